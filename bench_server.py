@@ -0,0 +1,380 @@
+"""Concurrent load generator for the Aegis server.
+
+Starts the server (in-process or as a subprocess, with ngrok stubbed out) and
+drives N simulated agents through a weighted mix of requests, then reports
+throughput, latency percentiles, connection setup cost and server RSS.
+
+    python bench_server.py --agents 8 --duration 10 --mix auth=1,alive=4,shell=4,run=1
+    python bench_server.py --target running --json bench_output.json
+    python bench_server.py --codecs
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from server import CODECS, COMPRESSORS, FRAME_COMPRESSED, MAX_FRAME_SIZE
+
+BENCH_HOST = '127.0.0.1'
+BENCH_PORT = 8080
+DEFAULT_MIX = "auth=1,alive=4,shell=4,run=1"
+STARTUP_TIMEOUT = 15.0
+CODEC_PAYLOAD_BYTES = 1 << 20   # size of each --codecs sample payload
+CODEC_MIN_SECONDS = 0.5         # each --codecs measurement repeats for at least this long
+
+# Stub script for --target subprocess: imports the server with ngrok disabled.
+_SUBPROCESS_SOURCE = (
+    "import sys, server\n"
+    "server.load_config()\n"
+    "server.start_ngrok = lambda: None\n"
+    "server.SERVER_MODE = sys.argv[1] or server.SERVER_MODE\n"
+    "server.start_server()\n"
+)
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of an already sorted list, in milliseconds."""
+    if not samples:
+        return None
+    index = min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))
+    return round(samples[index] * 1000, 3)
+
+def summarize(samples):
+    """Count, mean and p50/p90/p99/max latency of a list of durations in seconds."""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        "p50_ms": percentile(ordered, 0.50),
+        "p90_ms": percentile(ordered, 0.90),
+        "p99_ms": percentile(ordered, 0.99),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+    }
+
+def read_rss(pid):
+    """Resident set size of pid in KiB from /proc, or None where unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def parse_mix(text):
+    """Parse 'auth=1,alive=4' into a list of (kind, weight) pairs."""
+    mix = []
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f"Unknown request kind '{kind}'; expected one of {', '.join(REQUEST_KINDS)}.")
+        mix.append((kind, float(weight or 1)))
+    return mix
+
+class BenchClient:
+    """One simulated agent connection speaking the length-prefixed protocol."""
+
+    def __init__(self, identifier, host, port, codec="json", compression=None):
+        self.identifier = identifier
+        self.codec = CODECS[codec]
+        self.compressor = COMPRESSORS[compression]() if compression else None
+        started = time.perf_counter()
+        self.sock = socket.create_connection((host, port), timeout=30)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect_seconds = time.perf_counter() - started
+        handshake = {"id": identifier, "token": "bench", "framing": "length", "codec": codec}
+        if compression:
+            handshake["compression"] = compression
+        self.sock.sendall(json.dumps(handshake).encode('utf-8'))
+        response = self.recv()
+        if "new_token" not in response:
+            raise ConnectionError(f"Authentication failed: {response}")
+        self.token = response["new_token"]
+        self.setup_seconds = time.perf_counter() - started
+
+    def recv_exact(self, size):
+        chunks = b""
+        while len(chunks) < size:
+            chunk = self.sock.recv(size - len(chunks))
+            if not chunk:
+                raise ConnectionError("Connection closed while reading frame.")
+            chunks += chunk
+        return chunks
+
+    def recv(self):
+        (length,) = struct.unpack("!I", self.recv_exact(4))
+        body = self.recv_exact(length & ~FRAME_COMPRESSED)
+        if length & FRAME_COMPRESSED:
+            body = self.compressor.decompress(body, MAX_FRAME_SIZE)
+        return self.codec.decode(body)
+
+    def request(self, **fields):
+        fields.update(id=self.identifier, token=self.token)
+        body = self.codec.encode(fields)
+        self.sock.sendall(struct.pack("!I", len(body)) + body)
+        return self.recv()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def _auth(agent, args):
+    """Fresh connection plus handshake: the cost a new agent pays before its first command."""
+    client = BenchClient(args.identifier, args.host, args.port, args.codec, args.compression)
+    client.close()
+    agent.setup.append(client.setup_seconds)
+
+def _alive(agent, args):
+    agent.client.request(command="hows alive")
+
+def _shell(agent, args):
+    agent.client.request(command=args.shell_command)
+
+def _run(agent, args):
+    agent.client.request(command="run", code=args.run_code)
+
+REQUEST_KINDS = {"auth": _auth, "alive": _alive, "shell": _shell, "run": _run}
+
+class Agent(threading.Thread):
+    """Issues weighted random requests over one session until the deadline passes."""
+
+    def __init__(self, index, args, mix, deadline):
+        super().__init__(name=f"bench-agent-{index}", daemon=True)
+        self.args = args
+        self.deadline = deadline
+        self.random = random.Random(args.seed + index)
+        self.kinds = [kind for kind, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.latencies = {kind: [] for kind in self.kinds}
+        self.setup = []
+        self.errors = 0
+        self.client = None
+
+    def run(self):
+        try:
+            self.client = BenchClient(
+                self.args.identifier, self.args.host, self.args.port, self.args.codec, self.args.compression
+            )
+            self.setup.append(self.client.setup_seconds)
+        except (OSError, ConnectionError):
+            self.errors += 1
+            return
+        try:
+            while time.monotonic() < self.deadline:
+                kind = self.random.choices(self.kinds, self.weights)[0]
+                started = time.perf_counter()
+                try:
+                    REQUEST_KINDS[kind](self, self.args)
+                except (OSError, ConnectionError, ValueError):
+                    self.errors += 1
+                    if kind != "auth":
+                        return
+                    continue
+                self.latencies[kind].append(time.perf_counter() - started)
+        finally:
+            self.client.close()
+
+def wait_for_port(host, port, timeout):
+    """Poll until the server accepts TCP connections or the timeout elapses."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return time.monotonic()
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Server did not listen on {host}:{port} within {timeout}s.")
+
+def start_target(args):
+    """Start the server under test; return (pid, stop callable, seconds until listening)."""
+    started = time.monotonic()
+    if args.target == "running":
+        wait_for_port(args.host, args.port, STARTUP_TIMEOUT)
+        return args.server_pid, lambda: None, None
+    if args.target == "subprocess":
+        process = subprocess.Popen(
+            [sys.executable, "-c", _SUBPROCESS_SOURCE, args.mode or ""],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+        def stop():
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        try:
+            ready = wait_for_port(args.host, args.port, STARTUP_TIMEOUT)
+        except TimeoutError:
+            stop()
+            raise
+        return process.pid, stop, ready - started
+
+    import server
+    server.load_config()
+    server.start_ngrok = lambda: None
+    if args.mode:
+        server.SERVER_MODE = args.mode
+    threading.Thread(target=server.start_server, name="bench-server", daemon=True).start()
+    ready = wait_for_port(args.host, args.port, STARTUP_TIMEOUT)
+    return os.getpid(), server.SHUTDOWN_EVENT.set, ready - started
+
+def run_benchmark(args):
+    """Run one benchmark and return the report as a dict."""
+    mix = parse_mix(args.mix)
+    pid, stop, startup_seconds = start_target(args)
+    try:
+        rss_before = read_rss(pid) if pid else None
+        deadline = time.monotonic() + args.duration
+        agents = [Agent(index, args, mix, deadline) for index in range(args.agents)]
+        started = time.perf_counter()
+        for agent in agents:
+            agent.start()
+        for agent in agents:
+            agent.join()
+        elapsed = time.perf_counter() - started
+        rss_after = read_rss(pid) if pid else None
+    finally:
+        stop()
+
+    by_kind = {kind: [] for kind, _ in mix}
+    setup = []
+    for agent in agents:
+        setup.extend(agent.setup)
+        for kind, samples in agent.latencies.items():
+            by_kind[kind].extend(samples)
+    every = [sample for samples in by_kind.values() for sample in samples]
+    return {
+        "config": {
+            "target": args.target, "mode": args.mode, "codec": args.codec,
+            "compression": args.compression, "agents": args.agents,
+            "duration": args.duration, "mix": args.mix, "seed": args.seed,
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": len(every),
+        "errors": sum(agent.errors for agent in agents),
+        "requests_per_second": round(len(every) / elapsed, 2) if elapsed else None,
+        "latency": summarize(every),
+        "latency_by_kind": {kind: summarize(samples) for kind, samples in by_kind.items()},
+        "connection_setup": summarize(setup),
+        "server_startup_seconds": round(startup_seconds, 3) if startup_seconds is not None else None,
+        "server_rss_kib": {"before": rss_before, "after": rss_after},
+    }
+
+def format_report(report):
+    """Human-readable summary of a report."""
+    latency = report["latency"]
+    setup = report["connection_setup"]
+    lines = [
+        f"{report['requests']} requests in {report['elapsed_seconds']}s "
+        f"({report['requests_per_second']} req/s, {report['errors']} errors) "
+        f"with {report['config']['agents']} agents",
+        f"latency  p50 {latency['p50_ms']} ms  p90 {latency['p90_ms']} ms  p99 {latency['p99_ms']} ms",
+        f"setup    p50 {setup['p50_ms']} ms  p99 {setup['p99_ms']} ms",
+        f"rss      {report['server_rss_kib']['before']} -> {report['server_rss_kib']['after']} KiB",
+    ]
+    for kind, stats in report["latency_by_kind"].items():
+        lines.append(f"  {kind:<6} n={stats['count']:<7} p50 {stats['p50_ms']} ms  p99 {stats['p99_ms']} ms")
+    return "\n".join(lines)
+
+def codec_payloads():
+    """Representative ~1 MiB responses: text output, binary output and many small batch results."""
+    rng = random.Random(0)
+    line = "Collecting package-name==1.2.3 (from -r requirements.txt (line 12))\n"
+    text = (line * (CODEC_PAYLOAD_BYTES // len(line) + 1))[:CODEC_PAYLOAD_BYTES]
+    # Server output is decoded with surrogateescape, so arbitrary bytes arrive as str.
+    binary = bytes(rng.getrandbits(8) for _ in range(CODEC_PAYLOAD_BYTES)).decode('utf-8', 'surrogateescape')
+    results = {}
+    size = 0
+    while size < CODEC_PAYLOAD_BYTES:
+        output = f"result line {len(results)}\n" * 4
+        results[f"item-{len(results)}"] = {"output": output, "exit_status": 0}
+        size += len(output)
+    return {
+        "text_output": {"output": text},
+        "binary_output": {"output": binary},
+        "batch_results": {"results": results},
+    }
+
+def _time_per_call(func, arg):
+    """Average seconds per call, repeating until CODEC_MIN_SECONDS have passed."""
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        func(arg)
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= CODEC_MIN_SECONDS:
+            return elapsed / calls
+
+def run_codec_benchmark():
+    """Encode/decode cost per MiB of payload and encoded size for every codec."""
+    report = {}
+    for payload_name, payload in codec_payloads().items():
+        report[payload_name] = {}
+        for codec_name, codec in CODECS.items():
+            encoded = codec.encode(payload)
+            mib = CODEC_PAYLOAD_BYTES / (1 << 20)
+            report[payload_name][codec_name] = {
+                "encoded_bytes": len(encoded),
+                "encode_ms_per_mib": round(_time_per_call(codec.encode, payload) * 1000 / mib, 3),
+                "decode_ms_per_mib": round(_time_per_call(codec.decode, encoded) * 1000 / mib, 3),
+            }
+    return report
+
+def format_codec_report(report):
+    lines = [f"{'payload':<15} {'codec':<8} {'bytes':>9} {'encode ms/MiB':>14} {'decode ms/MiB':>14}"]
+    for payload_name, codecs in report.items():
+        for codec_name, stats in codecs.items():
+            lines.append(f"{payload_name:<15} {codec_name:<8} {stats['encoded_bytes']:>9} "
+                         f"{stats['encode_ms_per_mib']:>14} {stats['decode_ms_per_mib']:>14}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the Aegis server.")
+    parser.add_argument("--target", choices=("inprocess", "subprocess", "running"), default="subprocess",
+                        help="start the server in this process, as a subprocess, or use one already running")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default=None,
+                        help="override SERVER_MODE for a server started by the benchmark")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid to sample RSS from with --target running")
+    parser.add_argument("--host", default=BENCH_HOST)
+    parser.add_argument("--port", type=int, default=BENCH_PORT)
+    parser.add_argument("--identifier", default="Jarvis")
+    parser.add_argument("--agents", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted request kinds: auth, alive, shell, run")
+    parser.add_argument("--shell-command", default="echo bench")
+    parser.add_argument("--run-code", default="print(sum(range(1000)))")
+    parser.add_argument("--codec", choices=sorted(CODECS), default="json", help="message codec the agents negotiate")
+    parser.add_argument("--compression", choices=sorted(COMPRESSORS), default=None,
+                        help="frame compression the agents negotiate")
+    parser.add_argument("--codecs", action="store_true",
+                        help="benchmark encode/decode cost per MiB of every codec instead of running load")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    if args.codecs:
+        report, formatter = run_codec_benchmark(), format_codec_report
+    else:
+        report, formatter = run_benchmark(args), format_report
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print(formatter(report))
+        if args.json:
+            with open(args.json, "w") as output:
+                json.dump(report, output, indent=2)
+
+if __name__ == '__main__':
+    main()
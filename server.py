@@ -12,10 +12,35 @@ __program_name__ = "Aegis Sandbox"
 import socket
 import subprocess
 import os
+import sys
 import time
 import json
 import secrets
 import signal
+import struct
+import codecs
+import errno
+import shlex
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import heapq
+import itertools
+import re
+import bisect
+import http.server
+import shutil
+import sqlite3
+import tempfile
+import urllib.request
+import zlib
+import hashlib
+import io
+import random
+import cProfile
+import pstats
+import tracemalloc
 from datetime import datetime, timedelta
 
 try:
@@ -34,28 +59,410 @@ except ImportError:
         pass
     init()
 
+try:
+    import resource  # POSIX only; commands run without rlimits elsewhere
+except ImportError:
+    resource = None
+
 import threading
-from queue import Queue
-import io
-import contextlib
-
-# Logging function should be defined before using it.
-def log_message(message, level="INFO"):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_entry = f"[{timestamp}] [{level}] {message}"
-    with open("server.log", "a") as log_file:
-        log_file.write(log_entry + "\n")
-    if level == "INFO":
-        color = Fore.CYAN
-    elif level == "WARNING":
-        color = Fore.YELLOW
-    elif level == "ERROR":
-        color = Fore.RED
-    elif level == "DEBUG":
-        color = Fore.GREEN
-    else:
-        color = Fore.WHITE
-    print(color + log_entry + Style.RESET_ALL)
+import atexit
+from queue import Queue, Empty
+
+# Logging configuration. Records are queued by log_message and written by a
+# single background LogWriter thread, so callers never touch the file or console.
+LOG_FILE = os.environ.get("AEGIS_LOG_FILE", 'server.log')  # shard processes log to their own file
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = "DEBUG"
+LOG_FLUSH_INTERVAL = 0.5       # seconds between forced flushes of the log file
+LOG_FLUSH_BYTES = 64 * 1024    # flush early once this much is buffered
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_COLORS = {"INFO": Fore.CYAN, "WARNING": Fore.YELLOW, "ERROR": Fore.RED, "DEBUG": Fore.GREEN}
+
+def drain_queue(items, timeout=None):
+    """Wait for one item, then take everything already queued so bursts become one write.
+
+    Returns (batch, stopped): stopped is True once the None sentinel was taken, and an
+    empty batch with stopped False means the timeout passed with nothing queued.
+    """
+    batch = []
+    try:
+        item = items.get(timeout=timeout)
+        while item is not None:
+            batch.append(item)
+            item = items.get_nowait()
+    except Empty:
+        return batch, False
+    return batch, True
+
+class LogWriter:
+    """Background writer that batches log records, flushes on interval/size and rotates by size."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = Queue()
+        self.thread = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._unflushed = 0
+        self._last_timestamp = (None, "")
+
+    def submit(self, record):
+        if self.thread is None:
+            self._start()
+        self.records.put(record)
+
+    def _start(self):
+        with self._start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="aegis-log", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def close(self, timeout=5):
+        """Drain queued records and stop the writer thread."""
+        if self.thread is None:
+            return
+        self.records.put(None)
+        self.thread.join(timeout)
+
+    def _format(self, record):
+        created, level, message, args = record
+        second = int(created)
+        if self._last_timestamp[0] != second:
+            self._last_timestamp = (second, datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S"))
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f"{message} {args}"
+        if not message.isascii():
+            # Command output may carry surrogate-escaped bytes that cannot be written as UTF-8.
+            message = message.encode('utf-8', 'backslashreplace').decode('utf-8')
+        return f"[{self._last_timestamp[1]}] [{level}] {message}"
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(LOG_BACKUP_COUNT - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if LOG_BACKUP_COUNT > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write_batch(self, batch):
+        console = []
+        for record in batch:
+            line = self._format(record) + "\n"
+            if LOG_MAX_BYTES and self._size and self._size + len(line) > LOG_MAX_BYTES:
+                self._rotate()
+            self._file.write(line)
+            self._size += len(line)
+            self._unflushed += len(line)
+            console.append(LOG_COLORS.get(record[1], Fore.WHITE) + line[:-1] + Style.RESET_ALL)
+        print("\n".join(console), flush=True)
+
+    def _run(self):
+        self._open()
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            batch, stopped = drain_queue(self.records, LOG_FLUSH_INTERVAL)
+            running = not stopped
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    print(f"Failed to write log records: {e}")
+            now = time.monotonic()
+            if self._unflushed and (
+                not running or self._unflushed >= LOG_FLUSH_BYTES or now - last_flush >= LOG_FLUSH_INTERVAL
+            ):
+                self._file.flush()
+                self._unflushed = 0
+                last_flush = now
+        self._file.close()
+
+LOG_WRITER = LogWriter(LOG_FILE)
+
+def log_message(message, level="INFO", *args):
+    """Queue a log record; args are %-formatted on the writer thread only if the level is enabled."""
+    if LOG_LEVELS.get(level, 40) < LOG_LEVELS[LOG_LEVEL]:
+        return
+    LOG_WRITER.submit((time.time(), level, message, args))
+
+# Structured audit trail: one JSON record per request, appended to hourly (UTC)
+# segments named <YYYYMMDD-HH>.<AUDIT_NAME>.jsonl under AUDIT_DIR. A closed
+# segment gets a .idx file with a sparse time index and the record offsets of
+# every token, so queries seek instead of scanning. An empty AUDIT_DIR disables it.
+AUDIT_DIR = "audit"
+AUDIT_NAME = os.environ.get("AEGIS_AUDIT_NAME", "server")  # shards write their own segments
+AUDIT_INDEX_STRIDE = 256      # records between entries of the time index
+AUDIT_TEXT_LIMIT = 1024       # characters of command text or code kept per record
+AUDIT_QUERY_LIMIT = 1000      # most records one query returns
+AUDIT_TOKEN_CHARS = 16        # tokens are stored as a SHA-256 prefix of this length
+
+def audit_token(token):
+    """Digest identifying a token in audit records without writing the token itself."""
+    return hashlib.sha256(str(token).encode('utf-8')).hexdigest()[:AUDIT_TOKEN_CHARS]
+
+def _audit_hour(ts):
+    return time.strftime("%Y%m%d-%H", time.gmtime(ts))
+
+def parse_audit_time(text):
+    """Epoch seconds from a number or an ISO 8601 time (local time unless it has an offset)."""
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+class AuditLog:
+    """Background writer and reader for the time-partitioned, indexed audit segments."""
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.records = Queue()
+        self.thread = None
+        self._start_lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._hour = None
+        self._index = None
+
+    def configure(self, directory):
+        self.directory = directory
+
+    def record(self, kind, session, duration, fields):
+        """Queue an audit record for one request handled for session."""
+        if not self.directory:
+            return
+        client = session.client_address
+        entry = {
+            "ts": round(time.time(), 6),
+            "session": session.session_id,
+            "identifier": session.identifier,
+            "token": audit_token(session.token),
+            "client": "%s:%s" % tuple(client[:2]) if isinstance(client, tuple) else str(client),
+            "kind": kind,
+            "duration": round(duration, 6),
+        }
+        entry.update(fields)
+        if self.thread is None:
+            self._start()
+        self.records.put(entry)
+
+    def _start(self):
+        with self._start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="aegis-audit", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def close(self, timeout=5):
+        """Write queued records, index the open segment and stop the writer thread."""
+        if self.thread is None:
+            return
+        self.records.put(None)
+        self.thread.join(timeout)
+
+    def flush(self, timeout=1.0):
+        """Wait until records queued so far are written, so a query can see them."""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        written = threading.Event()
+        self.records.put(written)
+        written.wait(timeout)
+
+    def _segment_path(self, hour, name=None):
+        return os.path.join(self.directory, f"{hour}.{name or self.name}.jsonl")
+
+    @staticmethod
+    def _new_index():
+        return {"count": 0, "first": None, "last": None, "times": [], "tokens": {}}
+
+    @staticmethod
+    def _add_to_index(index, entry, offset):
+        if index["count"] % AUDIT_INDEX_STRIDE == 0:
+            index["times"].append([entry["ts"], offset])
+        index["count"] += 1
+        index["first"] = entry["ts"] if index["first"] is None else index["first"]
+        index["last"] = entry["ts"]
+        index["tokens"].setdefault(entry["token"], []).append(offset)
+
+    @classmethod
+    def _scan_index(cls, path):
+        """Build the index of a segment that has none (still open, or left by a crash)."""
+        index = cls._new_index()
+        with open(path, "rb") as segment:
+            offset = 0
+            for line in segment:
+                if line.endswith(b"\n"):
+                    try:
+                        cls._add_to_index(index, json.loads(line), offset)
+                    except ValueError:
+                        pass
+                offset += len(line)
+        return index
+
+    def _write_index(self):
+        temporary = self._path[:-len(".jsonl")] + ".idx.tmp"
+        with open(temporary, "w", encoding="utf-8") as handle:
+            json.dump(self._index, handle, separators=(",", ":"))
+        os.replace(temporary, self._path[:-len(".jsonl")] + ".idx")
+
+    def _open_segment(self, hour):
+        if self._file is not None:
+            self._file.close()
+            self._write_index()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._segment_path(hour)
+        index = self._scan_index(path) if os.path.exists(path) else self._new_index()
+        with self._index_lock:
+            self._file = open(path, "ab")
+            self._path, self._hour, self._index = path, hour, index
+
+    def _write_batch(self, batch):
+        written = []
+        for entry in batch:
+            hour = _audit_hour(entry["ts"])
+            if hour != self._hour:
+                self._index_written(written)
+                self._open_segment(hour)
+            offset = self._file.tell()
+            self._file.write((json.dumps(entry, separators=(",", ":")) + "\n").encode('utf-8'))
+            written.append((entry, offset))
+        self._index_written(written)
+
+    def _index_written(self, written):
+        """Flush, then index the records just written, so offsets never point past readable data."""
+        if not written:
+            return
+        self._file.flush()
+        with self._index_lock:
+            for entry, offset in written:
+                self._add_to_index(self._index, entry, offset)
+        written.clear()
+
+    def _run(self):
+        running = True
+        while running:
+            items, stopped = drain_queue(self.records)
+            running = not stopped
+            waiters = [item for item in items if isinstance(item, threading.Event)]
+            batch = [item for item in items if not isinstance(item, threading.Event)]
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    log_message(f"Failed to write audit records: {e}", "ERROR")
+            for waiter in waiters:
+                waiter.set()
+        if self._file is not None:
+            self._file.close()
+            self._write_index()
+
+    def _load_index(self, path):
+        """Index for a segment: the live one, its .idx file, or a one-off scan."""
+        with self._index_lock:
+            if path == self._path:
+                index = self._index
+                return {"times": list(index["times"]),
+                        "tokens": {token: list(offsets) for token, offsets in index["tokens"].items()}}
+        try:
+            with open(path[:-len(".jsonl")] + ".idx", encoding="utf-8") as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return self._scan_index(path)
+
+    def _segments(self, since, until):
+        """Segment paths whose hour overlaps [since, until], grouped by hour in order."""
+        low = _audit_hour(since) if since is not None else ""
+        high = _audit_hour(until) if until is not None else "~"
+        hours = collections.defaultdict(list)
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        for name in names:
+            hour, _, rest = name.partition(".")
+            if rest.endswith(".jsonl") and low <= hour <= high:
+                hours[hour].append(os.path.join(self.directory, name))
+        return [sorted(hours[hour]) for hour in sorted(hours)]
+
+    def _read_segment(self, path, token, since, until):
+        index = self._load_index(path)
+        with open(path, "rb") as segment:
+            if token is not None:
+                for offset in index["tokens"].get(token, ()):
+                    segment.seek(offset)
+                    entry = json.loads(segment.readline())
+                    if (since is None or entry["ts"] >= since) and (until is None or entry["ts"] < until):
+                        yield entry
+                return
+            if since is not None and index["times"]:
+                # Start one index entry early: concurrent requests may be recorded slightly out of order.
+                position = bisect.bisect_left([ts for ts, _ in index["times"]], since) - 2
+                segment.seek(index["times"][max(position, 0)][1])
+            for line in segment:
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                if until is not None and entry["ts"] >= until + 1:
+                    break  # same tolerance at the end
+                if (since is None or entry["ts"] >= since) and (until is None or entry["ts"] < until):
+                    yield entry
+
+    def query(self, token=None, since=None, until=None, limit=AUDIT_QUERY_LIMIT):
+        """Return up to limit records, oldest first, for a token (or its digest) in [since, until)."""
+        if not self.directory:
+            return []
+        self.flush()
+        if token is not None and len(token) != AUDIT_TOKEN_CHARS:
+            token = audit_token(token)
+        limit = min(limit, AUDIT_QUERY_LIMIT)
+        results = []
+        for paths in self._segments(since, until):
+            hour = []
+            for path in paths:
+                hour.extend(self._read_segment(path, token, since, until))
+            hour.sort(key=lambda entry: entry["ts"])
+            results.extend(hour[:limit - len(results)])
+            if len(results) >= limit:
+                break
+        return results
+
+AUDIT = AuditLog(AUDIT_DIR, AUDIT_NAME)
+
+def audit_note(**fields):
+    """Add fields such as exit_status or output_bytes to the audit record of the current request."""
+    current = AUDIT_FIELDS.get()
+    if current is not None:
+        current.update(fields)
+
+def parse_audit_query(args):
+    """Turn 'token=... since=... until=... limit=...' words into AuditLog.query arguments."""
+    options = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in ("token", "since", "until", "limit"):
+            raise ValueError(f"Unknown audit filter '{arg}'; use token=, since=, until= or limit=.")
+        if key in ("since", "until"):
+            options[key] = parse_audit_time(value)
+        elif key == "limit":
+            options[key] = int(value)
+        else:
+            options[key] = value
+    return options
 
 # ASCII Art Logo and Information Header
 def print_banner():
@@ -83,385 +490,3460 @@ def print_banner():
     print(Fore.CYAN + banner + Style.RESET_ALL)
     print(info)
 
-# Load allowed identifier and ngrok command from AEGIS.env file.
+# Settings read from AEGIS.env by load_config(); these are the defaults.
 ALLOWED_ID = None
 NGROK_COMMAND = None
-try:
-    with open("AEGIS.env", "r") as env_file:
-        for line in env_file:
-            line = line.strip()
-            if line.startswith("ID="):
-                ALLOWED_ID = line.split("=", 1)[1].strip()
-            elif line.startswith("NGROK_COMMAND="):
-                NGROK_COMMAND = line.split("=", 1)[1].strip()
-    if ALLOWED_ID is None or len(ALLOWED_ID) != 14:
-        raise ValueError("Loaded identifier is not a 14-character string.")
-    if NGROK_COMMAND is None:
-        NGROK_COMMAND = "ngrok http 8080"
-    log_message("Allowed identifier loaded from AEGIS.env: " + ALLOWED_ID, "INFO")
-    log_message("Ngrok command loaded from AEGIS.env: " + NGROK_COMMAND, "INFO")
-except Exception as e:
-    print(f"Error loading configuration from AEGIS.env: {e}")
-    exit(1)
+SERVER_MODE = "threaded"
+RUN_PRELOAD_MODULES = []
+DANGEROUS_RULES_FILE = "dangerous_commands.txt"
+METRICS_PORT = 0
+MIN_THREADS = 2          # worker threads kept alive when idle
+MAX_THREADS = 32         # worker threads the pool may grow to under load
+LISTEN_BACKLOG = 128     # pending connections the kernel queues before accept()
+QUEUE_HIGH_WATER = 64    # accepted connections waiting for a worker before new ones are refused
+SHARDS = 1               # listener processes sharing PORT via SO_REUSEPORT; 1 disables the supervisor
+COMMAND_TIMEOUT = 300            # default seconds a shell command may run; requests may pass "timeout"
+COMMAND_CPU_LIMIT = 300          # RLIMIT_CPU seconds per command process, 0 disables
+COMMAND_MEMORY_LIMIT = 0         # RLIMIT_AS bytes per command process, 0 disables (JVM/Go tools reserve far more)
+COMMAND_NPROC_LIMIT = 4096       # RLIMIT_NPROC (counted per user, not per command), 0 disables
+CONFIG_LOADED = False
+
+def load_config(path="AEGIS.env"):
+    """Read AEGIS.env into the module settings once; exit if it is missing or invalid."""
+    global CONFIG_LOADED, ALLOWED_ID, NGROK_COMMAND, SERVER_MODE, RUN_PRELOAD_MODULES, DANGEROUS_RULES_FILE
+    global METRICS_PORT, MIN_THREADS, MAX_THREADS, LISTEN_BACKLOG, QUEUE_HIGH_WATER, SHARDS, LOG_LEVEL
+    global COMMAND_TIMEOUT, COMMAND_CPU_LIMIT, COMMAND_MEMORY_LIMIT, COMMAND_NPROC_LIMIT, AUDIT_DIR
+    global PORT, ADMIN_PORT, RUN_POOL_SIZE
+    if CONFIG_LOADED:
+        return
+    try:
+        with open(path, "r") as env_file:
+            for line in env_file:
+                line = line.strip()
+                if line.startswith("ID="):
+                    ALLOWED_ID = line.split("=", 1)[1].strip()
+                elif line.startswith("NGROK_COMMAND="):
+                    NGROK_COMMAND = line.split("=", 1)[1].strip()
+                elif line.startswith("SERVER_MODE="):
+                    SERVER_MODE = line.split("=", 1)[1].strip().lower()
+                elif line.startswith("RUN_PRELOAD="):
+                    RUN_PRELOAD_MODULES = [name.strip() for name in line.split("=", 1)[1].split(",") if name.strip()]
+                elif line.startswith("RUN_POOL_SIZE="):
+                    RUN_POOL_SIZE = int(line.split("=", 1)[1].strip())
+                elif line.startswith("DANGEROUS_RULES="):
+                    DANGEROUS_RULES_FILE = line.split("=", 1)[1].strip()
+                elif line.startswith("METRICS_PORT="):
+                    METRICS_PORT = int(line.split("=", 1)[1].strip())
+                elif line.startswith("MIN_THREADS="):
+                    MIN_THREADS = int(line.split("=", 1)[1].strip())
+                elif line.startswith("MAX_THREADS="):
+                    MAX_THREADS = int(line.split("=", 1)[1].strip())
+                elif line.startswith("LISTEN_BACKLOG="):
+                    LISTEN_BACKLOG = int(line.split("=", 1)[1].strip())
+                elif line.startswith("QUEUE_HIGH_WATER="):
+                    QUEUE_HIGH_WATER = int(line.split("=", 1)[1].strip())
+                elif line.startswith("SHARDS="):
+                    SHARDS = int(line.split("=", 1)[1].strip())
+                elif line.startswith("LOG_LEVEL="):
+                    LOG_LEVEL = line.split("=", 1)[1].strip().upper()
+                elif line.startswith("COMMAND_TIMEOUT="):
+                    COMMAND_TIMEOUT = float(line.split("=", 1)[1].strip())
+                elif line.startswith("COMMAND_CPU_LIMIT="):
+                    COMMAND_CPU_LIMIT = int(line.split("=", 1)[1].strip())
+                elif line.startswith("COMMAND_MEMORY_LIMIT="):
+                    COMMAND_MEMORY_LIMIT = int(line.split("=", 1)[1].strip())
+                elif line.startswith("COMMAND_NPROC_LIMIT="):
+                    COMMAND_NPROC_LIMIT = int(line.split("=", 1)[1].strip())
+                elif line.startswith("AUDIT_DIR="):
+                    AUDIT_DIR = line.split("=", 1)[1].strip()
+                elif line.startswith("PORT="):
+                    PORT = int(line.split("=", 1)[1].strip())
+                elif line.startswith("ADMIN_PORT="):
+                    ADMIN_PORT = int(line.split("=", 1)[1].strip())
+        if ALLOWED_ID is None or len(ALLOWED_ID) != 14:
+            raise ValueError("Loaded identifier is not a 14-character string.")
+        if NGROK_COMMAND is None:
+            NGROK_COMMAND = "ngrok http 8080"
+        if LOG_LEVEL not in LOG_LEVELS:
+            raise ValueError(f"LOG_LEVEL must be one of {', '.join(LOG_LEVELS)}, got '{LOG_LEVEL}'.")
+        if SERVER_MODE not in ("threaded", "asyncio"):
+            raise ValueError(f"SERVER_MODE must be 'threaded' or 'asyncio', got '{SERVER_MODE}'.")
+        if not 1 <= MIN_THREADS <= MAX_THREADS:
+            raise ValueError(f"Need 1 <= MIN_THREADS <= MAX_THREADS, got {MIN_THREADS} and {MAX_THREADS}.")
+        if RUN_POOL_SIZE < 1:
+            raise ValueError(f"RUN_POOL_SIZE must be at least 1, got {RUN_POOL_SIZE}.")
+        if not 0 < COMMAND_TIMEOUT <= COMMAND_MAX_TIMEOUT:
+            raise ValueError(f"COMMAND_TIMEOUT must be between 0 and {COMMAND_MAX_TIMEOUT} seconds.")
+        log_message(f"Allowed identifier loaded from {path}: {ALLOWED_ID}", "INFO")
+        log_message(f"Ngrok command loaded from {path}: {NGROK_COMMAND}", "INFO")
+    except Exception as e:
+        print(f"Error loading configuration from {path}: {e}")
+        sys.exit(1)
+    CONFIG_LOADED = True
+    WORKER_POOL.configure(MIN_THREADS, MAX_THREADS, QUEUE_HIGH_WATER)
+    AUDIT.configure(AUDIT_DIR)
+    load_dangerous_rules()
 
 # Configuration
 HOST = '127.0.0.1'
 PORT = 8080
-LOG_FILE = 'server.log'
-AUTHORIZED_TOKENS = set()
+TOKEN_TTL = timedelta(hours=12)   # tokens unused for this long are forgotten
+TOKEN_MAX_COUNT = 10000           # least recently used tokens are evicted beyond this
 SERVER_START_TIME = datetime.now()
 SESSION_TIMEOUT = timedelta(minutes=1)
-MAX_THREADS = 10
+WORKER_IDLE_TIMEOUT = 30.0   # seconds an idle worker above MIN_THREADS waits before exiting
+WORKER_GROW_WAIT = 0.05      # queue wait (seconds) that makes the pool add a worker
+BUSY_RETRY_AFTER = 1         # seconds a refused client is told to wait before reconnecting
 VALID_IDENTIFIERS = ("Jarvis",)
 
+# Tunnel startup: the server accepts local connections at once while ngrok comes
+# up; readiness is the "started tunnel" log line or a public URL on its local API.
+NGROK_READY_TIMEOUT = 15.0
+NGROK_POLL_INTERVAL = 0.25
+NGROK_API_URL = "http://127.0.0.1:4040/api/tunnels"
+TUNNEL_READY_PATTERN = re.compile(r'started tunnel.*?url["=:]+\s*"?([^\s"]+)')
+_TUNNEL_STUB_SOURCE = (
+    "import sys, time\n"
+    "print('t=0 lvl=info msg=\"started tunnel\" obj=tunnels url=https://stub.invalid', flush=True)\n"
+    "time.sleep(1e9)\n"
+)
+STARTUP_TIMES = {}  # started (monotonic), startup_seconds, tunnel_ready_seconds, tunnel_url
+
+# Metrics: served by the 'stats' command and, when METRICS_PORT is set in
+# AEGIS.env, as Prometheus text on http://127.0.0.1:METRICS_PORT/metrics.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# On-demand profiling, started from the admin channel ("profile start ...").
+# While a window is open, sampled requests run under cProfile one at a time
+# (optionally with tracemalloc on); when it closes a report goes to PROFILE_DIR.
+# With no window open the request path pays a single attribute check.
+PROFILE_DIR = "profiles"
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+PROFILE_REPORT_LINES = 40
+
 # Global shutdown event to control graceful shutdown
 SHUTDOWN_EVENT = threading.Event()
 
-# Thread pool and task queue
-thread_pool = []
+# Task queue of accepted connections, drained by WORKER_POOL
 task_queue = Queue()
 
+# asyncio engine: sessions are coroutines, blocking command work runs on this executor.
+ASYNC_EXECUTOR_WORKERS = 32
+COMMAND_EXECUTOR = None
+
+# Wire protocol framing. Legacy clients send one JSON document per recv();
+# clients that ask for "framing": "length" in their handshake switch to
+# 4-byte big-endian length-prefixed frames for the rest of the session.
+FRAMING_LEGACY = "legacy"
+FRAMING_LENGTH = "length"
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_CHUNK_SIZE = 65536
+
+# Message codecs. "json" is the default; framed clients may ask for "codec":
+# "msgpack" in their handshake, in which case command output ("output" and
+# streamed "data" fields) travels as raw bytes instead of escaped text.
+CODEC_JSON = "json"
+CODEC_MSGPACK = "msgpack"
+BINARY_FIELDS = frozenset(("output", "data"))
+MSGPACK_MAX_DEPTH = 32
+
+# Frame compression ("compression": "zlib" in a framed handshake). Frames whose
+# encoded body exceeds COMPRESSION_THRESHOLD are compressed when that makes them
+# smaller; the top bit of the length header marks a compressed frame.
+COMPRESSION_THRESHOLD = 1024
+FRAME_COMPRESSED = 0x80000000
+ZLIB_LEVEL = 6
+
+# File transfer: get_file/put_file move raw bytes after a framed header, using
+# sendfile for downloads and fixed-size chunks for uploads.
+FILE_CHUNK_SIZE = 1024 * 1024
+FILE_CHECKSUMS = frozenset(("md5", "sha1", "sha256", "sha512"))
+
+# Optional long-lived shell per session ("persistent_shell": true in the handshake).
+PERSISTENT_SHELL = "/bin/sh"
+
+# Shell commands run in their own process group under the COMMAND_* rlimits.
+# When a command's deadline passes the group gets SIGTERM, then SIGKILL after
+# COMMAND_KILL_GRACE, and the reply carries the partial output with
+# "timed_out": true. A persistent shell that times out is restarted.
+COMMAND_MAX_TIMEOUT = 24 * 60 * 60   # upper bound for COMMAND_TIMEOUT and per-request "timeout"
+COMMAND_KILL_GRACE = 2.0
+
+# Interpreter pool for the "run" command. Each worker is a separate Python
+# process with RUN_PRELOAD_MODULES already imported; a worker that exceeds
+# RUN_TIMEOUT or RUN_MEMORY_LIMIT is killed and replaced.
+RUN_POOL_SIZE = os.cpu_count() or 4    # workers for the whole server; shards split them
+RUN_TIMEOUT = 30                       # seconds of wall-clock time per job
+RUN_MEMORY_LIMIT = 1024 * 1024 * 1024  # bytes of address space per worker (POSIX), 0 disables
+RUN_POOL = None
+RUN_POOL_LOCK = threading.Lock()
+RUN_RESPAWN_BACKOFF = 0.5    # first retry delay (seconds) after a replacement fails to start; doubles
+RUN_RESPAWN_MAX_BACKOFF = 30
+
+# Opt-in persistent namespaces for "run" ("kernel": true). Each token gets its
+# own interpreter whose globals survive between snippets until "reset": true,
+# the token's last session closing, or eviction of the least recently used
+# idle kernels once there are more than RUN_KERNEL_MAX of them or their
+# resident memory adds up to more than RUN_KERNEL_MEMORY_BUDGET.
+RUN_KERNEL_MAX = 32
+RUN_KERNEL_MEMORY_BUDGET = 4 * 1024 * 1024 * 1024
+
+# Batch requests: {"command": "batch", "commands": [{"id": ..., "command": ...}, ...]}
+BATCH_MAX_ITEMS = 100
+BATCH_MAX_CONCURRENCY = 16
+BATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=BATCH_MAX_CONCURRENCY, thread_name_prefix="aegis-batch"
+)
+
+# Multiplexed channels ("channels": true in a framed handshake). A request with a
+# "channel" id runs alongside other channels but in order within its own, and
+# every message it produces echoes the id. Untagged requests run one at a time
+# as before. {"command": "cancel", "channel": id} drops the channel's queue and
+# kills its running command.
+CHANNEL_MAX = 16              # channels open at once per session
+CHANNEL_QUEUE_DEPTH = 32      # requests waiting per channel
+CHANNEL_WORKERS = 64          # threads shared by every session's channels
+CHANNEL_DEFAULT_ONLY = ("exit", "shutdown", "put_file")
+CHANNEL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=CHANNEL_WORKERS, thread_name_prefix="aegis-channel"
+)
+CURRENT_CHANNEL = contextvars.ContextVar("aegis_channel", default=None)
+AUDIT_FIELDS = contextvars.ContextVar("aegis_audit", default=None)  # extra fields for the request's audit record
+
+# Opt-in result cache ("cache": true) for read-only commands. Only commands
+# matching CACHEABLE_COMMANDS, with no shell control characters, are cached.
+RESULT_CACHE_TTL = 10                       # seconds
+RESULT_CACHE_MAX_BYTES = 16 * 1024 * 1024   # total cached output
+CACHEABLE_COMMANDS = [
+    r"ls( [^ ]+)*",
+    r"cat( [^ ]+)+",
+    r"head( [^ ]+)+",
+    r"pwd",
+    r"uname( -[a-z]+)*",
+    r"whoami",
+    r"hostname",
+    r"(python3?|pip3?|node|git) --version",
+    r"pip3? (list|freeze)",
+    r"git status( [^ ]+)*",
+    # No --output (or an abbreviation of it), which writes a file.
+    r"git (log|diff)( (?!--ou)[^ ]+)*",
+    # Listing only: any other argument names a branch to create, move or delete.
+    r"git branch( (-a|-r|-v|-vv|--all|--remotes|--verbose|--list|--show-current))*",
+]
+SHELL_CONTROL_CHARS = set(";|&<>`$()\n")
+
+# Streaming command output ("stream": true, framed sessions only).
+STREAM_CHUNK_SIZE = 8192
+STREAM_QUEUE_DEPTH = 64
+
 # Define dangerous command keywords
 DANGEROUS_KEYWORDS = ["rm -rf", "del /f", "mkfs", "dd if=", "reboot", "poweroff", "halt"]
 
-# Global admin approval function (can be overridden for tests)
-ADMIN_APPROVAL_FUNC = input
+# Global admin approval function (can be overridden for tests). When it is None,
+# dangerous commands are parked in APPROVALS and decided through the admin channel.
+ADMIN_APPROVAL_FUNC = None
+
+# Admin channel: a line-based socket bound to localhost (and the console, when
+# interactive) accepting 'list', 'approve <id>' and 'deny <id>'. Socket clients must
+# first send 'auth <secret>'. The secret comes from AEGIS_ADMIN_SECRET in the server's
+# environment, never from AEGIS.env, which commands can read. start_server removes it
+# from the environment so commands do not inherit it. Without it, a secret is
+# generated at startup and printed on the console only.
+ADMIN_HOST = '127.0.0.1'
+ADMIN_PORT = 8081
+ADMIN_SECRET = None
+# Shards serve their admin channel on a private Unix socket (AEGIS_ADMIN_SOCKET) instead;
+# the supervisor owns ADMIN_PORT and forwards commands to them.
+ADMIN_SOCKET = None
+SHARD_ADMIN_TIMEOUT = 10.0
+APPROVAL_TIMEOUT = timedelta(minutes=5)
+APPROVAL_WORKERS = 4
+
+def normalize_command(command):
+    """Canonical form used for keyword matching: shell quoting removed, lowercased, single-spaced."""
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        # Unbalanced quotes: drop quoting characters and split on whitespace instead.
+        tokens = command.translate(_QUOTE_CHARS).split()
+    return " ".join(tokens).lower()
+
+_QUOTE_CHARS = str.maketrans("", "", "'\"\\`")
+
+class KeywordMatcher:
+    """Aho-Corasick automaton: finds any of its keywords in one linear pass over the text."""
+
+    def __init__(self, keywords):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.terminal = [False]
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.terminal.append(False)
+                    self.transitions[state][char] = next_state
+                state = next_state
+            self.terminal[state] = True
+        # Breadth-first pass to fill in failure links.
+        pending = collections.deque(self.transitions[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self.transitions[state].items():
+                pending.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.transitions[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.terminal[next_state] = self.terminal[next_state] or self.terminal[self.fail[next_state]]
+
+    def search(self, text):
+        """Return True if any keyword occurs in text."""
+        transitions, fail, terminal = self.transitions, self.fail, self.terminal
+        state = 0
+        for char in text:
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            if terminal[state]:
+                return True
+        return False
+
+def load_dangerous_rules(path=None):
+    """Build the dangerous-command matcher from DANGEROUS_KEYWORDS plus any patterns in the rules file."""
+    global DANGEROUS_MATCHER
+    keywords = list(DANGEROUS_KEYWORDS)
+    path = path or DANGEROUS_RULES_FILE
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as rules_file:
+            for line in rules_file:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    keywords.append(line)
+        log_message(f"Loaded dangerous command rules from {path}.", "INFO")
+    normalized = {normalize_command(keyword) for keyword in keywords}
+    DANGEROUS_MATCHER = KeywordMatcher(sorted(keyword for keyword in normalized if keyword))
+    return DANGEROUS_MATCHER
 
 def is_dangerous_command(command):
     """Check if the command contains dangerous keywords."""
-    for keyword in DANGEROUS_KEYWORDS:
-        if keyword in command:
+    matcher = DANGEROUS_MATCHER or load_dangerous_rules()
+    return matcher.search(normalize_command(command))
+
+DANGEROUS_MATCHER = None  # built by load_config(), or on first use
+
+class TokenRecord:
+    """Bookkeeping for one issued token."""
+    __slots__ = ("identifier", "issued", "last_used")
+
+    def __init__(self, identifier, now):
+        self.identifier = identifier
+        self.issued = now
+        self.last_used = now
+
+class TokenRegistry:
+    """Issued tokens in least-recently-used order, bounded by count and idle TTL.
+
+    The OrderedDict keeps the stalest token at the front, so both TTL expiry and
+    LRU eviction only ever pop from the front: O(1) per token.
+    """
+
+    def __init__(self, ttl, max_count):
+        self.ttl = ttl.total_seconds()
+        self.max_count = max_count
+        self._tokens = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _purge_expired(self, now):
+        while self._tokens:
+            token, record = next(iter(self._tokens.items()))
+            if now - record.last_used <= self.ttl:
+                break
+            self._tokens.popitem(last=False)
+
+    def issue(self, identifier):
+        """Create, record and return a new token owned by identifier."""
+        token = secrets.token_hex(16)
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            self._tokens[token] = TokenRecord(identifier, now)
+            while len(self._tokens) > self.max_count:
+                self._tokens.popitem(last=False)
+        return token
+
+    def validate(self, token, identifier):
+        """Return True and refresh the token if it is live and owned by identifier."""
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            record = self._tokens.get(token)
+            if record is None or record.identifier != identifier:
+                return False
+            record.last_used = now
+            self._tokens.move_to_end(token)
             return True
-    return False
 
-def generate_token():
+    def revoke(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def __len__(self):
+        return len(self._tokens)
+
+class SharedTokenStore:
+    """TokenRegistry counterpart kept in a SQLite file so every shard process sees the same tokens."""
+
+    def __init__(self, path, ttl, max_count):
+        self.path = path
+        self.ttl = ttl.total_seconds()
+        self.max_count = max_count
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tokens "
+                       "(token TEXT PRIMARY KEY, identifier TEXT NOT NULL, last_used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS tokens_last_used ON tokens (last_used)")
+
+    def _connect(self):
+        """One connection per thread; WAL lets shards read while another writes."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def issue(self, identifier):
+        """Create, record and return a new token owned by identifier."""
+        token = secrets.token_hex(16)
+        now = time.time()
+        with self._connect() as db:
+            db.execute("DELETE FROM tokens WHERE last_used < ?", (now - self.ttl,))
+            db.execute("INSERT INTO tokens VALUES (?, ?, ?)", (token, identifier, now))
+            db.execute("DELETE FROM tokens WHERE token IN (SELECT token FROM tokens ORDER BY last_used "
+                       "LIMIT max(0, (SELECT COUNT(*) FROM tokens) - ?))", (self.max_count,))
+        return token
+
+    def validate(self, token, identifier):
+        """Return True and refresh the token if it is live and owned by identifier."""
+        now = time.time()
+        with self._connect() as db:
+            cursor = db.execute("UPDATE tokens SET last_used = ? WHERE token = ? AND identifier = ? "
+                                "AND last_used >= ?", (now, token, identifier, now - self.ttl))
+        return cursor.rowcount == 1
+
+    def revoke(self, token):
+        with self._connect() as db:
+            db.execute("DELETE FROM tokens WHERE token = ?", (token,))
+
+    def __len__(self):
+        cursor = self._connect().execute("SELECT COUNT(*) FROM tokens WHERE last_used >= ?",
+                                         (time.time() - self.ttl,))
+        return cursor.fetchone()[0]
+
+AUTHORIZED_TOKENS = TokenRegistry(TOKEN_TTL, TOKEN_MAX_COUNT)
+
+class Histogram:
+    """Fixed-bucket latency histogram; observe() is a bisect and three additions."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket containing the given fraction of observations."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+class MetricsRegistry:
+    """In-process counters, up/down gauges, callback gauges and labelled latency histograms."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._levels = collections.Counter()
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, label=None, amount=1):
+        with self._lock:
+            self._counters[(name, label)] += amount
+
+    def add(self, name, amount):
+        """Move an up/down gauge such as active sessions."""
+        with self._lock:
+            self._levels[name] += amount
+
+    def observe(self, name, label, seconds):
+        with self._lock:
+            histogram = self._histograms.get((name, label))
+            if histogram is None:
+                histogram = self._histograms[(name, label)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def register_gauge(self, name, read):
+        """Register a gauge whose value is read by calling read() at snapshot time."""
+        self._gauges[name] = read
+
+    def _gauge_values(self):
+        values = dict(self._levels)
+        for name, read in self._gauges.items():
+            try:
+                values[name] = read()
+            except Exception:
+                values[name] = None
+        return values
+
+    def snapshot(self):
+        """Return every metric as plain JSON-serialisable data."""
+        with self._lock:
+            counters = {}
+            for (name, label), value in self._counters.items():
+                counters.setdefault(name, {})[label or "total"] = value
+            latency = {}
+            for (name, label), histogram in self._histograms.items():
+                latency.setdefault(name, {})[label or "total"] = {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "p50": histogram.percentile(0.5),
+                    "p90": histogram.percentile(0.9),
+                    "p99": histogram.percentile(0.99),
+                }
+            gauges = self._gauge_values()
+        return {"counters": counters, "gauges": gauges, "latency": latency}
+
+    def prometheus(self):
+        """Render every metric in the Prometheus text exposition format."""
+        def labels(label, extra=""):
+            parts = [f'kind="{label}"'] if label else []
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE aegis_{name} counter")
+                for (metric, label), value in sorted(self._counters.items(), key=lambda item: str(item[0])):
+                    if metric == name:
+                        lines.append(f"aegis_{name}{labels(label)} {value}")
+            for name, value in sorted(self._gauge_values().items()):
+                if value is not None:
+                    lines.append(f"# TYPE aegis_{name} gauge")
+                    lines.append(f"aegis_{name} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE aegis_{name} histogram")
+                for (metric, label), histogram in sorted(self._histograms.items(), key=lambda item: str(item[0])):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets + ("+Inf",), histogram.counts):
+                        cumulative += bucket_count
+                        bucket_labels = labels(label, 'le="%s"' % bound)
+                        lines.append(f"aegis_{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"aegis_{name}_sum{labels(label)} {histogram.sum}")
+                    lines.append(f"aegis_{name}_count{labels(label)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry(LATENCY_BUCKETS)
+
+class Profiler:
+    """Admin-controlled profiling window over request handling, written to a report file when it ends."""
+
+    def __init__(self):
+        self.active = False
+        self._lock = threading.Lock()
+        self._sampling = threading.Lock()  # one profiled request at a time; others run untouched
+        self._timer = None
+
+    def start(self, seconds=PROFILE_DEFAULT_SECONDS, requests=None, sample=1.0, memory=False):
+        """Open a window of at most seconds, ending early after requests profiled requests."""
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {PROFILE_MAX_SECONDS}.")
+        if requests is not None and requests < 1:
+            raise ValueError("requests must be a positive integer.")
+        if not 0 < sample <= 1:
+            raise ValueError("sample must be in (0, 1].")
+        with self._lock:
+            if self.active:
+                raise ValueError("Profiling is already running; use 'profile stop' first.")
+            self._stats = None
+            self._stages = collections.defaultdict(lambda: [0, 0.0, 0])
+            self._profiled = 0
+            self._max_requests = requests
+            self._sample = sample
+            self._seconds = seconds
+            self._started = time.time()
+            self._tracing = memory and not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+            self._timer = threading.Timer(seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+            self.active = True
+        log_message(f"Profiling started for up to {seconds}s (sample {sample}, memory {bool(memory)}).", "WARNING")
+
+    def status(self):
+        with self._lock:
+            if not self.active:
+                return "Profiling is off."
+            left = self._seconds - (time.time() - self._started)
+            return f"Profiling: {self._profiled} requests profiled, {max(left, 0):.0f}s left."
+
+    def run(self, stage, call, *args):
+        """Return call(*args), profiling it if this request is sampled and no other one is being profiled."""
+        started = time.perf_counter()
+        sampled = (self._sample >= 1 or random.random() < self._sample) and self._sampling.acquire(blocking=False)
+        profile = cProfile.Profile() if sampled else None
+        try:
+            return profile.runcall(call, *args) if sampled else call(*args)
+        finally:
+            # Merge before releasing, so stop() can wait for the request being profiled.
+            self._record(stage, time.perf_counter() - started, profile)
+            if sampled:
+                self._sampling.release()
+
+    def _record(self, stage, elapsed, profile):
+        finished = False
+        with self._lock:
+            if not self.active:
+                return
+            totals = self._stages[stage]
+            totals[0] += 1
+            totals[1] += elapsed
+            if profile is not None:
+                totals[2] += 1
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self._profiled += 1
+                finished = self._max_requests is not None and self._profiled >= self._max_requests
+        if finished:
+            threading.Thread(target=self.stop, daemon=True).start()
+
+    def stop(self):
+        """Close the window and write the report; return its path, or None if nothing was running."""
+        # Let a request that is being profiled right now finish, unless it is long-running.
+        waited = self._sampling.acquire(timeout=1.0)
+        try:
+            return self._stop()
+        finally:
+            if waited:
+                self._sampling.release()
+
+    def _stop(self):
+        with self._lock:
+            if not self.active:
+                return None
+            self.active = False
+            self._timer.cancel()
+            snapshot = tracemalloc.take_snapshot() if self._tracing else None
+            if self._tracing:
+                tracemalloc.stop()
+            stats, stages, profiled = self._stats, dict(self._stages), self._profiled
+            window = time.time() - self._started
+        path = self._write_report(stats, stages, profiled, window, snapshot)
+        log_message(f"Profiling stopped after {window:.1f}s; report written to {path}", "WARNING")
+        return path
+
+    def _write_report(self, stats, stages, profiled, window, snapshot):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.abspath(os.path.join(
+            PROFILE_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        ))
+        report = io.StringIO()
+        report.write(f"Profiling window: {window:.1f}s, {profiled} requests profiled (sample {self._sample})\n\n")
+        report.write(f"{'stage':<12} {'requests':>9} {'profiled':>9} {'total s':>10} {'mean ms':>9}\n")
+        for stage, (count, total, sampled) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            report.write(f"{stage:<12} {count:>9} {sampled:>9} {total:>10.3f} {1000 * total / count:>9.2f}\n")
+        if stats is not None:
+            stats.dump_stats(base + ".prof")
+            stats.stream = report
+            for order in ("cumulative", "tottime"):
+                report.write(f"\n--- Functions by {order} time ---\n")
+                stats.sort_stats(order).print_stats(PROFILE_REPORT_LINES)
+        if snapshot is not None:
+            report.write("\n--- Allocations still held, by line (tracemalloc) ---\n")
+            for statistic in snapshot.statistics("lineno")[:PROFILE_REPORT_LINES]:
+                report.write(f"{statistic}\n")
+        with open(base + ".txt", "w", encoding="utf-8") as handle:
+            handle.write(report.getvalue())
+        return base + ".txt"
+
+PROFILER = Profiler()
+
+def parse_profile_options(args):
+    """Turn 'seconds=N requests=N sample=F memory' words into Profiler.start arguments."""
+    options = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if key == "memory" and not sep:
+            options["memory"] = True
+        elif sep and key == "seconds":
+            options["seconds"] = float(value)
+        elif sep and key == "requests":
+            options["requests"] = int(value)
+        elif sep and key == "sample":
+            options["sample"] = float(value)
+        else:
+            raise ValueError(f"Unknown profile option '{arg}'; use seconds=, requests=, sample= or memory.")
+    return options
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves METRICS in Prometheus text format at /metrics."""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_endpoint():
+    """Serve Prometheus metrics on 127.0.0.1:METRICS_PORT in a background thread."""
+    if not METRICS_PORT:
+        return None
+    try:
+        httpd = http.server.ThreadingHTTPServer((HOST, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        log_message(f"Metrics endpoint unavailable on {HOST}:{METRICS_PORT}: {e}", "ERROR")
+        return None
+    threading.Thread(target=httpd.serve_forever, name="aegis-metrics", daemon=True).start()
+    log_message(f"Metrics endpoint listening on http://{HOST}:{METRICS_PORT}/metrics", "INFO")
+    return httpd
+
+def generate_token(identifier):
     """Generate a random token to uniquely identify a session."""
-    token = secrets.token_hex(16)
-    AUTHORIZED_TOKENS.add(token)
-    log_message(f"Generated new token: '{token}'", "DEBUG")
+    token = AUTHORIZED_TOKENS.issue(identifier)
+    log_message("Generated new token: '%s'", "DEBUG", token)
     return token
 
+def tunnel_command():
+    """The tunnel command line; NGROK_COMMAND=stub runs a local stand-in for offline testing."""
+    if NGROK_COMMAND == "stub":
+        return [sys.executable, "-c", _TUNNEL_STUB_SOURCE]
+    return shlex.split(NGROK_COMMAND, posix=os.name != 'nt')
+
 def start_ngrok():
-    """Start ngrok using the specified command in a separate, invisible window."""
+    """Launch the tunnel process and return it at once; readiness is tracked in the background."""
     log_message("Starting ngrok...", "INFO")
     try:
         if os.name == 'nt':
             # For Windows: create a new process group and hide the window.
             creation_flags = subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.CREATE_NO_WINDOW
             ngrok_process = subprocess.Popen(
-                NGROK_COMMAND.split(),
+                tunnel_command(),
+                stdin=subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
                 creationflags=creation_flags
             )
         else:
             # For Unix-like systems: set the process group id so that children can be terminated
             ngrok_process = subprocess.Popen(
-                NGROK_COMMAND.split(),
+                tunnel_command(),
+                stdin=subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
                 preexec_fn=os.setsid
             )
-        time.sleep(5)  # Give ngrok time to initialize
-        log_message("Ngrok started successfully.", "INFO")
-        return ngrok_process
     except Exception as e:
         log_message(f"Failed to start ngrok: {e}", "ERROR")
         raise
+    ready = threading.Event()
+    threading.Thread(target=_drain_tunnel_output, args=(ngrok_process, ready),
+                     name="aegis-tunnel-log", daemon=True).start()
+    threading.Thread(target=_wait_for_tunnel, args=(ngrok_process, ready),
+                     name="aegis-tunnel", daemon=True).start()
+    return ngrok_process
 
-def validate_client(client_socket):
-    """Ensure client provides a valid identifier and token for authentication."""
-    try:
-        credentials = client_socket.recv(4096).decode('utf-8').strip()
+def _drain_tunnel_output(process, ready):
+    """Read tunnel output until EOF, flagging readiness when the 'started tunnel' line appears."""
+    for raw_line in iter(process.stdout.readline, b''):
+        line = raw_line.decode('utf-8', 'replace').strip()
+        match = TUNNEL_READY_PATTERN.search(line)
+        if match and not ready.is_set():
+            STARTUP_TIMES["tunnel_url"] = match.group(1)
+            ready.set()
+        log_message("ngrok: %s", "DEBUG", line)
+    process.stdout.close()
+
+def _wait_for_tunnel(process, ready):
+    """Poll the tunnel's local API until it reports a public URL, the output says so, or the deadline passes."""
+    deadline = time.monotonic() + NGROK_READY_TIMEOUT
+    while not ready.is_set() and time.monotonic() < deadline:
+        if process.poll() is not None:
+            log_message(f"Ngrok exited during startup with status {process.returncode}.", "ERROR")
+            return
         try:
-            data = json.loads(credentials)
-        except json.JSONDecodeError:
-            client_socket.sendall(json.dumps({"error": "Invalid JSON format."}).encode('utf-8'))
-            return None, None
+            with urllib.request.urlopen(NGROK_API_URL, timeout=0.5) as response:
+                tunnels = json.load(response).get("tunnels", [])
+            if tunnels:
+                STARTUP_TIMES["tunnel_url"] = tunnels[0].get("public_url")
+                ready.set()
+        except (OSError, ValueError):
+            pass
+        ready.wait(NGROK_POLL_INTERVAL)
+    if not ready.is_set():
+        log_message(f"Ngrok not ready after {NGROK_READY_TIMEOUT}s; serving local connections only.", "WARNING")
+        return
+    STARTUP_TIMES["tunnel_ready_seconds"] = round(time.monotonic() - STARTUP_TIMES["started"], 3)
+    log_message(f"Ngrok tunnel ready at {STARTUP_TIMES['tunnel_url']} "
+                f"({STARTUP_TIMES['tunnel_ready_seconds']}s after startup).", "INFO")
 
-        identifier = data.get('id')
-        token = data.get('token')
+class JsonCodec:
+    """The default codec: one UTF-8 JSON document per message."""
+    name = CODEC_JSON
+    invalid_message = "Invalid JSON format."
 
-        if not identifier or not token:
-            client_socket.sendall(json.dumps({"error": "Missing 'id' or 'token' fields."}).encode('utf-8'))
-            return None, None
+    def encode(self, payload):
+        return json.dumps(payload).encode('utf-8')
 
-        if identifier not in VALID_IDENTIFIERS:
-            # Only pre-approved identifiers are allowed for connections.
-            log_message(f"Invalid identifier: {identifier}", "WARNING")
-            client_socket.sendall(json.dumps({"error": "Invalid identifier."}).encode('utf-8'))
-            return None, None
+    def decode(self, body):
+        return json.loads(body)
 
-        log_message(f"Received identifier: {identifier}, token: {token}", "INFO")
+class MsgpackCodec:
+    """Dependency-free MessagePack subset: nil, bool, int, float, str, bin, array and map.
 
-        if token in AUTHORIZED_TOKENS:
-            # Reuse previously authorized tokens.
-            log_message(f"Token '{token}' already authorized.", "DEBUG")
-            return identifier, token
+    Strings under BINARY_FIELDS keys are sent as bin, restoring the exact bytes a
+    command wrote (output is decoded with surrogateescape).
+    """
+    name = CODEC_MSGPACK
+    invalid_message = "Invalid msgpack message."
 
-        log_message(f"Token '{token}' not recognized. Generating new token.", "INFO")
-        new_token = generate_token()
-        client_socket.sendall(json.dumps({"new_token": new_token}).encode('utf-8'))
-        return identifier, new_token
+    def encode(self, payload):
+        out = bytearray()
+        self._pack(payload, out, False)
+        return bytes(out)
 
-    except Exception as e:
-        # Handle unexpected validation errors.
-        log_message(f"Error during client validation: {e}", "ERROR")
-        client_socket.sendall(json.dumps({"error": "Server error during validation."}).encode('utf-8'))
-        return None, None
+    def _pack(self, obj, out, binary):
+        if obj is None:
+            out.append(0xc0)
+        elif obj is True or obj is False:
+            out.append(0xc3 if obj else 0xc2)
+        elif isinstance(obj, int):
+            if -32 <= obj < 0x80:
+                out.append(obj & 0xff)
+                return
+            for limit, tag, width in (_MSGPACK_UINTS if obj >= 0 else _MSGPACK_INTS):
+                if obj < limit if obj >= 0 else obj >= limit:
+                    out.append(tag)
+                    out += obj.to_bytes(width, "big", signed=obj < 0)
+                    return
+            raise ValueError(f"Integer {obj} does not fit in 64 bits.")
+        elif isinstance(obj, float):
+            out += struct.pack("!Bd", 0xcb, obj)
+        elif isinstance(obj, str):
+            data = obj.encode('utf-8', 'surrogateescape')
+            if binary:
+                self._pack_bytes(data, out)
+            else:
+                size = len(data)
+                if size < 32:
+                    out.append(0xa0 | size)
+                elif size < 1 << 8:
+                    out += struct.pack("!BB", 0xd9, size)
+                elif size < 1 << 16:
+                    out += struct.pack("!BH", 0xda, size)
+                else:
+                    out += struct.pack("!BI", 0xdb, size)
+                out += data
+        elif isinstance(obj, (bytes, bytearray)):
+            self._pack_bytes(obj, out)
+        elif isinstance(obj, (list, tuple)):
+            self._pack_header(len(obj), out, 0x90, 0xdc)
+            for item in obj:
+                self._pack(item, out, False)
+        elif isinstance(obj, dict):
+            self._pack_header(len(obj), out, 0x80, 0xde)
+            for key, value in obj.items():
+                self._pack(key, out, False)
+                self._pack(value, out, key in BINARY_FIELDS)
+        else:
+            raise TypeError(f"Cannot encode {type(obj).__name__} as msgpack.")
 
-def handle_client(client_socket, client_address):
-    """Process client commands after successful authentication."""
-    log_message(f"Connection received from {client_address}", "INFO")
+    @staticmethod
+    def _pack_bytes(data, out):
+        size = len(data)
+        if size < 1 << 8:
+            out += struct.pack("!BB", 0xc4, size)
+        elif size < 1 << 16:
+            out += struct.pack("!BH", 0xc5, size)
+        else:
+            out += struct.pack("!BI", 0xc6, size)
+        out += data
 
-    identifier, token = validate_client(client_socket)
-    if not identifier or not token:
-        log_message(f"Client {client_address} failed validation.", "WARNING")
-        client_socket.close()
-        return
+    @staticmethod
+    def _pack_header(size, out, fix, wide):
+        if size < 16:
+            out.append(fix | size)
+        elif size < 1 << 16:
+            out += struct.pack("!BH", wide, size)
+        else:
+            out += struct.pack("!BI", wide + 1, size)
 
-    session_start_time = datetime.now()
-    last_activity_time = datetime.now()
+    def decode(self, body):
+        """Decode one message; raises ValueError on malformed or trailing data."""
+        view = memoryview(body)
+        obj, offset = self._unpack(view, 0, 0)
+        if offset != len(view):
+            raise ValueError("Trailing bytes after msgpack message.")
+        return obj
 
-    # Set a short timeout on the socket so the loop can periodically check for timeouts.
-    client_socket.settimeout(1)
+    def _take(self, view, offset, size):
+        end = offset + size
+        if end > len(view):
+            raise ValueError("Truncated msgpack message.")
+        return view[offset:end], end
 
-    try:
-        while True:
-            try:
-                # Try to read data from the client.
-                input_data = client_socket.recv(4096).decode('utf-8').strip()
-            except socket.timeout:
-                current_time = datetime.now()
-                # If no data is received, check for timeouts.
-                if current_time - session_start_time > SESSION_TIMEOUT:
-                    try:
-                        client_socket.sendall(
-                            json.dumps({"error": "Session timed out."}).encode('utf-8')
-                        )
-                        client_socket.shutdown(socket.SHUT_WR)
-                        time.sleep(0.1)
-                    except Exception as exc:
-                        log_message(f"Error sending session timeout message: {exc}", "ERROR")
-                    log_message(f"Session for {client_address} timed out.", "WARNING")
-                    break
-                if current_time - last_activity_time > SESSION_TIMEOUT:
-                    try:
-                        client_socket.sendall(
-                            json.dumps({"error": "Idle timeout reached."}).encode('utf-8')
-                        )
-                        client_socket.shutdown(socket.SHUT_WR)
-                        time.sleep(0.1)
-                    except Exception as exc:
-                        log_message(f"Error sending idle timeout message: {exc}", "ERROR")
-                    log_message(f"Session for {client_address} idle too long.", "WARNING")
-                    break
-                continue
+    def _unpack(self, view, offset, depth):
+        if depth > MSGPACK_MAX_DEPTH:
+            raise ValueError("msgpack message nested too deeply.")
+        if offset >= len(view):
+            raise ValueError("Truncated msgpack message.")
+        tag = view[offset]
+        offset += 1
+        if tag < 0x80:
+            return tag, offset
+        if tag >= 0xe0:
+            return tag - 0x100, offset
+        if 0xa0 <= tag <= 0xbf:
+            data, offset = self._take(view, offset, tag & 0x1f)
+            return str(data, 'utf-8'), offset
+        if 0x90 <= tag <= 0x9f:
+            return self._unpack_array(view, offset, tag & 0x0f, depth)
+        if 0x80 <= tag <= 0x8f:
+            return self._unpack_map(view, offset, tag & 0x0f, depth)
+        if tag == 0xc0:
+            return None, offset
+        if tag in (0xc2, 0xc3):
+            return tag == 0xc3, offset
+        fixed = _MSGPACK_FIXED.get(tag)
+        if fixed is not None:
+            data, offset = self._take(view, offset, fixed.size)
+            return fixed.unpack(data)[0], offset
+        sized = _MSGPACK_SIZED.get(tag)
+        if sized is None:
+            raise ValueError(f"Unsupported msgpack type 0x{tag:02x}.")
+        kind, header = sized
+        data, offset = self._take(view, offset, header.size)
+        size = header.unpack(data)[0]
+        if kind == "array":
+            return self._unpack_array(view, offset, size, depth)
+        if kind == "map":
+            return self._unpack_map(view, offset, size, depth)
+        data, offset = self._take(view, offset, size)
+        return (str(data, 'utf-8') if kind == "str" else bytes(data)), offset
 
-            # If the client closed the connection.
-            if not input_data:
-                break
+    def _unpack_array(self, view, offset, size, depth):
+        items = []
+        for _ in range(size):
+            item, offset = self._unpack(view, offset, depth + 1)
+            items.append(item)
+        return items, offset
 
-            current_time = datetime.now()
-            # Check timeouts after data arrives.
-            if current_time - session_start_time > SESSION_TIMEOUT:
-                try:
-                    client_socket.sendall(
-                        json.dumps({"error": "Session timed out."}).encode('utf-8')
-                    )
-                    client_socket.shutdown(socket.SHUT_WR)
-                    time.sleep(0.1)
-                except Exception as exc:
-                    log_message(f"Error sending session timeout message: {exc}", "ERROR")
-                log_message(f"Session for {client_address} timed out after receiving data.", "WARNING")
-                break
+    def _unpack_map(self, view, offset, size, depth):
+        result = {}
+        for _ in range(size):
+            key, offset = self._unpack(view, offset, depth + 1)
+            value, offset = self._unpack(view, offset, depth + 1)
+            try:
+                result[key] = value
+            except TypeError:
+                raise ValueError("Unhashable msgpack map key.")
+        return result, offset
 
-            if current_time - last_activity_time > SESSION_TIMEOUT:
-                try:
-                    client_socket.sendall(
-                        json.dumps({"error": "Idle timeout reached."}).encode('utf-8')
-                    )
-                    client_socket.shutdown(socket.SHUT_WR)
-                    time.sleep(0.1)
-                except Exception as exc:
-                    log_message(f"Error sending idle timeout message: {exc}", "ERROR")
-                log_message(f"Session for {client_address} idle too long after receiving data.", "WARNING")
-                break
+_MSGPACK_FIXED = {
+    0xca: struct.Struct("!f"), 0xcb: struct.Struct("!d"),
+    0xcc: struct.Struct("!B"), 0xcd: struct.Struct("!H"), 0xce: struct.Struct("!I"), 0xcf: struct.Struct("!Q"),
+    0xd0: struct.Struct("!b"), 0xd1: struct.Struct("!h"), 0xd2: struct.Struct("!i"), 0xd3: struct.Struct("!q"),
+}
+_MSGPACK_SIZED = {
+    0xc4: ("bin", struct.Struct("!B")), 0xc5: ("bin", struct.Struct("!H")), 0xc6: ("bin", struct.Struct("!I")),
+    0xd9: ("str", struct.Struct("!B")), 0xda: ("str", struct.Struct("!H")), 0xdb: ("str", struct.Struct("!I")),
+    0xdc: ("array", struct.Struct("!H")), 0xdd: ("array", struct.Struct("!I")),
+    0xde: ("map", struct.Struct("!H")), 0xdf: ("map", struct.Struct("!I")),
+}
+_MSGPACK_UINTS = ((1 << 8, 0xcc, 1), (1 << 16, 0xcd, 2), (1 << 32, 0xce, 4), (1 << 64, 0xcf, 8))
+_MSGPACK_INTS = ((-(1 << 7), 0xd0, 1), (-(1 << 15), 0xd1, 2), (-(1 << 31), 0xd2, 4), (-(1 << 63), 0xd3, 8))
+CODECS = {CODEC_JSON: JsonCodec(), CODEC_MSGPACK: MsgpackCodec()}
 
-            last_activity_time = current_time
+class ZlibCompressor:
+    """Default frame compressor. Compressors provide name, compress(data) and decompress(data, max_size)."""
+    name = "zlib"
 
-            try:
-                data = json.loads(input_data)
-            except json.JSONDecodeError:
-                client_socket.sendall(
-                    json.dumps({"error": "Invalid JSON format."}).encode('utf-8')
-                )
-                continue
+    def __init__(self, level=ZLIB_LEVEL):
+        self.level = level
 
-            recv_id = data.get('id')
-            recv_token = data.get('token')
-            command = data.get('command')
+    def compress(self, data):
+        return zlib.compress(data, self.level)
 
-            if not recv_id or not recv_token or not command:
-                client_socket.sendall(
-                    json.dumps({"error": "Missing required fields ('id', 'token', 'command')."}).encode('utf-8')
-                )
-                continue
+    def decompress(self, data, max_size):
+        """Inflate data, refusing output beyond max_size; raises ValueError."""
+        inflater = zlib.decompressobj()
+        try:
+            output = inflater.decompress(data, max_size)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if inflater.unconsumed_tail or not inflater.eof:
+            raise ValueError(f"Compressed frame is truncated or inflates beyond {max_size} bytes.")
+        return output
 
-            if recv_id != identifier or recv_token != token:
-                log_message(f"Invalid credentials from {client_address}: {recv_id}, {recv_token}", "WARNING")
-                client_socket.sendall(
-                    json.dumps({"error": "Invalid credentials."}).encode('utf-8')
-                )
-                break
+COMPRESSORS = {ZlibCompressor.name: ZlibCompressor}
 
-            # Shutdown command
-            if command.lower() == "shutdown":
-                log_message(f"Shutdown command received from {client_address}", "INFO")
-                client_socket.sendall(
-                    json.dumps({"message": "Server is shutting down."}).encode('utf-8')
-                )
-                SHUTDOWN_EVENT.set()
-                break
+def register_compressor(name, factory):
+    """Make a compressor negotiable by name; factory() returns a ZlibCompressor-like object."""
+    COMPRESSORS[name] = factory
 
-            # Change directory command.
-            if command.lower().startswith("cd "):
-                try:
-                    directory = command[3:].strip()
-                    os.chdir(directory)
-                    new_dir = os.getcwd()
-                    response = {"output": f"Changed directory to {new_dir}"}
-                    log_message(f"Changed directory to {new_dir} for {client_address}", "INFO")
-                except Exception as e:
-                    response = {"output": f"Failed to change directory: {e}"}
-                    log_message(f"Failed to change directory for {client_address}: {e}", "ERROR")
-                client_socket.sendall(json.dumps(response).encode('utf-8'))
-                continue
+class FramingError(Exception):
+    """Raised when a peer sends a frame that violates the wire protocol."""
 
-            # Exit command – send a goodbye message before closing.
-            if command.lower() == "exit":
-                log_message(f"Client {client_address} disconnected.", "INFO")
-                client_socket.sendall(
-                    json.dumps({"message": "Goodbye"}).encode('utf-8')
-                )
-                time.sleep(0.1)
-                break
+class MessageStream:
+    """Buffered message reader/writer wrapping a single client socket."""
 
-            # 'hows alive' command.
-            if command.lower() == "hows alive":
-                uptime = datetime.now() - SERVER_START_TIME
-                response = {"uptime": str(uptime).split('.')[0]}
-                client_socket.sendall(json.dumps(response).encode('utf-8'))
-                continue
+    def __init__(self, sock):
+        self.sock = sock
+        self.framing = FRAMING_LEGACY
+        self.codec = CODECS[CODEC_JSON]
+        self.compressor = None
+        self.channels = False
+        self.compression_stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self._buffer = bytearray()
+        # Approved commands reply from another thread, so whole messages are sent under a lock.
+        self._send_lock = threading.Lock()
 
-            # Arbitrary Code Execution: 'run' command uses the code field.
-            if command.lower() == "run":
-                if 'code' not in data or not data.get('code'):
-                    client_socket.sendall(json.dumps({"error": "Missing code for execution."}).encode('utf-8'))
-                    continue
-                code_to_run = data.get('code')
-                log_message(f"Executing arbitrary code from {recv_id} at {client_address}.", "DEBUG")
-                try:
-                    stdout_capture = io.StringIO()
-                    with contextlib.redirect_stdout(stdout_capture):
-                        exec(code_to_run, {})
-                    code_output = stdout_capture.getvalue()
-                except Exception as e:
-                    code_output = str(e)
-                    log_message(f"Error executing arbitrary code: {e}", "ERROR")
-                response = {"output": code_output}
-                client_socket.sendall(json.dumps(response).encode('utf-8'))
-                continue
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
 
-            # For other commands, check if it is dangerous.
-            if is_dangerous_command(command):
-                log_message(f"Dangerous command detected from {recv_id} at {client_address}: {command}", "WARNING")
-                admin_approval = ADMIN_APPROVAL_FUNC(f"Approve dangerous command from {recv_id} @ {client_address}: {command}\nApprove? (Y/N): ")
-                if admin_approval.strip().lower() != 'y':
-                    client_socket.sendall(json.dumps({"error": "Dangerous command execution denied by admin."}).encode('utf-8'))
-                    log_message("Dangerous command execution denied by admin.", "WARNING")
-                    continue
-                else:
-                    log_message("Admin approved dangerous command execution.", "INFO")
+    def _accept_handshake(self, chunk):
+        """Parse the first JSON document in chunk and buffer any pipelined bytes after it."""
+        if not chunk:
+            return None
+        # surrogateescape keeps any binary frame headers after the JSON intact.
+        text = chunk.decode('utf-8', errors='surrogateescape')
+        stripped = text.lstrip()
+        data, end = json.JSONDecoder().raw_decode(stripped)
+        if not isinstance(data, dict):
+            raise json.JSONDecodeError("Handshake must be a JSON object", stripped, 0)
+        self._buffer += stripped[end:].lstrip(' \t\r\n').encode('utf-8', errors='surrogateescape')
+        return data
 
-            log_message(f"Received command: {command} from {recv_id}", "INFO")
+    def _pop_buffered(self):
+        """Return the next complete message held in the buffer, or None if more bytes are needed."""
+        if self.framing == FRAMING_LEGACY:
+            if not self._buffer:
+                return None
+            pending = bytes(self._buffer)
+            self._buffer.clear()
+            return pending.decode('utf-8').strip()
+        if len(self._buffer) < FRAME_HEADER.size:
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self._buffer)
+        compressed = length & FRAME_COMPRESSED
+        length &= ~FRAME_COMPRESSED
+        if length > MAX_FRAME_SIZE:
+            raise FramingError(f"Frame of {length} bytes exceeds limit of {MAX_FRAME_SIZE}.")
+        end = FRAME_HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+        payload = bytes(self._buffer[FRAME_HEADER.size:end])
+        del self._buffer[:end]
+        if compressed:
+            if self.compressor is None:
+                raise FramingError("Compressed frame on a session without compression.")
             try:
-                output = subprocess.check_output(
-                    command, shell=True, stderr=subprocess.STDOUT, text=True
-                )
-            except subprocess.CalledProcessError as e:
-                output = e.output
-                log_message(f"Command execution error: {output}", "ERROR")
-
-            response = {"output": output}
-            client_socket.sendall(json.dumps(response).encode('utf-8'))
-    except Exception as e:
-        log_message(f"Error handling client {client_address}: {e}", "ERROR")
+                payload = self.compressor.decompress(payload, MAX_FRAME_SIZE)
+            except ValueError as e:
+                raise FramingError(f"Bad compressed frame: {e}")
+        if self.codec.name != CODEC_JSON:
+            return payload
         try:
-            client_socket.sendall(
-                json.dumps({"error": "Server error while handling command."}).encode('utf-8')
-            )
-        except Exception:
-            pass
-    finally:
-        client_socket.close()
-        log_message(f"Closed connection with {client_address}", "INFO")
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            raise FramingError("Frame payload is not valid UTF-8.")
 
-def worker():
-    """Thread worker to manage client requests in the queue."""
-    while True:
-        client_socket, client_address = task_queue.get()
-        try:
-            handle_client(client_socket, client_address)
-        finally:
-            task_queue.task_done()
+    def decode(self, message):
+        """Parse a message returned by read_message with the session codec; raises ValueError."""
+        return self.codec.decode(message)
 
-def clean_exit(server_socket, ngrok_process):
-    """Clean up resources and stop network activities."""
-    log_message("Cleaning up resources...", "INFO")
-    if ngrok_process:
-        try:
-            if os.name == 'nt':
-                ngrok_process.send_signal(signal.CTRL_BREAK_EVENT)
-            else:
-                os.killpg(os.getpgid(ngrok_process.pid), signal.SIGTERM)
-            ngrok_process.wait(timeout=5)  # Wait for process to terminate
-            log_message("Ngrok process terminated.", "INFO")
-        except subprocess.TimeoutExpired:
-            log_message("Ngrok process did not terminate. Attempting force kill...", "WARNING")
-            try:
-                ngrok_process.kill()
-            except Exception as kill_exception:
-                log_message(f"Failed to kill ngrok process: {kill_exception}", "ERROR")
-    if server_socket:
-        server_socket.close()
-        log_message("Server socket closed.", "INFO")
+    def _encode(self, payload):
+        body = self.codec.encode(payload)
+        if self.framing == FRAMING_LENGTH:
+            if self.compressor is not None and len(body) > COMPRESSION_THRESHOLD:
+                return self._compress(body)
+            return FRAME_HEADER.pack(len(body)) + body
+        return body
 
-def start_server():
-    """Launch the server and initialize the thread pool for client handling."""
-    log_message(f"Starting server on {HOST}:{PORT}...", "INFO")
-    ngrok_process = None
-    server_socket = None
+    def _compress(self, body):
+        """Frame body compressed when that saves bytes, recording size and CPU time per session."""
+        started = time.thread_time()
+        packed = self.compressor.compress(body)
+        cpu = time.thread_time() - started
+        smaller = len(packed) < len(body)
+        with self._stats_lock:
+            stats = self.compression_stats
+            stats["frames"] += 1
+            stats["compressed_frames"] += smaller
+            stats["raw_bytes"] += len(body)
+            stats["sent_bytes"] += len(packed) if smaller else len(body)
+            stats["cpu_seconds"] += cpu
+        METRICS.inc("compression_bytes_saved_total", self.compressor.name, max(len(body) - len(packed), 0))
+        if smaller:
+            return FRAME_HEADER.pack(len(packed) | FRAME_COMPRESSED) + packed
+        return FRAME_HEADER.pack(len(body)) + body
 
-    try:
-        ngrok_process = start_ngrok()  # Ensure ngrok is running
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((HOST, PORT))
-        server_socket.listen(5)
-        server_socket.settimeout(1.0)  # Timeout chosen for responsiveness to interrupts
-        log_message("Server is listening for connections...", "INFO")
+    def compression_report(self):
+        """Per-session compression totals: bytes saved against CPU time spent compressing."""
+        with self._stats_lock:
+            stats = dict(self.compression_stats)
+        return {
+            "algorithm": self.compressor.name,
+            "frames": stats.get("frames", 0),
+            "compressed_frames": stats.get("compressed_frames", 0),
+            "raw_bytes": stats.get("raw_bytes", 0),
+            "sent_bytes": stats.get("sent_bytes", 0),
+            "bytes_saved": stats.get("raw_bytes", 0) - stats.get("sent_bytes", 0),
+            "cpu_seconds": round(stats.get("cpu_seconds", 0.0), 6),
+        }
 
-        # Create and start thread pool
-        for _ in range(MAX_THREADS):
-            thread = threading.Thread(target=worker, daemon=True)
-            thread_pool.append(thread)
-            thread.start()
+    def read_handshake(self):
+        """Read the first JSON document and keep any pipelined bytes that follow it."""
+        return self._accept_handshake(self.sock.recv(4096))
 
-        while not SHUTDOWN_EVENT.is_set():
-            try:
+    def read_message(self):
+        """Return the next message as text, '' when the peer has closed, or raise socket.timeout."""
+        while True:
+            message = self._pop_buffered()
+            if message is not None:
+                return message
+            if self.framing == FRAMING_LEGACY:
+                return self.sock.recv(4096).decode('utf-8').strip()
+            chunk = self.sock.recv(RECV_CHUNK_SIZE)
+            if not chunk:
+                return ''
+            self._buffer += chunk
+
+    def send_message(self, payload):
+        """Encode payload with the session codec and send it using the negotiated framing."""
+        data = self._encode(payload)
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def send_file(self, header, file, offset, count):
+        """Send header, then count raw bytes of file from offset with sendfile, as one unit."""
+        data = self._encode(header)
+        with self._send_lock:
+            self.sock.sendall(data)
+            if count and self.sock.sendfile(file, offset, count) != count:
+                raise ConnectionError("File shrank while it was being sent.")
+
+    def _take_buffered(self, limit):
+        """Remove and return up to limit bytes already read past the last message."""
+        chunk = bytes(self._buffer[:limit])
+        del self._buffer[:limit]
+        return chunk
+
+    def read_raw(self, count):
+        """Yield exactly count raw bytes from the peer in chunks; raises ConnectionError on EOF."""
+        remaining = count
+        if self._buffer:
+            chunk = self._take_buffered(remaining)
+            remaining -= len(chunk)
+            yield chunk
+        while remaining:
+            chunk = self.sock.recv(min(remaining, FILE_CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError("Connection closed during upload.")
+            remaining -= len(chunk)
+            yield chunk
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+class AsyncMessageStream(MessageStream):
+    """MessageStream over asyncio streams; send_message stays callable from executor threads."""
+
+    def __init__(self, reader, writer, loop):
+        super().__init__(writer.get_extra_info('socket'))
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        # Keeps a file header and its raw bytes together when other senders are active.
+        self._write_lock = asyncio.Lock()
+
+    def settimeout(self, timeout):
+        pass
+
+    async def receive_handshake(self):
+        return self._accept_handshake(await self.reader.read(4096))
+
+    async def receive_message(self):
+        """Coroutine counterpart of read_message; safe to cancel between reads."""
+        while True:
+            message = self._pop_buffered()
+            if message is not None:
+                return message
+            if self.framing == FRAMING_LEGACY:
+                return (await self.reader.read(4096)).decode('utf-8').strip()
+            chunk = await self.reader.read(RECV_CHUNK_SIZE)
+            if not chunk:
+                return ''
+            self._buffer += chunk
+
+    async def send_message_async(self, payload):
+        async with self._write_lock:
+            self.writer.write(self._encode(payload))
+            await self.writer.drain()
+
+    async def _send_file_async(self, header, file, offset, count):
+        async with self._write_lock:
+            self.writer.write(self._encode(header))
+            await self.writer.drain()
+            if count and await self.loop.sendfile(self.writer.transport, file, offset, count) != count:
+                raise ConnectionError("File shrank while it was being sent.")
+
+    def send_file(self, header, file, offset, count):
+        asyncio.run_coroutine_threadsafe(self._send_file_async(header, file, offset, count), self.loop).result()
+
+    def read_raw(self, count):
+        # The engine pauses reading while a request runs; an upload needs the bytes behind it.
+        self.loop.call_soon_threadsafe(self.writer.transport.resume_reading)
+        remaining = count
+        if self._buffer:
+            chunk = self._take_buffered(remaining)
+            remaining -= len(chunk)
+            yield chunk
+        while remaining:
+            chunk = asyncio.run_coroutine_threadsafe(
+                self.reader.read(min(remaining, FILE_CHUNK_SIZE)), self.loop
+            ).result()
+            if not chunk:
+                raise ConnectionError("Connection closed during upload.")
+            remaining -= len(chunk)
+            yield chunk
+
+    def send_message(self, payload):
+        # Called from executor threads: hand the write to the loop and wait for drain (backpressure).
+        asyncio.run_coroutine_threadsafe(self.send_message_async(payload), self.loop).result()
+
+    def shutdown(self, how):
+        if self.writer.can_write_eof():
+            self.loop.call_soon_threadsafe(self.writer.write_eof)
+
+    def close(self):
+        self.writer.close()
+
+def validate_client(stream, client_address):
+    """Ensure client provides a valid identifier and token; return the new Session or None."""
+    try:
+        try:
+            data = stream.read_handshake()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            stream.send_message({"error": "Invalid JSON format."})
+            return None
+        if data is None:
+            return None
+        return authenticate_client(stream, data, client_address)
+
+    except Exception as e:
+        # Handle unexpected validation errors.
+        log_message(f"Error during client validation: {e}", "ERROR")
+        stream.send_message({"error": "Server error during validation."})
+        return None
+
+def authenticate_client(stream, data, client_address):
+    """Check a parsed handshake, negotiate session options and reply with the session token."""
+    started = time.perf_counter()
+    if PROFILER.active:
+        session = PROFILER.run("auth", negotiate_session, stream, data, client_address)
+    else:
+        session = negotiate_session(stream, data, client_address)
+    METRICS.observe("request_seconds", "auth", time.perf_counter() - started)
+    METRICS.inc("auth_total", "accepted" if session is not None else "rejected")
+    return session
+
+def session_options(stream):
+    """Negotiated wire options echoed back to framed clients in the handshake reply."""
+    options = {"framing": stream.framing, "codec": stream.codec.name}
+    if stream.compressor is not None:
+        options["compression"] = stream.compressor.name
+    if stream.channels:
+        options["channels"] = True
+    return options
+
+def negotiate_session(stream, data, client_address):
+    """Validate credentials and options from the handshake; return a Session or None."""
+    framing = data.get('framing', FRAMING_LEGACY)
+    if framing not in (FRAMING_LEGACY, FRAMING_LENGTH):
+        stream.send_message({"error": f"Unsupported framing '{framing}'."})
+        return None
+    codec = data.get('codec', CODEC_JSON)
+    if codec not in CODECS:
+        stream.send_message({"error": f"Unsupported codec '{codec}'."})
+        return None
+    if codec != CODEC_JSON and framing == FRAMING_LEGACY:
+        stream.send_message({"error": "Binary codecs require length-prefixed framing."})
+        return None
+    compression = data.get('compression')
+    if compression is not None:
+        if compression not in COMPRESSORS:
+            stream.send_message({"error": f"Unsupported compression '{compression}'."})
+            return None
+        if framing == FRAMING_LEGACY:
+            stream.send_message({"error": "Compression requires length-prefixed framing."})
+            return None
+    channels = bool(data.get('channels'))
+    if channels and framing == FRAMING_LEGACY:
+        stream.send_message({"error": "Channels require length-prefixed framing."})
+        return None
+    stream.framing = framing
+    stream.codec = CODECS[codec]
+    if compression is not None:
+        stream.compressor = COMPRESSORS[compression]()
+    stream.channels = channels
+
+    persistent_shell = bool(data.get('persistent_shell'))
+    if persistent_shell and os.name == 'nt':
+        stream.send_message({"error": "Persistent shells are not supported on this platform."})
+        return None
+
+    identifier = data.get('id')
+    token = data.get('token')
+
+    if not identifier or not token:
+        stream.send_message({"error": "Missing 'id' or 'token' fields."})
+        return None
+
+    if identifier not in VALID_IDENTIFIERS:
+        # Only pre-approved identifiers are allowed for connections.
+        log_message(f"Invalid identifier: {identifier}", "WARNING")
+        stream.send_message({"error": "Invalid identifier."})
+        return None
+
+    log_message("Received identifier: %s, token: %s", "INFO", identifier, token)
+
+    if AUTHORIZED_TOKENS.validate(token, identifier):
+        # Reuse previously authorized tokens.
+        log_message("Token '%s' already authorized.", "DEBUG", token)
+        # Framed clients may pipeline, so they always get an explicit acknowledgement.
+        reply = dict(session_options(stream), token=token) if stream.framing != FRAMING_LEGACY else None
+        return open_session(stream, reply, identifier, token, client_address, persistent_shell)
+
+    log_message(f"Token '{token}' not recognized. Generating new token.", "INFO")
+    new_token = generate_token(identifier)
+    response = {"new_token": new_token}
+    if stream.framing != FRAMING_LEGACY:
+        response.update(session_options(stream))
+    return open_session(stream, response, identifier, new_token, client_address, persistent_shell)
+
+def open_session(stream, reply, identifier, token, client_address, persistent_shell):
+    """Create the Session before replying, so a client that saw its token is already counted."""
+    session = Session(stream, identifier, token, client_address, persistent_shell)
+    if reply is not None:
+        try:
+            stream.send_message(reply)
+        except Exception:
+            session.close()
+            raise
+    return session
+
+class TimeoutScheduler:
+    """One thread firing callbacks at monotonic deadlines kept in a heap, shared by all sessions."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, deadline, callback):
+        """Run callback on the scheduler thread at deadline; return an entry usable with cancel()."""
+        entry = [deadline, next(self._counter), callback]
+        with self._condition:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="aegis-timeouts", daemon=True)
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        # Lazy deletion: the entry stays in the heap but does nothing when it comes due.
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                callback = heapq.heappop(self._heap)[2]
+            if callback is not None:
+                try:
+                    callback()
+                except Exception as e:
+                    log_message(f"Timeout callback failed: {e}", "ERROR")
+
+SESSION_TIMEOUTS = TimeoutScheduler()
+COMMAND_DEADLINES = TimeoutScheduler()
+
+def command_limits_prefix():
+    """Shell text that applies the COMMAND_* rlimits before anything else runs in the shell.
+
+    Setting them from the server after the spawn races with the shell's first fork, and a
+    preexec_fn is unsafe in a threaded server, so the shell sets them on itself instead.
+    Values are capped at the server's hard limits, which the shell could not raise.
+    """
+    if resource is None:
+        return ""
+    commands = []
+    for limit, value, template in ((resource.RLIMIT_CPU, COMMAND_CPU_LIMIT, "ulimit -t {}"),
+                                   (resource.RLIMIT_AS, COMMAND_MEMORY_LIMIT // 1024, "ulimit -v {}"),
+                                   # dash spells the process limit -p; in bash -p is the pipe size.
+                                   (resource.RLIMIT_NPROC, COMMAND_NPROC_LIMIT, "ulimit -u {0} 2>/dev/null || ulimit -p {0}")):
+        if value > 0:
+            hard = resource.getrlimit(limit)[1]
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard // 1024 if limit == resource.RLIMIT_AS else hard)
+            commands.append(template.format(value))
+    return "".join(command + "; " for command in commands)
+
+def start_command(args, **popen_args):
+    """Start a command as its own process group, under the COMMAND_* rlimits.
+
+    stdin defaults to /dev/null: the server's own stdin belongs to the admin console.
+    """
+    popen_args.setdefault("stdin", subprocess.DEVNULL)
+    prefix = command_limits_prefix()
+    if prefix and popen_args.get("shell"):
+        args = prefix + args
+    elif prefix:
+        args = ["/bin/sh", "-c", prefix + 'exec "$@"', "sh", *args]
+    return subprocess.Popen(args, start_new_session=True, **popen_args)
+
+def kill_process_group(process, signum=signal.SIGKILL):
+    """Signal the process group that process leads, so pipeline children go too.
+
+    Nothing is sent once the leader has been reaped, as its pid and group id may then
+    belong to another process. No poll() here: reaping a leader whose children still
+    run would skip the very kill meant for them.
+    """
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def command_timeout(data):
+    """The request's "timeout" in seconds, defaulting to COMMAND_TIMEOUT; raise ValueError if invalid."""
+    timeout = data.get('timeout')
+    if timeout is None:
+        return COMMAND_TIMEOUT
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 < timeout <= COMMAND_MAX_TIMEOUT:
+        raise ValueError(f"'timeout' must be a number of seconds between 0 and {COMMAND_MAX_TIMEOUT}.")
+    return timeout
+
+class CommandDeadline:
+    """Stops a command's process group when its timeout passes: SIGTERM, then SIGKILL after a grace period."""
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timed_out = False
+        self._entry = COMMAND_DEADLINES.schedule(time.monotonic() + timeout, self._expire)
+        # Commands started for a channel can be stopped by cancelling that channel.
+        self._channel = CURRENT_CHANNEL.get()
+        if self._channel is not None:
+            self._channel.deadlines.add(self)
+
+    def _expire(self):
+        self.timed_out = True
+        METRICS.inc("commands_timed_out")
+        self.stop()
+
+    def stop(self):
+        """Terminate the process group now, escalating to SIGKILL after COMMAND_KILL_GRACE."""
+        COMMAND_DEADLINES.cancel(self._entry)
+        kill_process_group(self.process, signal.SIGTERM)
+        # SIGKILL the group even if the leader obeyed, so background children cannot linger.
+        COMMAND_DEADLINES.schedule(time.monotonic() + COMMAND_KILL_GRACE, lambda: kill_process_group(self.process))
+
+    def cancel(self):
+        """Disarm the deadline once the command has finished."""
+        COMMAND_DEADLINES.cancel(self._entry)
+        if self._channel is not None:
+            self._channel.deadlines.discard(self)
+
+class PersistentShell:
+    """Long-lived shell for one session; each command's end is marked by a random sentinel."""
+
+    def __init__(self, cwd):
+        self.process = start_command(
+            [PERSISTENT_SHELL],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=cwd
+        )
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, command):
+        """Run command in the shell; return (output, exit_status, cwd), cwd None if the shell exited."""
+        sentinel = f"__AEGIS_{secrets.token_hex(8)}__"
+        # 'command eval' keeps syntax errors from killing the shell; stdin is detached so
+        # the command cannot swallow the sentinel line.
+        script = (
+            f"command eval {shlex.quote(command)} < /dev/null\n"
+            f"printf '\\n%s %d %s\\n' {sentinel} \"$?\" \"$PWD\"\n"
+        )
+        marker = f"\n{sentinel} ".encode('utf-8')
+        buffer = bytearray()
+        try:
+            self.process.stdin.write(script.encode('utf-8'))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return "", self.process.wait(), None
+        while True:
+            index = buffer.find(marker)
+            if index != -1:
+                end = buffer.find(b"\n", index + len(marker))
+                if end != -1:
+                    break
+            chunk = os.read(self.process.stdout.fileno(), RECV_CHUNK_SIZE)
+            if not chunk:
+                # The command exited the shell itself (e.g. 'exit').
+                return buffer.decode('utf-8', errors='surrogateescape'), self.process.wait(), None
+            buffer += chunk
+        output = buffer[:index].decode('utf-8', errors='surrogateescape')
+        status, _, cwd = buffer[index + len(marker):end].decode('utf-8', errors='replace').partition(' ')
+        return output, int(status), cwd
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        kill_process_group(self.process, signal.SIGTERM)
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            kill_process_group(self.process)
+            self.process.wait()
+
+class Session:
+    """State for one authenticated connection: credentials, working directory and shell."""
+
+    def __init__(self, stream, identifier, token, client_address, persistent_shell=False):
+        self.session_id = secrets.token_hex(4)
+        self.stream = stream
+        self.identifier = identifier
+        self.token = token
+        self.client_address = client_address
+        self.cwd = os.getcwd()
+        self.persistent_shell = persistent_shell
+        self.shell = None
+        self._shell_lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_activity = self.started
+        self.expired = None
+        self._timeout_entry = None
+        self._on_expire = None
+        self.channels = ChannelMux(self) if stream.channels else None
+        METRICS.add("active_sessions", 1)
+
+    @property
+    def owner(self):
+        """The connection's Session; channel views forward this to the session they belong to."""
+        return self
+
+    def touch(self):
+        """Record client activity; the idle deadline moves without touching the scheduler."""
+        self.last_activity = time.monotonic()
+
+    def deadline(self):
+        """Monotonic time at which the session or idle timeout next expires."""
+        return min(self.started, self.last_activity) + SESSION_TIMEOUT.total_seconds()
+
+    def expiry(self, now=None):
+        """Return the timeout error for this session, or None while it is still live."""
+        now = time.monotonic() if now is None else now
+        limit = SESSION_TIMEOUT.total_seconds()
+        if now - self.started > limit:
+            return "Session timed out."
+        if now - self.last_activity > limit:
+            return "Idle timeout reached."
+        return None
+
+    def watch(self, on_expire):
+        """Register with SESSION_TIMEOUTS; on_expire(reason) runs on the scheduler thread."""
+        self._on_expire = on_expire
+        self._timeout_entry = SESSION_TIMEOUTS.schedule(self.deadline(), self._check_timeout)
+
+    def _check_timeout(self):
+        # Deadlines are rescheduled lazily: activity only updates last_activity, and an
+        # early wake-up simply re-arms for the current deadline.
+        expiry = self.expiry()
+        if expiry is None:
+            self._timeout_entry = SESSION_TIMEOUTS.schedule(self.deadline(), self._check_timeout)
+            return
+        self.expired = expiry
+        try:
+            self._on_expire(expiry)
+        except OSError:
+            pass
+
+    def change_directory(self, directory):
+        """Change this session's working directory without touching the server process."""
+        if self.persistent_shell:
+            # Quote the path: anything after it would otherwise run in the shell unchecked.
+            output, exit_status, _ = self.run_in_shell(f"cd -- {shlex.quote(os.path.expanduser(directory))}")
+            if exit_status != 0:
+                raise OSError(output.strip() or f"cd exited with status {exit_status}")
+            return self.cwd
+        target = os.path.normpath(os.path.join(self.cwd, os.path.expanduser(directory)))
+        if not os.path.isdir(target):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), directory)
+        self.cwd = target
+        return target
+
+    def run_in_shell(self, command, timeout=None):
+        """Run command in the session's persistent shell, starting or restarting it as needed.
+
+        Returns (output, exit_status, timed_out). A timeout kills the whole shell,
+        which is started afresh in the last known directory by the next command.
+        """
+        with self._shell_lock:
+            if self.shell is None or not self.shell.alive():
+                self.shell = PersistentShell(self.cwd)
+            deadline = CommandDeadline(self.shell.process, timeout or COMMAND_TIMEOUT)
+            try:
+                output, exit_status, cwd = self.shell.run(command)
+            finally:
+                deadline.cancel()
+            if cwd is None:
+                self.shell = None
+            else:
+                self.cwd = cwd
+            return output, exit_status, deadline.timed_out
+
+    def close(self):
+        """Release per-session resources such as the persistent shell."""
+        if self._timeout_entry is not None:
+            SESSION_TIMEOUTS.cancel(self._timeout_entry)
+        if self.channels is not None:
+            self.channels.close()
+        APPROVALS.cancel_session(self)
+        KERNELS.release(self)
+        METRICS.add("active_sessions", -1)
+        with self._shell_lock:
+            if self.shell is not None:
+                self.shell.close()
+                self.shell = None
+
+# Source of a pooled interpreter. It runs as "python -c" rather than importing
+# this module so that workers do not repeat the server's configuration loading.
+# Jobs arrive as JSON lines on stdin; replies leave on a private copy of fd 1,
+# while fd 1 itself is pointed at /dev/null so stray writes cannot corrupt them.
+_INTERPRETER_WORKER_SOURCE = r"""
+import contextlib, gc, io, json, os, sys
+config = json.loads(sys.argv[1])
+channel = os.fdopen(os.dup(1), "w", encoding="utf-8")
+os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+for name in config["preload"]:
+    try:
+        __import__(name)
+    except Exception as exc:
+        sys.stderr.write(f"Failed to preload module {name}: {exc}\n")
+if config["memory_limit"]:
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (config["memory_limit"], config["memory_limit"]))
+    except (ImportError, ValueError, OSError):
+        pass
+def resident_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+namespace = {"__name__": "__main__"}
+for line in sys.stdin:
+    job = json.loads(line)
+    capture = io.StringIO()
+    error = None
+    recycle = False
+    if job.get("reset"):
+        namespace = {"__name__": "__main__"}
+        gc.collect()
+        output = ""
+    else:
+        try:
+            os.chdir(job["cwd"])
+            with contextlib.redirect_stdout(capture):
+                exec(job["code"], namespace if config["persistent"] else {})
+            output = capture.getvalue()
+        except MemoryError:
+            output = error = "Memory limit exceeded."
+            recycle = True
+        except BaseException as exc:
+            output = error = str(exc)
+    reply = {"output": output, "error": error, "recycle": recycle}
+    if config["persistent"]:
+        reply["memory"] = resident_bytes()
+    channel.write(json.dumps(reply) + "\n")
+    channel.flush()
+"""
+
+class InterpreterWorker:
+    """One warm interpreter process from the run pool."""
+
+    def __init__(self, preload, memory_limit, persistent=False):
+        config = json.dumps({"preload": preload, "memory_limit": memory_limit, "persistent": persistent})
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", _INTERPRETER_WORKER_SOURCE, config],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding='utf-8',
+            start_new_session=(os.name != 'nt')
+        )
+        self.replies = Queue()
+        threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def _read_replies(self):
+        for line in self.process.stdout:
+            self.replies.put(json.loads(line))
+        self.replies.put(None)
+
+    def execute(self, code, cwd, timeout, reset=False):
+        """Run code (or clear a persistent namespace); raise TimeoutError or RuntimeError if it must be recycled."""
+        job = {"code": code, "cwd": cwd}
+        if reset:
+            job["reset"] = True
+        self.process.stdin.write(json.dumps(job) + "\n")
+        self.process.stdin.flush()
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError(f"Execution timed out after {timeout} seconds.")
+        if reply is None:
+            raise RuntimeError("Interpreter worker exited unexpectedly.")
+        return reply
+
+    def close(self):
+        # Code run here may have started subprocesses of its own; they share the group.
+        if os.name == 'nt':
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        else:
+            kill_process_group(self.process)
+        self.process.wait()
+
+class InterpreterPool:
+    """Fixed-size pool of pre-started interpreters so concurrent "run" jobs use separate processes."""
+
+    def __init__(self, size, preload, timeout, memory_limit):
+        self.preload = list(preload)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.size = size
+        self.respawning = 0  # slots whose replacement has not started yet
+        self.closed = False
+        self._lock = threading.Lock()
+        self.idle = Queue()
+        for _ in range(size):
+            self.idle.put(self._spawn())
+
+    def _spawn(self):
+        return InterpreterWorker(self.preload, self.memory_limit)
+
+    def _replace(self, worker):
+        # Start the replacement off the request path so the next job finds it warm.
+        worker.close()
+        with self._lock:
+            self.respawning += 1
+        threading.Thread(target=self._respawn, daemon=True).start()
+
+    def _respawn(self):
+        """Refill one slot, retrying with backoff so a failed spawn does not lose the slot."""
+        delay = RUN_RESPAWN_BACKOFF
+        while not self.closed:
+            try:
+                worker = self._spawn()
+            except OSError as e:
+                log_message(f"Could not start a run interpreter, retrying in {delay:.1f}s: {e}", "ERROR")
+                time.sleep(delay)
+                delay = min(delay * 2, RUN_RESPAWN_MAX_BACKOFF)
+                continue
+            with self._lock:
+                self.respawning -= 1
+            self.idle.put(worker)
+            if self.closed:
+                self.close()
+            return
+
+    def _acquire(self):
+        """Return (worker, pooled): the next idle worker, or a one-shot one while every slot is respawning."""
+        while True:
+            try:
+                return self.idle.get(timeout=1.0), True
+            except Empty:
+                if self.respawning >= self.size:
+                    log_message("No run interpreter available while the pool respawns; using a one-shot one.", "WARNING")
+                    return self._spawn(), False
+
+    def execute(self, code, cwd):
+        """Run code on the next free worker and return (output, error)."""
+        try:
+            worker, pooled = self._acquire()
+        except OSError as e:
+            return str(e), str(e)
+        try:
+            reply = worker.execute(code, cwd, self.timeout)
+        except (TimeoutError, RuntimeError, OSError) as e:
+            if pooled:
+                self._replace(worker)
+            else:
+                worker.close()
+            return str(e), str(e)
+        if not pooled:
+            worker.close()
+        elif reply["recycle"]:
+            self._replace(worker)
+        else:
+            self.idle.put(worker)
+        return reply["output"], reply["error"]
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
+
+def get_interpreter_pool():
+    """Return the shared interpreter pool, starting it on first use."""
+    global RUN_POOL
+    with RUN_POOL_LOCK:
+        if RUN_POOL is None:
+            RUN_POOL = InterpreterPool(RUN_POOL_SIZE, RUN_PRELOAD_MODULES, RUN_TIMEOUT, RUN_MEMORY_LIMIT)
+        return RUN_POOL
+
+class Kernel:
+    """A token's persistent interpreter: an InterpreterWorker whose globals survive between runs."""
+
+    def __init__(self):
+        self.worker = None  # started by KernelRegistry._acquire outside the registry lock
+        self.lock = threading.Lock()  # one snippet at a time per namespace
+        self.sessions = set()
+        self.memory = 0
+        self.runs = 0
+        self.closed = False
+
+    def close_worker(self):
+        # A kernel closed while its process is still starting is closed again by its starter.
+        worker = self.worker
+        if worker is not None:
+            worker.close()
+
+class KernelRegistry:
+    """Kernels keyed by token, least recently used first, with memory accounting and eviction."""
+
+    def __init__(self, max_kernels, memory_budget):
+        self.max_kernels = max_kernels
+        self.memory_budget = memory_budget
+        self._kernels = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._kernels)
+
+    def memory(self):
+        """Resident bytes of all kernels as of their last run."""
+        with self._lock:
+            return sum(kernel.memory for kernel in self._kernels.values())
+
+    def _acquire(self, session):
+        """Return the kernel for the session's token with its lock held, starting one if needed."""
+        while True:
+            with self._lock:
+                kernel = self._kernels.get(session.token)
+                fresh = kernel is None
+                if fresh:
+                    # Reserve the slot, locked, and start the process below so that
+                    # other tokens' lookups do not wait behind the spawn.
+                    kernel = self._kernels[session.token] = Kernel()
+                    kernel.lock.acquire()
+                self._kernels.move_to_end(session.token)
+                kernel.sessions.add(session.owner)
+            if fresh:
+                try:
+                    kernel.worker = InterpreterWorker(RUN_PRELOAD_MODULES, RUN_MEMORY_LIMIT, persistent=True)
+                except OSError as e:
+                    kernel.lock.release()
+                    self._discard(session.token, kernel, f"could not start: {e}")
+                    raise
+                if kernel.closed:
+                    kernel.close_worker()
+            else:
+                kernel.lock.acquire()
+            if not kernel.closed:
+                return kernel
+            # Evicted between lookup and lock: start over with a fresh kernel.
+            kernel.lock.release()
+
+    def execute(self, session, code, reset=False):
+        """Run code in (or reset) the token's namespace; return (output, error, kernel info)."""
+        try:
+            kernel = self._acquire(session)
+        except OSError as e:
+            return str(e), str(e), {"memory": 0, "runs": 0, "discarded": True}
+        try:
+            try:
+                reply = kernel.worker.execute(code, session.cwd, RUN_TIMEOUT, reset)
+            except (TimeoutError, RuntimeError, OSError) as e:
+                self._discard(session.token, kernel, str(e))
+                return str(e), str(e), {"memory": 0, "runs": 0, "discarded": True}
+            if reply["recycle"]:
+                self._discard(session.token, kernel, reply["error"])
+                return reply["output"], reply["error"], {"memory": 0, "runs": 0, "discarded": True}
+            kernel.memory = reply["memory"]
+            kernel.runs = 0 if reset else kernel.runs + 1
+            info = {"memory": kernel.memory, "runs": kernel.runs}
+        finally:
+            kernel.lock.release()
+        self._enforce_limits()
+        return reply["output"], reply["error"], info
+
+    def _discard(self, token, kernel, reason):
+        with self._lock:
+            if self._kernels.get(token) is kernel:
+                del self._kernels[token]
+            kernel.closed = True
+        kernel.close_worker()
+        log_message(f"Kernel for token {token} discarded: {reason}", "WARNING")
+
+    def _enforce_limits(self):
+        """Evict idle kernels, least recently used first, while over the count or memory budget."""
+        victims = []
+        with self._lock:
+            total = sum(kernel.memory for kernel in self._kernels.values())
+            for token, kernel in list(self._kernels.items()):
+                if total <= self.memory_budget and len(self._kernels) <= self.max_kernels:
+                    break
+                if not kernel.lock.acquire(blocking=False):
+                    continue  # busy; its run will enforce the limits again when it finishes
+                del self._kernels[token]
+                kernel.closed = True
+                kernel.lock.release()
+                total -= kernel.memory
+                victims.append((token, kernel))
+        for token, kernel in victims:
+            kernel.close_worker()
+            log_message(f"Kernel for token {token} evicted ({kernel.memory} bytes resident).", "WARNING")
+
+    def release(self, session):
+        """Detach a closing session; a kernel with no sessions of its token left is shut down."""
+        with self._lock:
+            kernel = self._kernels.get(session.token)
+            if kernel is None:
+                return
+            kernel.sessions.discard(session)
+            if kernel.sessions:
+                return
+            del self._kernels[session.token]
+            kernel.closed = True
+        kernel.close_worker()
+
+    def close(self):
+        with self._lock:
+            kernels = list(self._kernels.values())
+            self._kernels.clear()
+        for kernel in kernels:
+            kernel.closed = True
+            kernel.close_worker()
+
+KERNELS = KernelRegistry(RUN_KERNEL_MAX, RUN_KERNEL_MEMORY_BUDGET)
+
+def run_in_kernel(session, data):
+    """Handle "run" with "kernel": true: execute in, or reset, the token's persistent namespace."""
+    stream = session.stream
+    reset = bool(data.get('reset'))
+    code = data.get('code')
+    if not reset and not code:
+        stream.send_message({"error": "Missing code for execution."})
+        return
+    log_message("Executing code in kernel for %s at %s.", "DEBUG", session.identifier, session.client_address)
+    output, error, info = KERNELS.execute(session, code or "", reset)
+    audit_note(code=str(code or "")[:AUDIT_TEXT_LIMIT], kernel=True, reset=reset,
+               output_bytes=len(output), error=bool(error))
+    if error:
+        log_message(f"Error executing arbitrary code: {error}", "ERROR")
+    stream.send_message({"output": output, "kernel": info})
+
+def _pump_pipe(pipe, name, chunks):
+    """Forward raw reads from a child pipe into the chunk queue until EOF."""
+    try:
+        for block in iter(lambda: pipe.read1(STREAM_CHUNK_SIZE), b''):
+            chunks.put((name, block))
+    finally:
+        pipe.close()
+        chunks.put((name, None))
+
+def stream_command(stream, command, cwd=None, timeout=None):
+    """Run command and send its output as sequenced chunk messages, then the exit status.
+
+    The chunk queue is bounded, so a slow client stalls the pipe readers (and
+    eventually the child) instead of growing server memory.
+    """
+    process = start_command(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    deadline = CommandDeadline(process, timeout or COMMAND_TIMEOUT)
+    chunks = Queue(maxsize=STREAM_QUEUE_DEPTH)
+    decoders = {}
+    for name, pipe in (("stdout", process.stdout), ("stderr", process.stderr)):
+        decoders[name] = codecs.getincrementaldecoder('utf-8')(errors='surrogateescape')
+        threading.Thread(target=_pump_pipe, args=(pipe, name, chunks), daemon=True).start()
+
+    seq = 0
+    streamed = 0
+    open_pipes = len(decoders)
+    try:
+        while open_pipes:
+            name, block = chunks.get()
+            if block is None:
+                open_pipes -= 1
+                text = decoders[name].decode(b'', final=True)
+            else:
+                streamed += len(block)
+                text = decoders[name].decode(block)
+            if text:
+                stream.send_message({"stream": name, "seq": seq, "data": text})
+                seq += 1
+        exit_status = process.wait()
+    except Exception:
+        # Client went away mid-stream: stop the whole pipeline and let the readers finish.
+        kill_process_group(process)
+        while open_pipes:
+            if chunks.get()[1] is None:
+                open_pipes -= 1
+        process.wait()
+        raise
+    finally:
+        deadline.cancel()
+    audit_note(exit_status=exit_status, output_bytes=streamed, timed_out=deadline.timed_out)
+    final = {"seq": seq, "exit_status": exit_status, "done": True}
+    if deadline.timed_out:
+        log_message(f"Streamed command timed out after {timeout or COMMAND_TIMEOUT}s: {command}", "WARNING")
+        final["timed_out"] = True
+    elif exit_status != 0:
+        log_message(f"Streamed command exited with status {exit_status}: {command}", "ERROR")
+    stream.send_message(final)
+
+class ChannelStream:
+    """View of a session's stream that tags every outgoing message with one channel id."""
+
+    def __init__(self, stream, channel_id):
+        self._stream = stream
+        self.channel_id = channel_id
+        self.cancelled = False  # set while the current request's commands were stopped by 'cancel'
+
+    def send_message(self, payload):
+        payload = dict(payload, channel=self.channel_id)
+        if self.cancelled:
+            payload["cancelled"] = True
+        self._stream.send_message(payload)
+
+    def send_file(self, header, file, offset, count):
+        self._stream.send_file(dict(header, channel=self.channel_id), file, offset, count)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+class ChannelSession:
+    """View of a Session for one channel: all state is shared, replies go through a ChannelStream."""
+
+    def __init__(self, session, channel_id):
+        self._session = session
+        self.stream = ChannelStream(session.stream, channel_id)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+class Channel:
+    """One logical channel: its queued requests and the deadlines of the commands it is running."""
+
+    def __init__(self, session, channel_id):
+        self.channel_id = channel_id
+        self.view = ChannelSession(session, channel_id)
+        self.pending = collections.deque()
+        self.running = False
+        self.deadlines = set()
+
+class ChannelMux:
+    """Channels of one session; each runs its requests in order on CHANNEL_EXECUTOR."""
+
+    def __init__(self, session):
+        self.session = session
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, data):
+        """Queue a channel-tagged request, or handle 'cancel' at once; return False to end the session."""
+        channel_id = data['channel']
+        if isinstance(channel_id, bool) or not isinstance(channel_id, (int, str)):
+            self.session.stream.send_message({"error": "'channel' must be an integer or string."})
+            return True
+        stream = ChannelStream(self.session.stream, channel_id)
+        recv_id, recv_token = data.get('id'), data.get('token')
+        if recv_id and recv_token and (recv_id != self.session.identifier or recv_token != self.session.token):
+            log_message(f"Invalid credentials from {self.session.client_address}: {recv_id}, {recv_token}", "WARNING")
+            stream.send_message({"error": "Invalid credentials."})
+            return False
+        command = data.get('command')
+        if isinstance(command, str) and command.lower() == "cancel" and recv_id and recv_token:
+            dropped, stopped = self.cancel(channel_id)
+            log_message(f"Channel {channel_id} of {self.session.client_address} cancelled: "
+                        f"{dropped} queued, {stopped} running", "INFO")
+            stream.send_message({"cancelled": True, "dropped": dropped, "stopped": stopped})
+            return True
+        if isinstance(command, str) and command.lower() in CHANNEL_DEFAULT_ONLY:
+            stream.send_message({"error": f"'{command}' is only available outside channels."})
+            return True
+
+        error = None
+        start = False
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None and len(self._channels) >= CHANNEL_MAX:
+                error = f"At most {CHANNEL_MAX} channels may be open at once."
+            elif channel is not None and len(channel.pending) >= CHANNEL_QUEUE_DEPTH:
+                error = f"Channel {channel_id} already has {CHANNEL_QUEUE_DEPTH} requests queued."
+            else:
+                if channel is None:
+                    channel = self._channels[channel_id] = Channel(self.session, channel_id)
+                    METRICS.add("open_channels", 1)
+                channel.pending.append(data)
+                start = not channel.running
+                channel.running = True
+        if error is not None:
+            stream.send_message({"error": error})
+        elif start:
+            CHANNEL_EXECUTOR.submit(self._drain, channel)
+        return True
+
+    def _drain(self, channel):
+        """Run a channel's queued requests one after another, then retire the channel."""
+        context_token = CURRENT_CHANNEL.set(channel)
+        try:
+            while True:
+                with self._lock:
+                    if self._closed or not channel.pending:
+                        channel.running = False
+                        channel.pending.clear()
+                        del self._channels[channel.channel_id]
+                        METRICS.add("open_channels", -1)
+                        return
+                    data = channel.pending.popleft()
+                    channel.view.stream.cancelled = False
+                try:
+                    timed_request(channel.view, data)
+                except Exception as e:
+                    log_message(f"Error on channel {channel.channel_id} of {self.session.client_address}: {e}", "ERROR")
+                    try:
+                        channel.view.stream.send_message({"error": "Server error while handling command."})
+                    except Exception:
+                        pass
+        finally:
+            CURRENT_CHANNEL.reset(context_token)
+
+    def cancel(self, channel_id):
+        """Drop a channel's queued requests and stop its commands; return (dropped, stopped) counts."""
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return 0, 0
+            dropped = len(channel.pending)
+            channel.pending.clear()
+            deadlines = list(channel.deadlines)
+            if deadlines:
+                # Mark the stopped request's replies so they cannot pass for a normal result.
+                channel.view.stream.cancelled = True
+        for deadline in deadlines:
+            deadline.stop()
+        return dropped, len(deadlines)
+
+    def close(self):
+        """Stop every channel when the session ends."""
+        with self._lock:
+            self._closed = True
+            deadlines = [deadline for channel in self._channels.values() for deadline in channel.deadlines]
+        for deadline in deadlines:
+            deadline.stop()
+
+def command_kind(command):
+    """Metric label for a command: the built-in name, or 'shell' for anything run by the shell."""
+    if not isinstance(command, str):
+        return "invalid"
+    lowered = command.lower()
+    if lowered.startswith("cd "):
+        return "cd"
+    if lowered in ("run", "batch", "get_file", "put_file", "hows alive", "stats", "exit", "shutdown"):
+        return lowered.replace(" ", "_")
+    return "shell"
+
+def process_request(session, data):
+    """Execute one parsed client request, or queue it on its channel; return False when the session should end."""
+    if session.channels is not None and data.get('channel') is not None:
+        return session.channels.submit(data)
+    return timed_request(session, data)
+
+def timed_request(session, data):
+    """Run dispatch_request for one request, recording its latency and audit record by command kind."""
+    command = data.get('command')
+    kind = command_kind(command)
+    fields = {"command": command[:AUDIT_TEXT_LIMIT]} if isinstance(command, str) else {}
+    if data.get('channel') is not None:
+        fields["channel"] = data['channel']
+    context_token = AUDIT_FIELDS.set(fields)
+    started = time.perf_counter()
+    try:
+        if PROFILER.active:
+            return PROFILER.run(kind, dispatch_request, session, data)
+        return dispatch_request(session, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        AUDIT_FIELDS.reset(context_token)
+        METRICS.observe("request_seconds", kind, elapsed)
+        METRICS.inc("requests_total", kind)
+        AUDIT.record(kind, session, elapsed, fields)
+
+def dispatch_request(session, data):
+    """Execute one parsed client request; return False when the session should end."""
+    stream = session.stream
+    client_address = session.client_address
+    recv_id = data.get('id')
+    recv_token = data.get('token')
+    command = data.get('command')
+
+    if not recv_id or not recv_token or not command:
+        stream.send_message({"error": "Missing required fields ('id', 'token', 'command')."})
+        return True
+
+    if recv_id != session.identifier or recv_token != session.token:
+        log_message(f"Invalid credentials from {client_address}: {recv_id}, {recv_token}", "WARNING")
+        stream.send_message({"error": "Invalid credentials."})
+        return False
+
+    # Shutdown command
+    if command.lower() == "shutdown":
+        log_message(f"Shutdown command received from {client_address}", "INFO")
+        stream.send_message({"message": "Server is shutting down."})
+        SHUTDOWN_EVENT.set()
+        return False
+
+    # Change directory command.
+    if command.lower().startswith("cd "):
+        try:
+            directory = command[3:].strip()
+            new_dir = session.change_directory(directory)
+            response = {"output": f"Changed directory to {new_dir}"}
+            log_message(f"Changed directory to {new_dir} for {client_address}", "INFO")
+        except Exception as e:
+            response = {"output": f"Failed to change directory: {e}"}
+            log_message(f"Failed to change directory for {client_address}: {e}", "ERROR")
+        stream.send_message(response)
+        return True
+
+    # Exit command – send a goodbye message before closing.
+    if command.lower() == "exit":
+        log_message(f"Client {client_address} disconnected.", "INFO")
+        stream.send_message({"message": "Goodbye"})
+        time.sleep(0.1)
+        return False
+
+    # 'stats' command: counters, gauges and latency percentiles.
+    if command.lower() == "stats":
+        response = METRICS.snapshot()
+        response["uptime"] = str(datetime.now() - SERVER_START_TIME).split('.')[0]
+        if stream.compressor is not None:
+            response["session"] = {"compression": stream.compression_report()}
+        stream.send_message(response)
+        return True
+
+    # 'hows alive' command.
+    if command.lower() == "hows alive":
+        uptime = datetime.now() - SERVER_START_TIME
+        response = {"uptime": str(uptime).split('.')[0]}
+        stream.send_message(response)
+        return True
+
+    # 'approval' collects the result of a parked dangerous command on legacy sessions.
+    if command.lower() == "approval":
+        stream.send_message(APPROVALS.collect(session, data.get('approval_id')))
+        return True
+
+    # 'cancel' only makes sense for a channel; ChannelMux handles the tagged form.
+    if command.lower() == "cancel":
+        stream.send_message({"error": "'cancel' requires a 'channel' on a session opened with channels."})
+        return True
+
+    # Batch of independent shell commands run concurrently.
+    if command.lower() == "batch":
+        run_batch(session, data)
+        return True
+
+    # Arbitrary Code Execution: 'run' command uses the code field.
+    if command.lower() == "run" and data.get('kernel'):
+        run_in_kernel(session, data)
+        return True
+    if command.lower() == "run":
+        if 'code' not in data or not data.get('code'):
+            stream.send_message({"error": "Missing code for execution."})
+            return True
+        code_to_run = data.get('code')
+        log_message("Executing arbitrary code from %s at %s.", "DEBUG", recv_id, client_address)
+        code_output, error = get_interpreter_pool().execute(code_to_run, session.cwd)
+        audit_note(code=str(code_to_run)[:AUDIT_TEXT_LIMIT], output_bytes=len(code_output), error=bool(error))
+        if error:
+            log_message(f"Error executing arbitrary code: {error}", "ERROR")
+        response = {"output": code_output}
+        stream.send_message(response)
+        return True
+
+    # Raw file transfer.
+    if command.lower() == "get_file":
+        send_file(session, data)
+        return True
+    if command.lower() == "put_file":
+        return receive_file(session, data)
+
+    wants_stream = bool(data.get('stream'))
+    if wants_stream and stream.framing == FRAMING_LEGACY:
+        stream.send_message({"error": "Streaming requires length-prefixed framing."})
+        return True
+    try:
+        timeout = command_timeout(data)
+    except ValueError as e:
+        stream.send_message({"error": str(e)})
+        return True
+
+    # For other commands, check if it is dangerous.
+    if is_dangerous_command(command):
+        log_message(f"Dangerous command detected from {recv_id} at {client_address}: {command}", "WARNING")
+        if ADMIN_APPROVAL_FUNC is None:
+            # Park the command and free this worker; the result is sent (or, on legacy
+            # sessions, kept for an 'approval' request) once an admin decides.
+            pending = APPROVALS.submit(session, command, wants_stream, timeout)
+            stream.send_message({
+                "approval_id": pending.approval_id,
+                "status": "pending",
+                "message": "Dangerous command is awaiting admin approval."
+            })
+            return True
+        admin_approval = ADMIN_APPROVAL_FUNC(f"Approve dangerous command from {recv_id} @ {client_address}: {command}\nApprove? (Y/N): ")
+        if admin_approval.strip().lower() != 'y':
+            stream.send_message({"error": "Dangerous command execution denied by admin."})
+            log_message("Dangerous command execution denied by admin.", "WARNING")
+            return True
+        else:
+            log_message("Admin approved dangerous command execution.", "INFO")
+
+    watch = data.get('watch') or ()
+    if not isinstance(watch, list) or not all(isinstance(path, str) for path in watch):
+        watch = ()
+    execute_command(session, command, wants_stream, use_cache=bool(data.get('cache')), watch=watch, timeout=timeout)
+    return True
+
+_CACHEABLE_PATTERN = re.compile("|".join(f"(?:{pattern})" for pattern in CACHEABLE_COMMANDS))
+
+def is_cacheable_command(command):
+    """True for allowlisted read-only commands that contain no shell control characters."""
+    if SHELL_CONTROL_CHARS.intersection(command):
+        return False
+    return _CACHEABLE_PATTERN.fullmatch(normalize_command(command)) is not None
+
+class CachedResult:
+    """One cached command result plus the mtimes of the paths it depends on."""
+    __slots__ = ("output", "exit_status", "created", "watched")
+
+    def __init__(self, output, exit_status, created, watched):
+        self.output = output
+        self.exit_status = exit_status
+        self.created = created
+        self.watched = watched
+
+class ResultCache:
+    """LRU cache of command output keyed by (cwd, command), bounded by TTL and total bytes."""
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _mtimes(cwd, paths):
+        snapshot = []
+        for path in paths:
+            full_path = os.path.join(cwd, path)
+            try:
+                snapshot.append((full_path, os.stat(full_path).st_mtime_ns))
+            except OSError:
+                snapshot.append((full_path, None))
+        return tuple(snapshot)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.output)
+
+    def get(self, cwd, command):
+        """Return a live CachedResult or None; stale or invalidated entries are dropped."""
+        key = (cwd, command)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created > self.ttl:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+        if entry.watched:
+            paths = [path for path, _ in entry.watched]
+            if self._mtimes(cwd, paths) != entry.watched:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._drop(key)
+                return None
+        return entry
+
+    def put(self, cwd, command, output, exit_status, watch=()):
+        if len(output) > self.max_bytes:
+            return
+        entry = CachedResult(output, exit_status, time.monotonic(), self._mtimes(cwd, watch))
+        key = (cwd, command)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._size += len(output)
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_TTL, RESULT_CACHE_MAX_BYTES)
+
+def run_shell_command(command, cwd, timeout=None):
+    """Run command through the system shell and return (combined output, exit status, timed out).
+
+    Output is decoded with surrogateescape so binary codecs can send the exact bytes.
+    A command killed at its deadline returns whatever it printed before then.
+    """
+    process = start_command(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+    deadline = CommandDeadline(process, timeout or COMMAND_TIMEOUT)
+    try:
+        output = process.communicate()[0].decode('utf-8', 'surrogateescape')
+    finally:
+        deadline.cancel()
+    if deadline.timed_out:
+        log_message(f"Command timed out after {timeout or COMMAND_TIMEOUT}s: {command}", "WARNING")
+    elif process.returncode != 0:
+        log_message(f"Command execution error: {output}", "ERROR")
+    return output, process.returncode, deadline.timed_out
+
+def parse_batch(data):
+    """Validate a batch request; return (items, concurrency) or raise ValueError."""
+    items = data.get('commands')
+    if not isinstance(items, list) or not items:
+        raise ValueError("Batch requires a non-empty 'commands' list.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"Batch is limited to {BATCH_MAX_ITEMS} commands.")
+    seen = set()
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('command'), str) or not item['command']:
+            raise ValueError("Each batch item needs an 'id' and a 'command' string.")
+        item_id = item.get('id')
+        # Collected results are keyed by str(id), so 1 and "1" are the same id.
+        if isinstance(item_id, bool) or not isinstance(item_id, (str, int)) or str(item_id) in seen:
+            raise ValueError("Batch item ids must be unique strings or integers.")
+        seen.add(str(item_id))
+        command_timeout(item)
+    concurrency = data.get('concurrency', BATCH_MAX_CONCURRENCY)
+    if not isinstance(concurrency, int) or concurrency < 1:
+        raise ValueError("'concurrency' must be a positive integer.")
+    command_timeout(data)
+    return items, min(concurrency, BATCH_MAX_CONCURRENCY)
+
+def run_batch(session, data):
+    """Run independent commands in parallel and reply per item or with one collected message."""
+    stream = session.stream
+    try:
+        items, concurrency = parse_batch(data)
+    except ValueError as e:
+        stream.send_message({"error": str(e)})
+        return
+    stream_results = bool(data.get('stream'))
+    if stream_results and stream.framing == FRAMING_LEGACY:
+        stream.send_message({"error": "Streaming requires length-prefixed framing."})
+        return
+    log_message(f"Batch of {len(items)} commands from {session.identifier} (concurrency {concurrency})", "INFO")
+
+    results = {}
+
+    def finish(item_id, result):
+        if stream_results:
+            result = dict(result, batch_item=item_id)
+            stream.send_message(result)
+        else:
+            results[str(item_id)] = result
+
+    # Dangerous items go through the same approval path as single commands.
+    runnable = []
+    for item in items:
+        command = item['command']
+        if not is_dangerous_command(command):
+            runnable.append(item)
+            continue
+        log_message(f"Dangerous command detected in batch from {session.identifier} at "
+                    f"{session.client_address}: {command}", "WARNING")
+        if ADMIN_APPROVAL_FUNC is None:
+            pending = APPROVALS.submit(session, command, False, item.get('timeout') or data.get('timeout'))
+            finish(item['id'], {"approval_id": pending.approval_id, "status": "pending"})
+            continue
+        admin_approval = ADMIN_APPROVAL_FUNC(
+            f"Approve dangerous command from {session.identifier} @ {session.client_address}: {command}\nApprove? (Y/N): "
+        )
+        if admin_approval.strip().lower() == 'y':
+            runnable.append(item)
+        else:
+            finish(item['id'], {"error": "Dangerous command execution denied by admin."})
+
+    # Keep at most `concurrency` items in flight on the shared executor.
+    queued = list(reversed(runnable))
+    in_flight = {}
+    while queued or in_flight:
+        while queued and len(in_flight) < concurrency:
+            item = queued.pop()
+            timeout = item.get('timeout') or data.get('timeout')
+            # Run in a copy of this context so a channel cancel also reaches batch items.
+            future = BATCH_EXECUTOR.submit(
+                contextvars.copy_context().run, run_shell_command, item['command'], session.cwd, timeout
+            )
+            in_flight[future] = item['id']
+        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            item_id = in_flight.pop(future)
+            try:
+                output, exit_status, timed_out = future.result()
+                result = {"output": output, "exit_status": exit_status}
+                if timed_out:
+                    result["timed_out"] = True
+                finish(item_id, result)
+            except Exception as e:
+                log_message(f"Batch item {item_id} failed: {e}", "ERROR")
+                finish(item_id, {"error": f"Failed to run command: {e}"})
+
+    audit_note(items=len(items))
+    if stream_results:
+        stream.send_message({"batch_done": True, "count": len(items)})
+    else:
+        stream.send_message({"results": results})
+
+def _file_request(session, data):
+    """Validate the fields shared by get_file and put_file; return (path, offset, length, checksum)."""
+    path = data.get('path')
+    if not isinstance(path, str) or not path:
+        raise ValueError("File transfer requires a 'path' string.")
+    offset = data.get('offset', 0)
+    length = data.get('length')
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("'offset' must be a non-negative integer.")
+    if length is not None and (not isinstance(length, int) or length < 0):
+        raise ValueError("'length' must be a non-negative integer.")
+    checksum = data.get('checksum')
+    if checksum is not None and checksum not in FILE_CHECKSUMS:
+        raise ValueError(f"'checksum' must be one of {', '.join(sorted(FILE_CHECKSUMS))}.")
+    return os.path.join(session.cwd, path), offset, length, checksum
+
+def _file_digest(file, offset, count, algorithm):
+    """Hash count bytes of file starting at offset, reading through one reusable buffer."""
+    digest = hashlib.new(algorithm)
+    buffer = memoryview(bytearray(FILE_CHUNK_SIZE))
+    file.seek(offset)
+    while count:
+        read = file.readinto(buffer[:min(count, FILE_CHUNK_SIZE)])
+        if not read:
+            break
+        digest.update(buffer[:read])
+        count -= read
+    return digest.hexdigest()
+
+def send_file(session, data):
+    """get_file: send a header describing the range, then the raw bytes via sendfile."""
+    stream = session.stream
+    if stream.framing == FRAMING_LEGACY:
+        stream.send_message({"error": "File transfer requires length-prefixed framing."})
+        return
+    try:
+        path, offset, length, checksum = _file_request(session, data)
+        file = open(path, "rb")
+    except (ValueError, OSError) as e:
+        stream.send_message({"error": f"Cannot read file: {e}"})
+        return
+    with file:
+        size = os.fstat(file.fileno()).st_size
+        if offset > size:
+            stream.send_message({"error": f"Offset {offset} is past the end of the file ({size} bytes)."})
+            return
+        count = size - offset if length is None else min(length, size - offset)
+        header = {"file": path, "size": size, "offset": offset, "length": count}
+        if checksum:
+            header["checksum"] = {"algorithm": checksum, "digest": _file_digest(file, offset, count, checksum)}
+        log_message("Sending %s bytes of %s from offset %s to %s", "INFO", count, path, offset, session.client_address)
+        stream.send_file(header, file, offset, count)
+    METRICS.inc("file_bytes_total", "get", count)
+    audit_note(path=path, output_bytes=count)
+
+def receive_file(session, data):
+    """put_file: read exactly 'length' raw bytes after the request and write them at 'offset'.
+
+    Returns False when the byte count is unknown, since the stream cannot be resynchronised.
+    """
+    stream = session.stream
+    if stream.framing == FRAMING_LEGACY:
+        stream.send_message({"error": "File transfer requires length-prefixed framing."})
+        return True
+    try:
+        path, offset, length, checksum = _file_request(session, data)
+    except ValueError as e:
+        stream.send_message({"error": str(e)})
+        # The upload bytes are already on their way: skip them if their count is known.
+        length = data.get('length')
+        return isinstance(length, int) and length >= 0 and _drain(stream, length)
+    if length is None:
+        stream.send_message({"error": "put_file requires 'length'."})
+        return False
+    digest = hashlib.new(checksum) if checksum else None
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    except OSError as e:
+        _drain(stream, length)
+        stream.send_message({"error": f"Cannot write file: {e}"})
+        return True
+    written = 0
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        for chunk in stream.read_raw(length):
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view):]
+            if digest is not None:
+                digest.update(chunk)
+            written += len(chunk)
+        if data.get('truncate'):
+            os.ftruncate(fd, offset + length)
+        size = os.fstat(fd).st_size
+    except ConnectionError:
+        raise
+    except OSError as e:
+        _drain(stream, length - written)
+        stream.send_message({"error": f"Failed writing file after {written} bytes: {e}", "written": written})
+        return True
+    finally:
+        os.close(fd)
+    METRICS.inc("file_bytes_total", "put", written)
+    audit_note(path=path, input_bytes=written)
+    log_message("Received %s bytes into %s at offset %s from %s", "INFO", written, path, offset, session.client_address)
+    response = {"file": path, "offset": offset, "written": written, "size": size}
+    if digest is not None:
+        response["checksum"] = {"algorithm": checksum, "digest": digest.hexdigest()}
+        expected = data.get('digest')
+        if isinstance(expected, str) and expected.lower() != digest.hexdigest():
+            response["error"] = "Checksum mismatch."
+    stream.send_message(response)
+    return True
+
+def _drain(stream, count):
+    """Discard count upload bytes so the next frame lines up; returns False if the peer went away."""
+    try:
+        for _ in stream.read_raw(count):
+            pass
+    except ConnectionError:
+        return False
+    return True
+
+def execute_command(session, command, wants_stream, reply_fields=None, use_cache=False, watch=(), timeout=None,
+                    send=None):
+    """Run a shell command for session and send its output; reply_fields are merged into the response.
+
+    send, if given, receives the response instead of the session's stream (streamed output excepted).
+    """
+    stream = session.stream
+    log_message("Received command: %s from %s", "INFO", command, session.identifier)
+    if wants_stream:
+        stream_command(stream, command, session.cwd, timeout)
+        return
+    cache_requested = use_cache
+    use_cache = use_cache and is_cacheable_command(command)
+    cached = RESULT_CACHE.get(session.cwd, command) if use_cache else None
+    timed_out = False
+    if cached is not None:
+        output = cached.output
+    elif session.persistent_shell:
+        output, exit_status, timed_out = session.run_in_shell(command, timeout)
+        if timed_out:
+            log_message(f"Command timed out in persistent shell: {command}", "WARNING")
+        elif exit_status != 0:
+            log_message(f"Command execution error: {output}", "ERROR")
+    else:
+        output, exit_status, timed_out = run_shell_command(command, session.cwd, timeout)
+    if use_cache and cached is None and exit_status == 0 and not timed_out:
+        RESULT_CACHE.put(session.cwd, command, output, exit_status, watch)
+
+    audit_note(output_bytes=len(output), cached=cached is not None)
+    if cached is None:
+        audit_note(exit_status=exit_status, timed_out=timed_out)
+    response = {"output": output}
+    if timed_out:
+        response.update(timed_out=True, exit_status=exit_status)
+    if cache_requested:
+        response["cached"] = cached is not None
+    if reply_fields:
+        response.update(reply_fields)
+    (send or stream.send_message)(response)
+
+class PendingApproval:
+    """A dangerous command parked until an admin approves or denies it."""
+
+    def __init__(self, approval_id, session, command, wants_stream, timeout=None):
+        self.approval_id = approval_id
+        self.session = session
+        self.command = command
+        self.wants_stream = wants_stream
+        self.timeout = timeout
+        self.created = datetime.now()
+        self.timer = None
+        # Legacy replies have no boundaries, so a result sent unprompted could run into the
+        # next reply: those sessions collect it with an 'approval' request instead.
+        self.collect = session.stream.framing == FRAMING_LEGACY
+        self.result = None
+
+class ApprovalRegistry:
+    """Pending dangerous commands keyed by approval id, with automatic denial on timeout."""
+
+    def __init__(self):
+        self._pending = {}
+        self._results = {}  # decided approvals of legacy sessions, until their result is collected
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=APPROVAL_WORKERS, thread_name_prefix="aegis-approved"
+        )
+
+    def submit(self, session, command, wants_stream, timeout=None):
+        with self._lock:
+            approval_id = secrets.token_hex(4)
+            while approval_id in self._pending:
+                approval_id = secrets.token_hex(4)
+            pending = PendingApproval(approval_id, session, command, wants_stream, timeout)
+            self._pending[approval_id] = pending
+        pending.timer = threading.Timer(APPROVAL_TIMEOUT.total_seconds(), self._expire, args=(approval_id,))
+        pending.timer.daemon = True
+        pending.timer.start()
+        log_message(
+            f"Approval {approval_id} pending for {session.identifier} @ {session.client_address}: {command} "
+            f"(use 'approve {approval_id}' or 'deny {approval_id}')",
+            "WARNING"
+        )
+        return pending
+
+    def _take(self, approval_id):
+        with self._lock:
+            pending = self._pending.pop(approval_id, None)
+            if pending is not None and pending.collect:
+                self._results[approval_id] = pending
+        if pending is not None and pending.timer is not None:
+            pending.timer.cancel()
+        return pending
+
+    def _reply(self, pending, payload):
+        payload["approval_id"] = pending.approval_id
+        if pending.collect:
+            pending.result = payload
+            return
+        try:
+            pending.session.stream.send_message(payload)
+        except Exception as e:
+            log_message(f"Could not deliver approval result {pending.approval_id}: {e}", "ERROR")
+
+    def _run_approved(self, pending):
+        fields = {"command": pending.command[:AUDIT_TEXT_LIMIT], "approval_id": pending.approval_id}
+        context_token = AUDIT_FIELDS.set(fields)
+        started = time.perf_counter()
+        try:
+            execute_command(pending.session, pending.command, pending.wants_stream,
+                            timeout=pending.timeout, send=lambda payload: self._reply(pending, payload))
+        except Exception as e:
+            log_message(f"Error running approved command {pending.approval_id}: {e}", "ERROR")
+            self._reply(pending, {"error": "Server error while handling command."})
+        finally:
+            AUDIT_FIELDS.reset(context_token)
+            AUDIT.record("approved", pending.session, time.perf_counter() - started, fields)
+
+    def decide(self, approval_id, approved):
+        """Approve or deny a pending command; return False if the id is unknown."""
+        pending = self._take(approval_id)
+        if pending is None:
+            return False
+        if approved:
+            log_message(f"Admin approved dangerous command {approval_id}.", "INFO")
+        else:
+            log_message(f"Admin denied dangerous command {approval_id}.", "WARNING")
+        if approved:
+            self._executor.submit(self._run_approved, pending)
+        else:
+            self._reply(pending, {"error": "Dangerous command execution denied by admin."})
+        return True
+
+    def _expire(self, approval_id):
+        pending = self._take(approval_id)
+        if pending is not None:
+            log_message(f"Approval {approval_id} timed out.", "WARNING")
+            self._reply(pending, {"error": "Dangerous command approval timed out."})
+
+    def collect(self, session, approval_id):
+        """Reply to a legacy session's 'approval' poll: the decided result once, else its status."""
+        with self._lock:
+            pending = self._pending.get(approval_id) or self._results.get(approval_id)
+            if pending is None or pending.session.owner is not session.owner:
+                return {"error": "Unknown approval id."}
+            if pending.result is None:
+                status = "pending" if approval_id in self._pending else "running"
+                return {"approval_id": approval_id, "status": status}
+            del self._results[approval_id]
+            return pending.result
+
+    def cancel_session(self, session):
+        """Drop every pending approval that belongs to a closing session."""
+        with self._lock:
+            owned = [key for key, pending in self._pending.items() if pending.session.owner is session]
+        for approval_id in owned:
+            pending = self._take(approval_id)
+            if pending is not None:
+                log_message(f"Approval {approval_id} cancelled: session closed.", "INFO")
+        with self._lock:
+            for approval_id in [key for key, pending in self._results.items() if pending.session.owner is session]:
+                del self._results[approval_id]
+
+    def list_pending(self):
+        with self._lock:
+            return list(self._pending.values())
+
+    def __len__(self):
+        return len(self._pending)
+
+APPROVALS = ApprovalRegistry()
+
+def handle_admin_command(line):
+    """Execute one admin channel command and return the text reply."""
+    parts = line.strip().split()
+    if not parts:
+        return ""
+    action = parts[0].lower()
+    if action == "list" and len(parts) == 1:
+        pending = APPROVALS.list_pending()
+        if not pending:
+            return "No pending approvals."
+        now = datetime.now()
+        return "\n".join(
+            f"{item.approval_id}  {int((now - item.created).total_seconds())}s  "
+            f"{item.session.identifier}@{item.session.client_address}  {item.command}"
+            for item in pending
+        )
+    if action in ("approve", "deny") and len(parts) == 2:
+        if APPROVALS.decide(parts[1], action == "approve"):
+            return f"{'Approved' if action == 'approve' else 'Denied'} {parts[1]}."
+        return f"Unknown approval id {parts[1]}."
+    if action == "profile" and len(parts) >= 2:
+        try:
+            if parts[1] == "start":
+                PROFILER.start(**parse_profile_options(parts[2:]))
+                return PROFILER.status()
+        except ValueError as e:
+            return str(e)
+        if parts[1] == "stop" and len(parts) == 2:
+            path = PROFILER.stop()
+            return f"Profile report written to {path}." if path else "Profiling is off."
+        if parts[1] == "status" and len(parts) == 2:
+            return PROFILER.status()
+    if action == "audit":
+        try:
+            records = AUDIT.query(**parse_audit_query(parts[1:]))
+        except ValueError as e:
+            return str(e)
+        if not records:
+            return "No matching audit records."
+        return "\n".join(json.dumps(record) for record in records)
+    return ("Unknown admin command. Use: list, approve <id>, deny <id>, audit [token= since= until= limit=], "
+            "profile start [seconds= requests= sample= memory] | stop | status.")
+
+def admin_authenticated(line):
+    """True if line is 'auth <secret>' with the current ADMIN_SECRET."""
+    parts = line.split()
+    return (ADMIN_SECRET is not None and len(parts) == 2 and parts[0] == "auth"
+            and secrets.compare_digest(parts[1].encode('utf-8'), ADMIN_SECRET.encode('utf-8')))
+
+def serve_admin_client(admin_socket, handler=handle_admin_command):
+    """Answer admin commands, one per line, until the admin disconnects."""
+    # Separate reader and writer: a text write would discard lines already buffered for reading.
+    with admin_socket, admin_socket.makefile("r", encoding="utf-8", newline="\n") as reader, \
+            admin_socket.makefile("w", encoding="utf-8", newline="\n") as writer:
+        if not admin_authenticated(reader.readline()):
+            log_message("Admin channel connection refused: missing or wrong secret.", "WARNING")
+            writer.write("Authentication required.\n")
+            writer.flush()
+            return
+        writer.write("Authenticated.\n")
+        writer.flush()
+        for line in reader:
+            reply = handler(line)
+            if reply:
+                writer.write(reply + "\n")
+                writer.flush()
+
+def admin_listener(address, handler):
+    """Accept admin connections on address, (host, port) or a Unix socket path, until shutdown."""
+    label = address if isinstance(address, str) else f"{address[0]}:{address[1]}"
+    try:
+        if isinstance(address, str):
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if os.path.exists(address):
+                os.unlink(address)  # left by a shard that crashed
+        else:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        listener.listen(5)
+        listener.settimeout(1.0)
+    except OSError as e:
+        log_message(f"Admin channel unavailable on {label}: {e}", "ERROR")
+        return
+    log_message(f"Admin channel listening on {label}", "INFO")
+    with listener:
+        while not SHUTDOWN_EVENT.is_set():
+            try:
+                admin_socket, _ = listener.accept()
+            except socket.timeout:
+                continue
+            admin_socket.settimeout(None)
+            threading.Thread(target=serve_admin_client, args=(admin_socket, handler), daemon=True).start()
+
+def admin_console(handler):
+    """Read admin commands typed at the server console."""
+    for line in sys.stdin:
+        reply = handler(line)
+        if reply:
+            print(reply)
+
+def start_admin_channel(handler=handle_admin_command):
+    """Start the admin socket and, for an interactive console, the console reader."""
+    global ADMIN_SECRET
+    address = ADMIN_SOCKET or ((ADMIN_HOST, ADMIN_PORT) if ADMIN_PORT else None)
+    if address is not None:
+        if ADMIN_SECRET is None:
+            ADMIN_SECRET = secrets.token_urlsafe(24)
+            # Console only: the log files are readable by the commands clients run.
+            print(f"Admin channel secret (set AEGIS_ADMIN_SECRET to choose one): {ADMIN_SECRET}")
+        threading.Thread(target=admin_listener, args=(address, handler), name="aegis-admin", daemon=True).start()
+    if sys.stdin is not None and sys.stdin.isatty():
+        threading.Thread(target=admin_console, args=(handler,), name="aegis-console", daemon=True).start()
+
+def ask_shard_admin(path, line):
+    """Send one admin command to a shard's private admin socket and return its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as shard:
+        shard.settimeout(SHARD_ADMIN_TIMEOUT)
+        shard.connect(path)
+        shard.sendall(f"auth {ADMIN_SECRET}\n{line.strip()}\n".encode('utf-8'))
+        shard.shutdown(socket.SHUT_WR)
+        with shard.makefile("r", encoding="utf-8") as reader:
+            reader.readline()  # "Authenticated."
+            return reader.read().strip()
+
+def shard_admin_command(paths, line):
+    """Answer an admin command in the supervisor, asking the shards that hold approvals and profiles."""
+    parts = line.split()
+    if not parts:
+        return ""
+    action = parts[0].lower()
+    if action not in ("list", "approve", "deny", "profile"):
+        # 'audit' reads every shard's segments from the shared directory; the rest is usage help.
+        return handle_admin_command(line)
+    replies = []
+    for index, path in enumerate(paths):
+        try:
+            replies.append(ask_shard_admin(path, line))
+        except OSError as e:
+            log_message(f"Admin channel of shard {index} unavailable: {e}", "ERROR")
+            replies.append(f"Shard {index} unavailable.")
+    if action == "list":
+        return "\n".join(reply for reply in replies if reply != "No pending approvals.") or "No pending approvals."
+    if action in ("approve", "deny"):
+        # Approval ids are only known to the shard holding the session.
+        return next((reply for reply in replies if not reply.startswith(("Unknown approval id", "Shard "))),
+                    replies[0])
+    return "\n".join(f"shard {index}: {reply}" for index, reply in enumerate(replies))
+
+def end_session(stream, expiry, client_address, detail=""):
+    """Tell the client why its session ended and half-close the connection."""
+    try:
+        stream.send_message({"error": expiry})
+        stream.shutdown(socket.SHUT_WR)
+        time.sleep(0.1)
+    except Exception as exc:
+        log_message(f"Error sending timeout message: {exc}", "ERROR")
+    log_message(f"Session for {client_address} ended{detail}: {expiry}", "WARNING")
+
+METRICS.register_gauge("queue_depth", task_queue.qsize)
+METRICS.register_gauge("startup_seconds", lambda: STARTUP_TIMES.get("startup_seconds"))
+METRICS.register_gauge("tunnel_ready_seconds", lambda: STARTUP_TIMES.get("tunnel_ready_seconds"))
+METRICS.register_gauge("pool_threads", lambda: WORKER_POOL.threads)
+METRICS.register_gauge("busy_workers", lambda: WORKER_POOL.threads - WORKER_POOL.idle)
+METRICS.register_gauge("pending_approvals", lambda: len(APPROVALS))
+METRICS.register_gauge("authorized_tokens", lambda: len(AUTHORIZED_TOKENS))
+METRICS.register_gauge("run_pool_idle", lambda: RUN_POOL.idle.qsize() if RUN_POOL is not None else 0)
+METRICS.register_gauge("run_kernels", lambda: len(KERNELS))
+METRICS.register_gauge("run_kernel_memory_bytes", KERNELS.memory)
+
+def handle_client(client_socket, client_address):
+    """Process client commands after successful authentication."""
+    log_message("Connection received from %s", "INFO", client_address)
+
+    stream = MessageStream(client_socket)
+    session = validate_client(stream, client_address)
+    if session is None:
+        log_message(f"Client {client_address} failed validation.", "WARNING")
+        client_socket.close()
+        return
+
+    # Block in recv with no polling; SESSION_TIMEOUTS wakes this thread when a deadline passes.
+    client_socket.settimeout(None)
+    session.watch(lambda expiry: stream.shutdown(socket.SHUT_RD))
+
+    try:
+        while True:
+            try:
+                input_data = stream.read_message()
+            except FramingError as exc:
+                log_message(f"Protocol error from {client_address}: {exc}", "WARNING")
+                stream.send_message({"error": "Invalid frame."})
+                break
+
+            if session.expired:
+                end_session(stream, session.expired, client_address)
+                break
+
+            # If the client closed the connection.
+            if not input_data:
+                break
+
+            # Check timeouts after data arrives.
+            expiry = session.expiry()
+            if expiry is not None:
+                end_session(stream, expiry, client_address, " after receiving data")
+                break
+            session.touch()
+
+            try:
+                data = stream.decode(input_data)
+            except ValueError:
+                stream.send_message({"error": stream.codec.invalid_message})
+                continue
+
+            if not process_request(session, data):
+                break
+    except Exception as e:
+        log_message(f"Error handling client {client_address}: {e}", "ERROR")
+        try:
+            stream.send_message({"error": "Server error while handling command."})
+        except Exception:
+            pass
+    finally:
+        session.close()
+        client_socket.close()
+        log_message("Closed connection with %s", "INFO", client_address)
+
+async def handle_client_async(reader, writer):
+    """Coroutine counterpart of handle_client used by the asyncio engine."""
+    client_address = writer.get_extra_info('peername')
+    log_message("Connection received from %s", "INFO", client_address)
+    METRICS.inc("connections_total")
+    loop = asyncio.get_running_loop()
+    stream = AsyncMessageStream(reader, writer, loop)
+    session = None
+
+    try:
+        try:
+            data = await stream.receive_handshake()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            await stream.send_message_async({"error": "Invalid JSON format."})
+            data = None
+        if data is not None:
+            try:
+                session = await loop.run_in_executor(
+                    COMMAND_EXECUTOR, authenticate_client, stream, data, client_address
+                )
+            except Exception as e:
+                log_message(f"Error during client validation: {e}", "ERROR")
+                await stream.send_message_async({"error": "Server error during validation."})
+        if session is None:
+            log_message(f"Client {client_address} failed validation.", "WARNING")
+            return
+
+        while True:
+            # asyncio keeps its own deadline heap, so the loop's timer replaces SESSION_TIMEOUTS here.
+            remaining = session.deadline() - time.monotonic()
+            try:
+                input_data = await asyncio.wait_for(stream.receive_message(), timeout=max(remaining, 0))
+            except asyncio.TimeoutError:
+                expiry = session.expiry()
+                if expiry is None:
+                    continue
+                try:
+                    await stream.send_message_async({"error": expiry})
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                except Exception as exc:
+                    log_message(f"Error sending timeout message: {exc}", "ERROR")
+                log_message(f"Session for {client_address} ended: {expiry}", "WARNING")
+                break
+            except FramingError as exc:
+                log_message(f"Protocol error from {client_address}: {exc}", "WARNING")
+                await stream.send_message_async({"error": "Invalid frame."})
+                break
+
+            # If the client closed the connection.
+            if not input_data:
+                break
+
+            expiry = session.expiry()
+            if expiry is not None:
+                await stream.send_message_async({"error": expiry})
+                log_message(f"Session for {client_address} ended after receiving data: {expiry}", "WARNING")
+                break
+            session.touch()
+
+            try:
+                data = stream.decode(input_data)
+            except ValueError:
+                await stream.send_message_async({"error": stream.codec.invalid_message})
+                continue
+
+            # Like the threaded engine, stop reading while a request runs so unread input
+            # stays in the kernel and exerts backpressure on the client.
+            writer.transport.pause_reading()
+            keep_open = await loop.run_in_executor(COMMAND_EXECUTOR, process_request, session, data)
+            if not keep_open:
+                break
+            writer.transport.resume_reading()
+    except Exception as e:
+        log_message(f"Error handling client {client_address}: {e}", "ERROR")
+        try:
+            await stream.send_message_async({"error": "Server error while handling command."})
+        except Exception:
+            pass
+    finally:
+        if session is not None:
+            await loop.run_in_executor(COMMAND_EXECUTOR, session.close)
+        writer.close()
+        log_message("Closed connection with %s", "INFO", client_address)
+
+async def serve_asyncio(server_socket):
+    """Accept connections on server_socket with one coroutine per session until shutdown."""
+    global COMMAND_EXECUTOR
+    COMMAND_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+        max_workers=ASYNC_EXECUTOR_WORKERS, thread_name_prefix="aegis-exec"
+    )
+    try:
+        server = await asyncio.start_server(handle_client_async, sock=server_socket, backlog=LISTEN_BACKLOG)
+        async with server:
+            while not SHUTDOWN_EVENT.is_set():
+                await asyncio.sleep(1.0)
+    finally:
+        COMMAND_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+class WorkerPool:
+    """Worker threads draining task_queue, grown under backlog and retired after idling."""
+
+    def __init__(self, queue, min_threads, max_threads, high_water):
+        self.queue = queue
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.high_water = high_water
+        self.threads = 0
+        self.idle = 0
+        self._lock = threading.Lock()
+
+    def configure(self, min_threads, max_threads, high_water):
+        with self._lock:
+            self.min_threads = min_threads
+            self.max_threads = max_threads
+            self.high_water = high_water
+
+    def start(self):
+        with self._lock:
+            for _ in range(self.min_threads):
+                self._spawn()
+
+    def _spawn(self):
+        """Start one worker; the caller holds the lock."""
+        self.threads += 1
+        self.idle += 1
+        threading.Thread(target=self._run, name="aegis-worker", daemon=True).start()
+
+    def submit(self, client_socket, client_address):
+        """Queue a connection for a worker; return False when the queue is past its high-water mark."""
+        with self._lock:
+            if self.queue.qsize() >= self.high_water:
+                return False
+            self.queue.put((client_socket, client_address, time.monotonic()))
+            if self.idle < self.queue.qsize() and self.threads < self.max_threads:
+                self._spawn()
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                client_socket, client_address, queued_at = self.queue.get(timeout=WORKER_IDLE_TIMEOUT)
+            except Empty:
+                with self._lock:
+                    if self.threads > self.min_threads:
+                        self.threads -= 1
+                        self.idle -= 1
+                        return
+                continue
+            waited = time.monotonic() - queued_at
+            with self._lock:
+                self.idle -= 1
+                # submit() may have counted this worker as idle; re-check the backlog now that it
+                # is busy, and grow early when connections are already waiting too long.
+                if not self.idle and self.threads < self.max_threads and (
+                        self.queue.qsize() or waited > WORKER_GROW_WAIT):
+                    self._spawn()
+            METRICS.observe("queue_wait_seconds", None, waited)
+            try:
+                handle_client(client_socket, client_address)
+            finally:
+                with self._lock:
+                    self.idle += 1
+                self.queue.task_done()
+
+WORKER_POOL = WorkerPool(task_queue, MIN_THREADS, MAX_THREADS, QUEUE_HIGH_WATER)
+
+def reject_busy(client_socket, client_address):
+    """Refuse a connection immediately with a retry hint instead of queueing it."""
+    METRICS.inc("connections_rejected_total")
+    log_message("Queue past high-water mark; refusing %s", "WARNING", client_address)
+    try:
+        client_socket.settimeout(1.0)
+        client_socket.sendall(json.dumps(
+            {"error": "Server busy, retry later.", "retry_after": BUSY_RETRY_AFTER}
+        ).encode('utf-8'))
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+def clean_exit(server_socket, ngrok_process):
+    """Clean up resources and stop network activities."""
+    log_message("Cleaning up resources...", "INFO")
+    if ngrok_process:
+        try:
+            if os.name == 'nt':
+                ngrok_process.send_signal(signal.CTRL_BREAK_EVENT)
+            else:
+                os.killpg(os.getpgid(ngrok_process.pid), signal.SIGTERM)
+            ngrok_process.wait(timeout=5)  # Wait for process to terminate
+            log_message("Ngrok process terminated.", "INFO")
+        except subprocess.TimeoutExpired:
+            log_message("Ngrok process did not terminate. Attempting force kill...", "WARNING")
+            try:
+                ngrok_process.kill()
+            except Exception as kill_exception:
+                log_message(f"Failed to kill ngrok process: {kill_exception}", "ERROR")
+    if RUN_POOL is not None:
+        RUN_POOL.close()
+        log_message("Interpreter pool stopped.", "INFO")
+    KERNELS.close()
+    PROFILER.stop()
+    if server_socket:
+        server_socket.close()
+        log_message("Server socket closed.", "INFO")
+
+SHARD_STARTUP_GRACE = 5.0   # a shard failing sooner than this after launch aborts the supervisor
+
+def run_shards(count):
+    """Supervise count shard processes that share HOST:PORT; any clean shard exit stops them all."""
+    log_message(f"Starting {count} shards on {HOST}:{PORT}...", "INFO")
+    store_dir = tempfile.mkdtemp(prefix="aegis-")
+    token_store = os.path.join(store_dir, "tokens.db")
+    SharedTokenStore(token_store, TOKEN_TTL, TOKEN_MAX_COUNT)  # create the schema before shards race to
+    shards = {}
+    ngrok_process = None
+    # One admin endpoint for all shards: ADMIN_PORT here, private sockets in store_dir (mode 0700).
+    admin_sockets = [os.path.join(store_dir, f"admin{index}.sock") for index in range(count)]
+    start_admin_channel(lambda line: shard_admin_command(admin_sockets, line))
+
+    def spawn(index):
+        # RUN_POOL_SIZE is for the whole server: each shard warms its share of the interpreters.
+        env = dict(os.environ, AEGIS_TOKEN_STORE=token_store, AEGIS_LOG_FILE=f"server.shard{index}.log",
+                   AEGIS_AUDIT_NAME=f"shard{index}", AEGIS_RUN_POOL_SIZE=str(max(1, RUN_POOL_SIZE // count)))
+        if ADMIN_SECRET is not None:
+            env.update(AEGIS_ADMIN_SECRET=ADMIN_SECRET, AEGIS_ADMIN_SOCKET=admin_sockets[index])
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--shard", str(index)],
+            env=env, stdin=subprocess.DEVNULL
+        )
+        log_message(f"Shard {index} started (pid {process.pid}).", "INFO")
+        return process, time.monotonic()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: SHUTDOWN_EVENT.set())
+    try:
+        ngrok_process = start_ngrok()
+        for index in range(count):
+            shards[index] = spawn(index)
+        while not SHUTDOWN_EVENT.wait(0.5):
+            for index, (process, started) in list(shards.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                if code == 0:
+                    log_message(f"Shard {index} shut down; stopping all shards.", "INFO")
+                    SHUTDOWN_EVENT.set()
+                elif time.monotonic() - started < SHARD_STARTUP_GRACE:
+                    log_message(f"Shard {index} failed during startup (exit {code}); stopping all shards.", "ERROR")
+                    SHUTDOWN_EVENT.set()
+                else:
+                    log_message(f"Shard {index} exited with {code}; restarting it.", "WARNING")
+                    shards[index] = spawn(index)
+    except KeyboardInterrupt:
+        log_message("Interrupt received. Preparing to shut down.", "INFO")
+    finally:
+        for process, _ in shards.values():
+            if process.poll() is None:
+                process.terminate()
+        for process, _ in shards.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(store_dir, ignore_errors=True)
+        clean_exit(None, ngrok_process)
+
+def serve_shard(index):
+    """Entry point of one shard process started by run_shards."""
+    global AUTHORIZED_TOKENS, ADMIN_PORT, ADMIN_SOCKET, METRICS_PORT, RUN_POOL_SIZE
+    load_config()
+    RUN_POOL_SIZE = int(os.environ.get("AEGIS_RUN_POOL_SIZE", RUN_POOL_SIZE))
+    AUTHORIZED_TOKENS = SharedTokenStore(os.environ["AEGIS_TOKEN_STORE"], TOKEN_TTL, TOKEN_MAX_COUNT)
+    # The supervisor serves ADMIN_PORT; this shard answers it on its private socket, if any.
+    ADMIN_PORT = 0
+    ADMIN_SOCKET = os.environ.get("AEGIS_ADMIN_SOCKET")
+    # Each shard is its own metrics target: shard i uses METRICS_PORT + i.
+    if METRICS_PORT:
+        METRICS_PORT += index
+    signal.signal(signal.SIGTERM, lambda signum, frame: SHUTDOWN_EVENT.set())
+    start_server(shard=index)
+
+def start_server(shard=None):
+    """Launch the server and initialize the thread pool for client handling."""
+    global ADMIN_SECRET
+    STARTUP_TIMES["started"] = time.monotonic()
+    # Before anything is spawned, so no command process inherits the secret.
+    ADMIN_SECRET = os.environ.pop("AEGIS_ADMIN_SECRET", None) or ADMIN_SECRET
+    load_config()
+    if shard is None and SHARDS > 1:
+        if hasattr(socket, "SO_REUSEPORT"):
+            run_shards(SHARDS)
+            return
+        log_message("SO_REUSEPORT is not available on this platform; running a single process.", "WARNING")
+    label = f" (shard {shard})" if shard is not None else ""
+    log_message(f"Starting server on {HOST}:{PORT}{label}...", "INFO")
+    ngrok_process = None
+    server_socket = None
+
+    try:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if shard is not None:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((HOST, PORT))
+        server_socket.listen(LISTEN_BACKLOG)
+        server_socket.settimeout(1.0)  # Timeout chosen for responsiveness to interrupts
+        if shard is None:
+            ngrok_process = start_ngrok()  # Comes up in parallel; the supervisor owns it when sharded
+        # Warm the "run" interpreters without holding up the accept loop.
+        threading.Thread(target=get_interpreter_pool, name="aegis-run-warmup", daemon=True).start()
+        start_admin_channel()
+        start_metrics_endpoint()
+        STARTUP_TIMES["startup_seconds"] = round(time.monotonic() - STARTUP_TIMES["started"], 3)
+        log_message(f"Server is listening for connections ({SERVER_MODE} mode) "
+                    f"after {STARTUP_TIMES['startup_seconds']}s...", "INFO")
+
+        if SERVER_MODE == "asyncio":
+            asyncio.run(serve_asyncio(server_socket))
+            return
+
+        WORKER_POOL.start()
+
+        while not SHUTDOWN_EVENT.is_set():
+            try:
                 client_socket, client_address = server_socket.accept()
-                task_queue.put((client_socket, client_address))
+                METRICS.inc("connections_total")
+                if not WORKER_POOL.submit(client_socket, client_address):
+                    reject_busy(client_socket, client_address)
             except socket.timeout:
                 continue
 
@@ -471,6 +3953,23 @@ def start_server():
         clean_exit(server_socket, ngrok_process)
 
 if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "--shard":
+        serve_shard(int(sys.argv[2]))
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == "--audit":
+        # Offline query: python server.py --audit [dir=audit] [token=...] [since=...] [until=...] [limit=...]
+        filters = [arg for arg in sys.argv[2:] if not arg.startswith("dir=")]
+        for arg in sys.argv[2:]:
+            if arg.startswith("dir="):
+                AUDIT.configure(arg[len("dir="):])
+        try:
+            records = AUDIT.query(**parse_audit_query(filters))
+        except ValueError as e:
+            sys.exit(str(e))
+        for record in records:
+            print(json.dumps(record))
+        sys.exit(0)
     print_banner()  # Display ASCII logo and metadata
+    load_config()
     log_message("Server initialization...", "INFO")
     start_server()
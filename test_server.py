@@ -1,9 +1,20 @@
 import unittest
+import os
 import socket
 import json
+import struct
 import time
+import zlib
+import hashlib
 import logging
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
 from unittest.mock import patch
+from server import MsgpackCodec, TimeoutScheduler, is_cacheable_command, kill_process_group
 
 # Configure test logging
 TEST_LOG_FILENAME = "test_log.log"
@@ -16,20 +27,60 @@ logging.basicConfig(
 # Configuration for testing
 TEST_HOST = '127.0.0.1'
 TEST_PORT = 8080
+TEST_ADMIN_PORT = 8081
+# Start the server with the same AEGIS_ADMIN_SECRET in its environment.
+TEST_ADMIN_SECRET = os.environ.get("AEGIS_ADMIN_SECRET", "aegis-test-secret")
 # Our server SESSION_TIMEOUT is 60 seconds; tests use 60 seconds as well.
 SESSION_TIMEOUT = 60
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
 
 def log_test(message):
     logging.debug(message)
     print(message)  # also print to console, if desired
 
-class TestServer(unittest.TestCase):
+def start_server_process(directory, port, admin_port, **settings):
+    """Run server.py from directory with its own AEGIS.env; return the process once both ports accept connections."""
+    lines = ["ID=exampleexample", "NGROK_COMMAND=stub", f"PORT={port}", f"ADMIN_PORT={admin_port}"]
+    lines += [f"{key}={value}" for key, value in settings.items()]
+    with open(os.path.join(directory, "AEGIS.env"), "w") as env_file:
+        env_file.write("\n".join(lines) + "\n")
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT], cwd=directory, stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, AEGIS_ADMIN_SECRET=TEST_ADMIN_SECRET)
+    )
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError(f"Server in {directory} exited with {process.returncode}.")
+        try:
+            # The admin channel is bound after the client port, so wait for it too.
+            for listening_port in (port, admin_port):
+                socket.create_connection((TEST_HOST, listening_port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    stop_server_process(process)
+    raise RuntimeError(f"Server in {directory} did not start listening on ports {port} and {admin_port}.")
+
+def stop_server_process(process):
+    """Interrupt a server started by start_server_process and wait for its clean exit."""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+class ServerTestCase(unittest.TestCase):
+    """Connection and admin channel helpers for tests against a running server."""
     command_history = []  # records tuples (sent, received)
+    port = TEST_PORT
+    admin_port = TEST_ADMIN_PORT
 
     def setUp(self):
         """Setup a new connection to the server for each test."""
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((TEST_HOST, TEST_PORT))
+        self.client_socket.connect((TEST_HOST, self.port))
         log_test("Connected to server")
 
     def tearDown(self):
@@ -60,6 +111,41 @@ class TestServer(unittest.TestCase):
                 return {"error": "Invalid JSON in response"}
         return {}
 
+    def send_framed(self, data):
+        """Send one JSON message using the length-prefixed framing."""
+        body = json.dumps(data).encode('utf-8')
+        log_test(f"Sending framed command: {body.decode('utf-8')[:200]}")
+        self.client_socket.sendall(struct.pack("!I", len(body)) + body)
+
+    def recv_exact(self, size):
+        """Read exactly size bytes from the socket."""
+        chunks = b""
+        while len(chunks) < size:
+            chunk = self.client_socket.recv(size - len(chunks))
+            if not chunk:
+                raise ConnectionError("Connection closed while reading frame.")
+            chunks += chunk
+        return chunks
+
+    def recv_framed(self):
+        """Receive one length-prefixed JSON message, inflating it if the compressed bit is set."""
+        (length,) = struct.unpack("!I", self.recv_exact(4))
+        body = self.recv_exact(length & 0x7FFFFFFF)
+        if length & 0x80000000:
+            body = zlib.decompress(body)
+        decoded_response = body.decode('utf-8')
+        log_test(f"Received framed response: {decoded_response[:200]}")
+        return json.loads(decoded_response)
+
+    def framed_session(self):
+        """Authenticate with length-prefixed framing and return the session token."""
+        self.client_socket.sendall(json.dumps(
+            {"id": "Jarvis", "token": "invalid_token", "framing": "length"}
+        ).encode('utf-8'))
+        auth_response = self.recv_framed()
+        self.assertEqual(auth_response.get("framing"), "length")
+        return auth_response["new_token"]
+
     @classmethod
     def tearDownClass(cls):
         """After all tests, write a summary to the test log."""
@@ -69,6 +155,36 @@ class TestServer(unittest.TestCase):
         summary = "\n".join(summary_lines)
         log_test(summary)
 
+    def admin_command(self, line, secret=TEST_ADMIN_SECRET):
+        """Send one command over the local admin channel and return its reply."""
+        with socket.create_connection((TEST_HOST, self.admin_port)) as admin:
+            admin.sendall(f"auth {secret}\n{line}\n".encode('utf-8'))
+            admin.shutdown(socket.SHUT_WR)
+            greeting, _, reply = admin.makefile("r", encoding="utf-8").read().partition("\n")
+        if greeting != "Authenticated.":
+            reply = greeting
+        reply = reply.strip()
+        log_test(f"Admin '{line}' -> {reply}")
+        return reply
+
+    def decide_legacy(self, token, command, action):
+        """Park command on a legacy session, decide it over the admin channel and collect the result."""
+        pending = self.send_and_receive({"id": "Jarvis", "token": token, "command": command})
+        self.assertEqual(pending.get("status"), "pending")
+        approval_id = pending["approval_id"]
+        self.assertTrue(self.admin_command(f"{action} {approval_id}").endswith(f" {approval_id}."))
+        poll = {"id": "Jarvis", "token": token, "command": "approval", "approval_id": approval_id}
+        for _ in range(100):
+            response = self.send_and_receive(poll)
+            if response.get("status") not in ("pending", "running"):
+                self.assertEqual(response["approval_id"], approval_id)
+                # A result is handed out once.
+                self.assertEqual(self.send_and_receive(poll), {"error": "Unknown approval id."})
+                return response
+            time.sleep(0.05)
+        self.fail(f"Approval {approval_id} never produced a result.")
+
+class TestServer(ServerTestCase):
     def test_invalid_json(self):
         """Test the server response to invalid JSON data."""
         self.client_socket.sendall(b"Invalid JSON")
@@ -109,6 +225,59 @@ class TestServer(unittest.TestCase):
         # The echo output may have trailing newline characters
         self.assertEqual(response["output"].strip(), "Hello")
 
+    def test_command_timeout_kills_process_group(self):
+        """Test that a command past its deadline is killed with its children and returns partial output."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        started = time.monotonic()
+        response = self.send_and_receive({
+            "id": "Jarvis", "token": token, "command": "echo started; sleep 30 & sleep 30", "timeout": 0.5
+        })
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(response["output"].strip(), "started")
+        self.assertTrue(response["timed_out"])
+        self.assertLess(response["exit_status"], 0)
+        invalid = self.send_and_receive({"id": "Jarvis", "token": token, "command": "echo hi", "timeout": -1})
+        self.assertIn("error", invalid)
+
+    def test_stream_disconnect_kills_pipeline(self):
+        """Test that a client leaving mid-stream stops every process of the command's pipeline."""
+        marker = f"aegis-pipeline-{os.getpid()}-{time.monotonic_ns()}"
+        token = self.framed_session()
+        self.send_framed({"id": "Jarvis", "token": token, "command": f"yes {marker} | cat", "stream": True})
+        self.assertEqual(self.recv_framed()["stream"], "stdout")
+        self.client_socket.close()
+
+        def pipeline_alive():
+            for pid in filter(str.isdigit, os.listdir("/proc")):
+                try:
+                    with open(f"/proc/{pid}/cmdline", "rb") as cmdline:
+                        if marker.encode() in cmdline.read():
+                            return True
+                except OSError:
+                    pass
+            return False
+
+        for _ in range(50):
+            if not pipeline_alive():
+                break
+            time.sleep(0.1)
+        self.assertFalse(pipeline_alive())
+
+    def test_command_rlimits_applied(self):
+        """Test that commands and the processes they fork run under the default CPU and process limits."""
+        import resource  # POSIX only, like the limits themselves
+        hard = resource.getrlimit(resource.RLIMIT_NPROC)[1]
+        nproc = 4096 if hard == resource.RLIM_INFINITY else min(4096, hard)
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        # The subshell and the interpreter are forked by the command's shell, so they only
+        # see the limits if the shell applied them before it ran anything.
+        command = (f"(ulimit -t); ulimit -v; {sys.executable} -c "
+                   "'import resource; print(resource.getrlimit(resource.RLIMIT_NPROC)[0])'")
+        response = self.send_and_receive({"id": "Jarvis", "token": token, "command": command})
+        self.assertEqual(response["output"].split(), ["300", "unlimited", str(nproc)])
+
     def test_hows_alive_command(self):
         """Test that the 'hows alive' command returns the server uptime."""
         auth_data = {"id": "Jarvis", "token": "invalid_token"}
@@ -119,6 +288,47 @@ class TestServer(unittest.TestCase):
         self.assertIn("uptime", response)
         self.assertTrue(isinstance(response["uptime"], str))
 
+    def test_stats_command(self):
+        """Test that the 'stats' command reports request counters, gauges and latency percentiles."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        self.send_and_receive({"id": "Jarvis", "token": token, "command": "echo metrics"})
+        stats = self.send_and_receive({"id": "Jarvis", "token": token, "command": "stats"})
+        self.assertGreaterEqual(stats["counters"]["requests_total"]["shell"], 1)
+        self.assertGreaterEqual(stats["gauges"]["active_sessions"], 1)
+        self.assertIn("queue_depth", stats["gauges"])
+        shell_latency = stats["latency"]["request_seconds"]["shell"]
+        self.assertGreaterEqual(shell_latency["count"], 1)
+        self.assertIsNotNone(shell_latency["p99"])
+        self.assertIn("auth", stats["latency"]["request_seconds"])
+
+    def test_worker_pool_grows_under_load(self):
+        """Test that more concurrent sessions than the minimum pool size are all served."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        self.assertIn("new_token", auth_response)
+        others = []
+        try:
+            for _ in range(6):
+                other = socket.create_connection((TEST_HOST, self.port))
+                other.settimeout(5)
+                others.append(other)
+                other.sendall(json.dumps({"id": "Jarvis", "token": "invalid_token"}).encode('utf-8'))
+            for other in others:
+                self.assertIn("new_token", json.loads(other.recv(4096).decode('utf-8')))
+            stats = self.send_and_receive({"id": "Jarvis", "token": auth_response["new_token"], "command": "stats"})
+            self.assertGreaterEqual(stats["gauges"]["active_sessions"], 7)
+        finally:
+            for other in others:
+                other.close()
+
+    def test_startup_time_reported(self):
+        """Test that the time from launch to accepting connections is reported as a metric."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        stats = self.send_and_receive({"id": "Jarvis", "token": auth_response["new_token"], "command": "stats"})
+        self.assertIsInstance(stats["gauges"]["startup_seconds"], float)
+        # The tunnel starts in parallel and must not hold up the listener.
+        self.assertLess(stats["gauges"]["startup_seconds"], 5)
+
     def test_exit_command(self):
         """Test that the 'exit' command closes the connection."""
         auth_data = {"id": "Jarvis", "token": "invalid_token"}
@@ -165,6 +375,24 @@ class TestServer(unittest.TestCase):
         self.assertIn("output", response)
         self.assertEqual(response["output"].strip(), "Hello from run")
 
+    def test_run_kernel_keeps_namespace(self):
+        """Test that 'run' with a kernel keeps globals between snippets until reset."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        request = {"id": "Jarvis", "token": token, "command": "run", "kernel": True}
+        first = self.send_and_receive(dict(request, code="import math\ntotal = 40"))
+        self.assertEqual(first["kernel"]["runs"], 1)
+        second = self.send_and_receive(dict(request, code="print(total + 2, math.floor(2.5))"))
+        self.assertEqual(second["output"].strip(), "42 2")
+        self.assertGreater(second["kernel"]["memory"], 0)
+        reset = self.send_and_receive(dict(request, reset=True))
+        self.assertEqual(reset["kernel"]["runs"], 0)
+        after = self.send_and_receive(dict(request, code="print(total)"))
+        self.assertIn("total", after["output"])
+        # Plain 'run' still starts from an empty namespace.
+        plain = self.send_and_receive({"id": "Jarvis", "token": token, "command": "run", "code": "print('total' in dir())"})
+        self.assertEqual(plain["output"].strip(), "False")
+
     def test_rce_vulnerability(self):
         """Test to see if arbitrary code execution can read server files (RCE).
            This simulates an attacker trying to bypass restrictions.
@@ -187,18 +415,15 @@ class TestServer(unittest.TestCase):
         # Even if the command succeeds, note that allowing arbitrary directory listing may be undesirable.
         self.assertTrue("Files:" in response["output"])
 
-    @patch('server.ADMIN_APPROVAL_FUNC', lambda prompt: "n")
     def test_dangerous_command_denied(self):
         """Test that a dangerous command is denied when admin does not approve."""
         auth_data = {"id": "Jarvis", "token": "invalid_token"}
         auth_response = self.send_and_receive(auth_data)
         token = auth_response.get("new_token")
-        dangerous_data = {"id": "Jarvis", "token": token, "command": "rm -rf /dummy"}
-        response = self.send_and_receive(dangerous_data)
+        response = self.decide_legacy(token, "rm -rf /dummy", "deny")
         self.assertIn("error", response)
         self.assertEqual(response["error"], "Dangerous command execution denied by admin.")
 
-    @patch('server.ADMIN_APPROVAL_FUNC', lambda prompt: "y")
     def test_dangerous_command_approved(self):
         """Test that a dangerous command is executed when admin approves.
            Note: We use a harmless command containing the dangerous keyword.
@@ -206,15 +431,23 @@ class TestServer(unittest.TestCase):
         auth_data = {"id": "Jarvis", "token": "invalid_token"}
         auth_response = self.send_and_receive(auth_data)
         token = auth_response.get("new_token")
-        dangerous_data = {
-            "id": "Jarvis",
-            "token": token,
-            "command": "echo rm -rf approved"
-        }
-        response = self.send_and_receive(dangerous_data)
+        response = self.decide_legacy(token, "echo rm -rf approved", "approve")
         self.assertIn("output", response)
         self.assertIn("rm -rf approved", response["output"])
 
+    def test_legacy_session_usable_while_approval_pending(self):
+        """Test that a parked command does not hold a legacy session and is reported pending until decided."""
+        token = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"}).get("new_token")
+        pending = self.send_and_receive({"id": "Jarvis", "token": token, "command": "rm -rf /dummy"})
+        approval_id = pending["approval_id"]
+        try:
+            response = self.send_and_receive({"id": "Jarvis", "token": token, "command": "echo still here"})
+            self.assertEqual(response["output"].strip(), "still here")
+            poll = {"id": "Jarvis", "token": token, "command": "approval", "approval_id": approval_id}
+            self.assertEqual(self.send_and_receive(poll), {"approval_id": approval_id, "status": "pending"})
+        finally:
+            self.admin_command(f"deny {approval_id}")
+
     def test_bypass_attempt(self):
         """Simulate an attempt to bypass authentication by sending extra fields."""
         # Even if additional fields are sent or the command is modified,
@@ -227,15 +460,513 @@ class TestServer(unittest.TestCase):
         auth_response = self.send_and_receive(auth_data)
         token = auth_response.get("new_token")
         # Try to bypass dangerous command approval by appending a benign command to a dangerous one
-        bypass_data = {
-            "id": "Jarvis",
-            "token": token,
-            "command": "rm -rf /dummy && echo bypass"
-        }
-        response = self.send_and_receive(bypass_data)
+        response = self.decide_legacy(token, "rm -rf /dummy && echo bypass", "deny")
         # With admin approval required, the dangerous part should trigger denial if not approved.
         self.assertIn("error", response)
         self.assertEqual(response["error"], "Dangerous command execution denied by admin.")
 
+    def test_framed_pipelined_commands(self):
+        """Test that several framed commands sent back-to-back each get their own response."""
+        token = self.framed_session()
+        payload = b""
+        for word in ("one", "two", "three"):
+            body = json.dumps({"id": "Jarvis", "token": token, "command": f"echo {word}"}).encode('utf-8')
+            payload += struct.pack("!I", len(body)) + body
+        self.client_socket.sendall(payload)
+        outputs = [self.recv_framed()["output"].strip() for _ in range(3)]
+        self.assertEqual(outputs, ["one", "two", "three"])
+
+    def test_framed_large_run_payload(self):
+        """Test that a run payload larger than one recv buffer arrives intact."""
+        token = self.framed_session()
+        code = "data = '" + "x" * 200000 + "'\nprint(len(data))"
+        self.send_framed({"id": "Jarvis", "token": token, "command": "run", "code": code})
+        response = self.recv_framed()
+        self.assertEqual(response["output"].strip(), "200000")
+
+    def test_streamed_command_output(self):
+        """Test that a streamed command delivers sequenced chunks and a final exit status."""
+        token = self.framed_session()
+        self.send_framed({
+            "id": "Jarvis",
+            "token": token,
+            "command": "echo streamed-out; echo streamed-err 1>&2; exit 3",
+            "stream": True
+        })
+        chunks = {"stdout": "", "stderr": ""}
+        expected_seq = 0
+        while True:
+            message = self.recv_framed()
+            self.assertEqual(message["seq"], expected_seq)
+            expected_seq += 1
+            if message.get("done"):
+                break
+            chunks[message["stream"]] += message["data"]
+        self.assertEqual(message["exit_status"], 3)
+        self.assertEqual(chunks["stdout"].strip(), "streamed-out")
+        self.assertEqual(chunks["stderr"].strip(), "streamed-err")
+
+    def test_cd_is_isolated_per_session(self):
+        """Test that 'cd' changes only the calling session's working directory."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        response = self.send_and_receive({"id": "Jarvis", "token": token, "command": "cd /"})
+        self.assertEqual(response["output"], "Changed directory to " + os.path.abspath("/"))
+        response = self.send_and_receive({"id": "Jarvis", "token": token, "command": "pwd"})
+        self.assertEqual(response["output"].strip(), os.path.abspath("/"))
+
+        other = socket.create_connection((TEST_HOST, self.port))
+        try:
+            other.sendall(json.dumps({"id": "Jarvis", "token": "invalid_token"}).encode('utf-8'))
+            other_token = json.loads(other.recv(4096).decode('utf-8'))["new_token"]
+            other.sendall(json.dumps({"id": "Jarvis", "token": other_token, "command": "pwd"}).encode('utf-8'))
+            other_output = json.loads(other.recv(4096).decode('utf-8'))["output"]
+        finally:
+            other.close()
+        self.assertNotEqual(other_output.strip(), os.path.abspath("/"))
+
+    def test_persistent_shell_keeps_state(self):
+        """Test that a persistent shell keeps environment variables and cwd between commands."""
+        auth_data = {"id": "Jarvis", "token": "invalid_token", "persistent_shell": True}
+        auth_response = self.send_and_receive(auth_data)
+        token = auth_response.get("new_token")
+        self.send_and_receive({"id": "Jarvis", "token": token, "command": "export AEGIS_TEST_VAR=kept"})
+        self.send_and_receive({"id": "Jarvis", "token": token, "command": "cd /"})
+        response = self.send_and_receive({"id": "Jarvis", "token": token, "command": "echo $AEGIS_TEST_VAR; pwd"})
+        self.assertEqual(response["output"].split(), ["kept", "/"])
+        # A syntax error must not lose the shell's state.
+        self.send_and_receive({"id": "Jarvis", "token": token, "command": "if"})
+        response = self.send_and_receive({"id": "Jarvis", "token": token, "command": "echo $AEGIS_TEST_VAR"})
+        self.assertEqual(response["output"].strip(), "kept")
+
+    def test_persistent_shell_cd_does_not_run_commands(self):
+        """Test that text after a 'cd' path is not executed by a persistent shell."""
+        victim = tempfile.mkdtemp(prefix="aegis-cd-test-")
+        try:
+            auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token", "persistent_shell": True})
+            token = auth_response.get("new_token")
+            response = self.send_and_receive({"id": "Jarvis", "token": token, "command": f"cd /tmp; rm -rf {victim}"})
+            self.assertTrue(response["output"].startswith("Failed to change directory"), response)
+            self.assertTrue(os.path.isdir(victim))
+            self.send_and_receive({"id": "Jarvis", "token": token, "command": "cd ~"})
+            response = self.send_and_receive({"id": "Jarvis", "token": token, "command": "pwd"})
+            self.assertEqual(response["output"].strip(), os.path.expanduser("~"))
+        finally:
+            shutil.rmtree(victim, ignore_errors=True)
+
+    def test_concurrent_run_output_is_isolated(self):
+        """Test that overlapping 'run' requests from two sessions do not mix their output."""
+        code = (
+            "import time\n"
+            "for _ in range(5):\n"
+            "    print('{marker}')\n"
+            "    time.sleep(0.05)\n"
+        )
+        sessions = []
+        for marker in ("first", "second"):
+            conn = socket.create_connection((TEST_HOST, self.port))
+            conn.sendall(json.dumps({"id": "Jarvis", "token": "invalid_token"}).encode('utf-8'))
+            token = json.loads(conn.recv(4096).decode('utf-8'))["new_token"]
+            sessions.append((conn, token, marker))
+        try:
+            for conn, token, marker in sessions:
+                conn.sendall(json.dumps({
+                    "id": "Jarvis", "token": token, "command": "run", "code": code.format(marker=marker)
+                }).encode('utf-8'))
+            for conn, token, marker in sessions:
+                output = json.loads(conn.recv(4096).decode('utf-8'))["output"]
+                self.assertEqual(output.split(), [marker] * 5)
+        finally:
+            for conn, _, _ in sessions:
+                conn.close()
+
+    def test_admin_channel_requires_secret(self):
+        """Test that the admin channel refuses commands without the secret and that commands cannot read it."""
+        self.assertEqual(self.admin_command("list", secret="wrong"), "Authentication required.")
+        token = self.framed_session()
+        self.send_framed({"id": "Jarvis", "token": token, "command": "env"})
+        output = self.recv_framed()["output"]
+        self.assertNotIn("AEGIS_ADMIN_SECRET", output)
+        self.assertNotIn(TEST_ADMIN_SECRET, output)
+
+    def test_dangerous_command_denied_via_admin_channel(self):
+        """Test that a parked dangerous command is denied through the admin channel."""
+        token = self.framed_session()
+        self.send_framed({"id": "Jarvis", "token": token, "command": "rm -rf /dummy"})
+        pending = self.recv_framed()
+        self.assertEqual(pending.get("status"), "pending")
+        approval_id = pending["approval_id"]
+        # The session stays usable while the command waits for a decision.
+        self.send_framed({"id": "Jarvis", "token": token, "command": "hows alive"})
+        self.assertIn("uptime", self.recv_framed())
+        self.assertEqual(self.admin_command(f"deny {approval_id}"), f"Denied {approval_id}.")
+        result = self.recv_framed()
+        self.assertEqual(result["approval_id"], approval_id)
+        self.assertEqual(result["error"], "Dangerous command execution denied by admin.")
+
+    def test_dangerous_command_approved_via_admin_channel(self):
+        """Test that a parked dangerous command runs once approved through the admin channel."""
+        token = self.framed_session()
+        self.send_framed({"id": "Jarvis", "token": token, "command": "echo rm -rf approved"})
+        approval_id = self.recv_framed()["approval_id"]
+        self.assertIn(approval_id, self.admin_command("list"))
+        self.assertEqual(self.admin_command(f"approve {approval_id}"), f"Approved {approval_id}.")
+        result = self.recv_framed()
+        self.assertEqual(result["approval_id"], approval_id)
+        self.assertIn("rm -rf approved", result["output"])
+
+    def test_audit_query_by_token(self):
+        """Test that each command leaves a structured audit record that the admin channel can query by token."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        self.send_and_receive({"id": "Jarvis", "token": token, "command": "echo audited"})
+        reply = self.admin_command(f"audit token={token} since={time.time() - 60} limit=1")
+        if reply == "No matching audit records.":
+            # The record is queued just after the reply is sent.
+            time.sleep(0.2)
+            reply = self.admin_command(f"audit token={token} limit=1")
+        record = json.loads(reply)
+        self.assertEqual((record["kind"], record["command"]), ("shell", "echo audited"))
+        self.assertEqual((record["exit_status"], record["output_bytes"]), (0, len("audited\n")))
+        self.assertNotIn(token, reply)
+        self.assertEqual(self.admin_command(f"audit token=unknown{token}"), "No matching audit records.")
+
+    def test_profiling_window_writes_report(self):
+        """Test that an admin profiling window covers requests and writes a report when stopped."""
+        self.assertTrue(self.admin_command("profile start seconds=30 memory").startswith("Profiling:"))
+        try:
+            auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+            token = auth_response.get("new_token")
+            self.send_and_receive({"id": "Jarvis", "token": token, "command": "echo profiled"})
+        finally:
+            reply = self.admin_command("profile stop")
+        self.assertTrue(reply.startswith("Profile report written to "))
+        path = reply[len("Profile report written to "):-1]
+        try:
+            with open(path, encoding="utf-8") as report:
+                text = report.read()
+            self.assertIn("shell", text)
+            self.assertIn("dispatch_request", text)
+            self.assertIn("tracemalloc", text)
+        finally:
+            os.remove(path)
+            os.remove(path[:-len(".txt")] + ".prof")
+        self.assertEqual(self.admin_command("profile status"), "Profiling is off.")
+
+    def test_dangerous_command_obfuscated(self):
+        """Test that extra whitespace and shell quoting do not hide a dangerous command."""
+        token = self.framed_session()
+        self.send_framed({"id": "Jarvis", "token": token, "command": "r''m  -r\"f\" /dummy"})
+        pending = self.recv_framed()
+        self.assertEqual(pending.get("status"), "pending")
+        self.admin_command(f"deny {pending['approval_id']}")
+        result = self.recv_framed()
+        self.assertEqual(result["error"], "Dangerous command execution denied by admin.")
+
+    def test_token_reuse_on_reconnect(self):
+        """Test that a token issued earlier is accepted again on a new connection."""
+        token = self.framed_session()
+        self.client_socket.close()
+        self.client_socket = socket.create_connection((TEST_HOST, self.port))
+        self.client_socket.sendall(json.dumps(
+            {"id": "Jarvis", "token": token, "framing": "length"}
+        ).encode('utf-8'))
+        response = self.recv_framed()
+        self.assertEqual(response.get("token"), token)
+        self.assertNotIn("new_token", response)
+
+    def test_batch_collected_results(self):
+        """Test that a batch runs its commands concurrently and returns results keyed by id."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        batch_data = {
+            "id": "Jarvis",
+            "token": token,
+            "command": "batch",
+            "commands": [
+                {"id": "a", "command": "sleep 0.5; echo first"},
+                {"id": "b", "command": "sleep 0.5; echo second"},
+                {"id": "c", "command": "sleep 0.5; exit 2"}
+            ]
+        }
+        started = time.time()
+        response = self.send_and_receive(batch_data)
+        self.assertLess(time.time() - started, 1.4)
+        results = response["results"]
+        self.assertEqual(results["a"]["output"].strip(), "first")
+        self.assertEqual(results["b"]["output"].strip(), "second")
+        self.assertEqual(results["c"]["exit_status"], 2)
+        # 1 and "1" would share a result key, so they count as duplicates.
+        batch_data["commands"] = [{"id": 1, "command": "echo one"}, {"id": "1", "command": "echo two"}]
+        self.assertIn("error", self.send_and_receive(batch_data))
+
+    def test_batch_streamed_results(self):
+        """Test that a streamed batch sends each result as it finishes, then a completion message."""
+        token = self.framed_session()
+        self.send_framed({
+            "id": "Jarvis",
+            "token": token,
+            "command": "batch",
+            "stream": True,
+            "concurrency": 2,
+            "commands": [
+                {"id": 1, "command": "sleep 0.4; echo slow"},
+                {"id": 2, "command": "echo fast"}
+            ]
+        })
+        first = self.recv_framed()
+        second = self.recv_framed()
+        done = self.recv_framed()
+        self.assertEqual((first["batch_item"], first["output"].strip()), (2, "fast"))
+        self.assertEqual((second["batch_item"], second["output"].strip()), (1, "slow"))
+        self.assertEqual(done, {"batch_done": True, "count": 2})
+
+    def test_channels_run_concurrently_and_cancel(self):
+        """Test that channel-tagged commands overlap on one connection and one channel can be cancelled."""
+        self.client_socket.sendall(json.dumps(
+            {"id": "Jarvis", "token": "invalid_token", "framing": "length", "channels": True}
+        ).encode('utf-8'))
+        auth_response = self.recv_framed()
+        self.assertTrue(auth_response["channels"])
+        token = auth_response["new_token"]
+        self.send_framed({"id": "Jarvis", "token": token, "command": "echo slow; sleep 30", "channel": 1})
+        self.send_framed({"id": "Jarvis", "token": token, "command": "echo fast", "channel": 2})
+        self.assertEqual(self.recv_framed(), {"output": "fast\n", "channel": 2})
+        time.sleep(0.2)
+        self.send_framed({"id": "Jarvis", "token": token, "command": "cancel", "channel": 1})
+        ack = self.recv_framed()
+        self.assertEqual((ack["channel"], ack["cancelled"], ack["stopped"]), (1, True, 1))
+        cancelled = self.recv_framed()
+        self.assertEqual(cancelled, {"output": "slow\n", "channel": 1, "cancelled": True})
+        # Untagged requests still work on the same connection.
+        self.send_framed({"id": "Jarvis", "token": token, "command": "echo plain"})
+        self.assertEqual(self.recv_framed(), {"output": "plain\n"})
+
+    def test_msgpack_codec_carries_raw_bytes(self):
+        """Test that a msgpack session returns command output as exact bytes, including invalid UTF-8."""
+        codec = MsgpackCodec()
+        self.client_socket.sendall(json.dumps(
+            {"id": "Jarvis", "token": "invalid_token", "framing": "length", "codec": "msgpack"}
+        ).encode('utf-8'))
+        (length,) = struct.unpack("!I", self.recv_exact(4))
+        auth_response = codec.decode(self.recv_exact(length))
+        self.assertEqual(auth_response["codec"], "msgpack")
+        body = codec.encode({"id": "Jarvis", "token": auth_response["new_token"], "command": "printf '\\377\\000ok'"})
+        self.client_socket.sendall(struct.pack("!I", len(body)) + body)
+        (length,) = struct.unpack("!I", self.recv_exact(4))
+        response = codec.decode(self.recv_exact(length))
+        self.assertEqual(response["output"], b"\xff\x00ok")
+
+    def test_compressed_large_response(self):
+        """Test that a zlib session gets large outputs as compressed frames and per-session savings in stats."""
+        self.client_socket.sendall(json.dumps(
+            {"id": "Jarvis", "token": "invalid_token", "framing": "length", "compression": "zlib"}
+        ).encode('utf-8'))
+        auth_response = self.recv_framed()
+        self.assertEqual(auth_response["compression"], "zlib")
+        token = auth_response["new_token"]
+        self.send_framed({"id": "Jarvis", "token": token, "command": "seq 1 20000"})
+        (header,) = struct.unpack("!I", self.recv_exact(4))
+        self.assertTrue(header & 0x80000000)
+        response = json.loads(zlib.decompress(self.recv_exact(header & 0x7FFFFFFF)))
+        self.assertEqual(response["output"].split()[-1], "20000")
+        self.send_framed({"id": "Jarvis", "token": token, "command": "echo small"})
+        self.assertEqual(self.recv_framed()["output"], "small\n")
+        self.send_framed({"id": "Jarvis", "token": token, "command": "stats"})
+        compression = self.recv_framed()["session"]["compression"]
+        # Only the large output crossed the threshold; the small reply went out as-is.
+        self.assertEqual(compression["frames"], 1)
+        self.assertGreater(compression["bytes_saved"], 0)
+
+    def test_file_upload_resume_and_ranged_download(self):
+        """Test put_file in two resumed parts, then get_file of a byte range with a checksum."""
+        token = self.framed_session()
+        content = os.urandom(300000)
+        name = f"/tmp/aegis_file_test_{time.time_ns()}.bin"
+        try:
+            for offset, part in ((0, content[:100000]), (100000, content[100000:])):
+                self.send_framed({"id": "Jarvis", "token": token, "command": "put_file", "path": name,
+                                  "offset": offset, "length": len(part), "checksum": "sha256",
+                                  "digest": hashlib.sha256(part).hexdigest()})
+                self.client_socket.sendall(part)
+                response = self.recv_framed()
+                self.assertNotIn("error", response)
+                self.assertEqual((response["written"], response["size"]), (len(part), offset + len(part)))
+            with open(name, "rb") as handle:
+                self.assertEqual(handle.read(), content)
+
+            self.send_framed({"id": "Jarvis", "token": token, "command": "get_file", "path": name,
+                              "offset": 1000, "length": 50000, "checksum": "sha256"})
+            header = self.recv_framed()
+            self.assertEqual((header["size"], header["offset"], header["length"]), (300000, 1000, 50000))
+            data = self.recv_exact(header["length"])
+            self.assertEqual(data, content[1000:51000])
+            self.assertEqual(header["checksum"]["digest"], hashlib.sha256(data).hexdigest())
+            # The session keeps working after the raw bytes.
+            self.send_framed({"id": "Jarvis", "token": token, "command": "echo after"})
+            self.assertEqual(self.recv_framed()["output"], "after\n")
+        finally:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_cacheable_commands_are_read_only(self):
+        """Test that git forms with side effects are kept out of the result cache."""
+        for command in ("git status", "git log --oneline -5", "git diff HEAD~1", "git branch", "git branch -a -v"):
+            self.assertTrue(is_cacheable_command(command), command)
+        for command in ("git branch newbranch", "git branch -D main", "git branch -m old new",
+                        "git diff --output=/tmp/x", "git log --output /tmp/y", "git log --outp=/tmp/y"):
+            self.assertFalse(is_cacheable_command(command), command)
+
+    def test_timeout_scheduler_fires_in_deadline_order(self):
+        """Test that the heap scheduler fires callbacks by deadline, not by scheduling order, and skips cancelled ones."""
+        scheduler = TimeoutScheduler()
+        fired = []
+        done = threading.Event()
+        now = time.monotonic()
+        scheduler.schedule(now + 0.4, lambda: (fired.append("last"), done.set()))
+        scheduler.schedule(now + 0.2, lambda: fired.append("second"))
+        cancelled = scheduler.schedule(now + 0.1, lambda: fired.append("cancelled"))
+        scheduler.schedule(now + 0.3, lambda: fired.append("third"))
+        # A new earliest deadline must wake the scheduler thread, which is already waiting on the old head.
+        time.sleep(0.02)
+        scheduler.schedule(now + 0.05, lambda: fired.append("first"))
+        scheduler.cancel(cancelled)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(fired, ["first", "second", "third", "last"])
+
+    def test_kill_skips_reaped_process_group(self):
+        """Test that a process group is not signalled once its leader was reaped, as its id may be reused."""
+        process = subprocess.Popen(["sleep", "60"], start_new_session=True)
+        with patch("server.os.killpg") as killpg:
+            kill_process_group(process)
+            killpg.assert_called_once_with(process.pid, signal.SIGKILL)
+        process.kill()
+        process.wait()
+        with patch("server.os.killpg") as killpg:
+            kill_process_group(process)
+            killpg.assert_not_called()
+
+    def test_cached_read_only_command(self):
+        """Test that an opted-in read-only command is served from cache until a watched path changes."""
+        auth_response = self.send_and_receive({"id": "Jarvis", "token": "invalid_token"})
+        token = auth_response.get("new_token")
+        marker = f"aegis_cache_test_{time.time_ns()}.txt"
+        path = os.path.join("/tmp", marker)
+        with open(path, "w") as handle:
+            handle.write("one")
+        try:
+            self.send_and_receive({"id": "Jarvis", "token": token, "command": "cd /tmp"})
+            request = {"id": "Jarvis", "token": token, "command": f"cat {marker}", "cache": True, "watch": [marker]}
+            first = self.send_and_receive(request)
+            second = self.send_and_receive(request)
+            self.assertEqual((first["output"], first["cached"]), ("one", False))
+            self.assertEqual((second["output"], second["cached"]), ("one", True))
+            time.sleep(0.01)
+            with open(path, "w") as handle:
+                handle.write("two")
+            third = self.send_and_receive(request)
+            self.assertEqual((third["output"], third["cached"]), ("two", False))
+            # Commands outside the allowlist are never cached.
+            uncached = self.send_and_receive({"id": "Jarvis", "token": token, "command": "date", "cache": True})
+            self.assertFalse(uncached["cached"])
+        finally:
+            os.remove(path)
+
+class TestAsyncioServer(TestServer):
+    """The TestServer suite again, against a server of its own running the asyncio engine."""
+    port = TEST_PORT + 200
+    admin_port = TEST_ADMIN_PORT + 200
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix="aegis-test-")
+        cls.server = start_server_process(cls.directory, cls.port, cls.admin_port, SERVER_MODE="asyncio")
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server_process(cls.server)
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        super().tearDownClass()
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "Sharding needs SO_REUSEPORT.")
+class TestShardedServer(ServerTestCase):
+    """Tests against a supervisor with two shards, started on ports of its own."""
+    port = TEST_PORT + 100
+    admin_port = TEST_ADMIN_PORT + 100
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix="aegis-test-")
+        cls.server = start_server_process(cls.directory, cls.port, cls.admin_port, SHARDS=2, RUN_POOL_SIZE=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server_process(cls.server)
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        super().tearDownClass()
+
+    def shard_pid(self, token):
+        """Run a command in this session and return the pid of the shard serving it."""
+        self.send_framed({"id": "Jarvis", "token": token, "command": "echo $PPID"})
+        return self.recv_framed()["output"].strip()
+
+    def test_run_pool_split_across_shards(self):
+        """Test that each shard warms its share of RUN_POOL_SIZE interpreters, not the whole pool."""
+        token = self.framed_session()
+        stats = {"id": "Jarvis", "token": token, "command": "stats"}
+        for _ in range(100):
+            self.send_framed(stats)
+            if self.recv_framed()["gauges"]["run_pool_idle"] >= 2:
+                break
+            time.sleep(0.1)
+        time.sleep(0.5)
+        self.send_framed(stats)
+        self.assertEqual(self.recv_framed()["gauges"]["run_pool_idle"], 2)
+
+    def test_token_accepted_by_every_shard(self):
+        """Test that a token issued by one shard is accepted on connections served by the other."""
+        token = self.framed_session()
+        pids = {self.shard_pid(token)}
+        for _ in range(30):
+            self.client_socket.close()
+            self.client_socket = socket.create_connection((TEST_HOST, self.port))
+            self.client_socket.sendall(json.dumps(
+                {"id": "Jarvis", "token": token, "framing": "length"}
+            ).encode('utf-8'))
+            response = self.recv_framed()
+            self.assertEqual(response.get("token"), token)
+            self.assertNotIn("new_token", response)
+            pids.add(self.shard_pid(token))
+            if len(pids) == 2:
+                break
+        self.assertEqual(len(pids), 2)
+
+    def test_admin_channel_reaches_every_shard(self):
+        """Test that the supervisor's admin port lists and decides approvals parked on either shard."""
+        sessions = {}
+        self.client_socket.close()
+        try:
+            for _ in range(30):
+                self.client_socket = socket.create_connection((TEST_HOST, self.port))
+                token = self.framed_session()
+                pid = self.shard_pid(token)
+                if pid in sessions:
+                    self.client_socket.close()
+                    continue
+                self.send_framed({"id": "Jarvis", "token": token, "command": f"echo rm -rf {pid}"})
+                sessions[pid] = (self.client_socket, self.recv_framed()["approval_id"])
+                if len(sessions) == 2:
+                    break
+            self.assertEqual(len(sessions), 2)
+            listing = self.admin_command("list")
+            for connection, approval_id in sessions.values():
+                self.assertIn(approval_id, listing)
+                self.assertEqual(self.admin_command(f"deny {approval_id}"), f"Denied {approval_id}.")
+                self.client_socket = connection
+                self.assertEqual(self.recv_framed()["error"], "Dangerous command execution denied by admin.")
+        finally:
+            for connection, _ in sessions.values():
+                connection.close()
+
 if __name__ == '__main__':
     unittest.main()